@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frame timing from photodiode recordings of the corner square.
+
+Each Screen in server/Magneto.py draws a corner square (square_size, square_loc) that flips between
+light and dark on every presented frame while a stimulus plays, and holds still between epochs. With a
+photodiode over the square of each screen recorded on the DAQ (e.g. acquisition/ain, see
+LabJackTSeries.start_ain_acquisition), every square transition marks a presented frame. Bursts of
+transitions separated by a pause mark epochs.
+
+Traces are processed in chunks with NumPy, carrying the detector state across chunk boundaries, so
+hour-long recordings never have to be loaded into memory at once.
+
+Usage:
+    with h5py.File(filepath, 'r') as f:
+        ain = f[epoch_run_path + '/acquisition/ain']
+        timing = align_screens(iter_dataset_chunks(ain), sample_rate=ain.attrs['sample_rate'],
+                               screen_channels={'Left': 0, 'Right': 1}, refresh_rate=144)
+"""
+import numpy as np
+
+
+def detect_transitions(trace, low, high, state=None):
+    """
+    Schmitt-trigger edge detection: the state goes high above high, low below low, and holds in between.
+
+    :trace: 1D array
+    :state: state (bool) before the first sample, e.g. from the previous chunk. If None, the first
+            sample outside the hysteresis band sets it without counting as a transition
+    returns: (indices of samples where the state changed, new state of each transition (bool), state after the last sample)
+    """
+    trace = np.asarray(trace)
+    above = trace > high
+    defined = above | (trace < low)
+    # Forward-fill the state through the hysteresis band
+    last_defined = np.where(defined, np.arange(trace.shape[0]), -1)
+    np.maximum.accumulate(last_defined, out=last_defined)
+    if state is None:
+        first = np.flatnonzero(defined)
+        if first.size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), None
+        state = bool(above[first[0]])
+    states = np.where(last_defined >= 0, above[np.maximum(last_defined, 0)], state)
+
+    previous = np.empty_like(states)
+    previous[0] = state
+    previous[1:] = states[:-1]
+    indices = np.flatnonzero(states != previous)
+    end_state = bool(states[-1]) if states.shape[0] > 0 else state
+    return indices, states[indices], end_state
+
+
+def get_thresholds(trace, low_fraction=0.3, high_fraction=0.7, percentiles=(1, 99)):
+    """
+    Hysteresis thresholds at low_fraction and high_fraction of the way between the dark and light levels,
+    estimated as percentiles of trace.
+    """
+    dark, light = np.percentile(trace, percentiles)
+    return dark + low_fraction * (light - dark), dark + high_fraction * (light - dark)
+
+
+class PhotodiodeAligner():
+    """
+    Streaming frame and epoch detection for one photodiode channel.
+
+    :sample_rate: (Hz) of the trace
+    :low, high: hysteresis thresholds. If None, they are estimated (see get_thresholds) once the chunks fed so
+                far span at least min_contrast between dark and light. Chunks are held back until then,
+                e.g. while the square is static before the first epoch
+    :min_contrast: difference between light and dark levels (trace units, e.g. V) needed to estimate the thresholds.
+                   Should be well above the noise range of the trace
+    :max_pending_time: (sec) at most this much of the trace is held back. If min_contrast is still not reached then,
+                       e.g. on a low-contrast channel, the thresholds are estimated from the held samples anyway and
+                       low_contrast is set
+    :low_fraction, high_fraction: threshold fractions passed to get_thresholds
+    :start_time: (sec) acquisition time of the first sample
+    """
+    def __init__(self, sample_rate, low=None, high=None, min_contrast=0.5, max_pending_time=60.0,
+                 low_fraction=0.3, high_fraction=0.7, start_time=0.0):
+        self.sample_rate = float(sample_rate)
+        self.low = low
+        self.high = high
+        self.min_contrast = min_contrast
+        self.low_fraction = low_fraction
+        self.high_fraction = high_fraction
+        self.low_contrast = False  # True if the thresholds were estimated below min_contrast
+        self.max_pending_samples = int(max_pending_time * self.sample_rate)
+        self.start_time = start_time
+
+        self.state = None
+        self.n_samples = 0
+        self.transition_chunks = []
+        self.pending_chunks = []  # held back until the thresholds are known
+        self.n_pending_samples = 0
+        self.dark = np.inf
+        self.light = -np.inf
+
+    def feed(self, chunk):
+        """
+        Process the next chunk of samples. Returns the number of transitions found.
+        """
+        chunk = np.asarray(chunk, dtype=float).reshape(-1)
+        if self.low is None or self.high is None:
+            dark, light = np.percentile(chunk, (1, 99)) if chunk.size > 0 else (np.inf, -np.inf)
+            self.dark, self.light = min(self.dark, dark), max(self.light, light)
+            self.pending_chunks.append(chunk)
+            self.n_pending_samples += chunk.shape[0]
+            if self.light - self.dark < self.min_contrast:
+                if self.n_pending_samples < self.max_pending_samples:
+                    return 0
+                self.low_contrast = True
+            chunk = np.concatenate(self.pending_chunks)
+            self.low, self.high = get_thresholds(chunk, self.low_fraction, self.high_fraction)
+            self.pending_chunks = []
+            self.n_pending_samples = 0
+        elif self.pending_chunks:
+            chunk = np.concatenate(self.pending_chunks + [chunk])
+            self.pending_chunks = []
+            self.n_pending_samples = 0
+        indices, _, self.state = detect_transitions(chunk, self.low, self.high, state=self.state)
+        self.transition_chunks.append(indices.astype(np.int64) + self.n_samples)
+        self.n_samples += chunk.shape[0]
+        return indices.shape[0]
+
+    def get_transition_samples(self):
+        if len(self.transition_chunks) > 1:
+            self.transition_chunks = [np.concatenate(self.transition_chunks)]
+        return self.transition_chunks[0] if self.transition_chunks else np.zeros(0, dtype=np.int64)
+
+    def get_frame_times(self):
+        """
+        Acquisition time (sec) of every presented frame, i.e. of every square transition.
+        """
+        return self.start_time + self.get_transition_samples() / self.sample_rate
+
+    def get_timing(self, refresh_rate=None, epoch_gap=None):
+        """
+        Frame times, epochs and frame timing errors.
+
+        :refresh_rate: (Hz) display refresh rate. If None, estimated from the median frame interval
+        :epoch_gap: (sec) a pause without transitions longer than this separates epochs. Defaults to 10 frame periods
+        returns: dict with
+            'frame_times': (sec) of every presented frame
+            'frame_period': (sec) nominal frame period
+            'epoch_onsets', 'epoch_offsets': (sec) first and last frame of each epoch
+            'epoch_frame_slices': (n_epochs, 2) [start, stop) indices into frame_times per epoch
+            'dropped_frames': per epoch, refreshes a frame was held beyond its own (intervals of k periods count k - 1)
+            'duplicated_frames': per epoch, transitions less than half a period after the previous one
+                                 (more than one frame within a refresh, e.g. without vsync)
+            'low_contrast': True if the thresholds were estimated below min_contrast, so transitions may be missed
+        """
+        frame_times = self.get_frame_times()
+        intervals = np.diff(frame_times)
+        if refresh_rate is None:
+            frame_period = float(np.median(intervals)) if intervals.size > 0 else np.nan
+        else:
+            frame_period = 1.0 / refresh_rate
+        if epoch_gap is None:
+            epoch_gap = 10 * frame_period
+
+        # Epochs: runs of frames without a pause longer than epoch_gap
+        breaks = np.flatnonzero(intervals > epoch_gap) + 1
+        starts = np.concatenate([[0], breaks]) if frame_times.size > 0 else np.zeros(0, dtype=np.int64)
+        stops = np.concatenate([breaks, [frame_times.size]]) if frame_times.size > 0 else np.zeros(0, dtype=np.int64)
+
+        # Frame timing errors, counted within epochs only
+        n_periods = np.rint(intervals / frame_period)
+        within_epoch = np.ones(intervals.shape[0], dtype=bool)
+        within_epoch[breaks - 1] = False
+        dropped = np.where(within_epoch & (n_periods > 1), n_periods - 1, 0).astype(np.int64)
+        duplicated = (within_epoch & (intervals < 0.5 * frame_period)).astype(np.int64)
+        # Per epoch sums; interval i lies between frames i and i + 1
+        dropped_cumsum = np.concatenate([[0], np.cumsum(dropped)])
+        duplicated_cumsum = np.concatenate([[0], np.cumsum(duplicated)])
+        last_interval = np.maximum(stops - 1, starts)
+
+        return {'frame_times': frame_times,
+                'frame_period': frame_period,
+                'epoch_onsets': frame_times[starts],
+                'epoch_offsets': frame_times[stops - 1] if stops.size > 0 else np.zeros(0),
+                'epoch_frame_slices': np.stack([starts, stops], axis=1) if starts.size > 0 else np.zeros((0, 2), dtype=np.int64),
+                'dropped_frames': dropped_cumsum[last_interval] - dropped_cumsum[starts],
+                'duplicated_frames': duplicated_cumsum[last_interval] - duplicated_cumsum[starts],
+                'low_contrast': self.low_contrast}
+
+
+def iter_dataset_chunks(dataset, chunk_rows=1000000):
+    """
+    Yield consecutive row blocks of an array-like (e.g. an h5py dataset), reading one block at a time.
+    """
+    for start in range(0, dataset.shape[0], chunk_rows):
+        yield dataset[start:start+chunk_rows]
+
+
+def align_screens(chunks, sample_rate, screen_channels, refresh_rate=None, epoch_gap=None, thresholds=None, start_time=0.0):
+    """
+    Frame timing per screen from a multichannel recording.
+
+    :chunks: iterable of (n_samples, n_channels) arrays in time order, e.g. iter_dataset_chunks(ain_dataset)
+    :screen_channels: dict of screen name -> photodiode column
+    :refresh_rate: (Hz) one value for all screens or dict of screen name -> value
+    :thresholds: dict of screen name -> (low, high). Screens not given are estimated from the first chunk
+    returns: dict of screen name -> PhotodiodeAligner.get_timing() dict
+    """
+    thresholds = thresholds or {}
+    aligners = {name: PhotodiodeAligner(sample_rate, *thresholds.get(name, (None, None)), start_time=start_time) for name in screen_channels}
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        for name, column in screen_channels.items():
+            aligners[name].feed(chunk[:, column])
+
+    timing = {}
+    for name, aligner in aligners.items():
+        screen_refresh_rate = refresh_rate.get(name) if isinstance(refresh_rate, dict) else refresh_rate
+        timing[name] = aligner.get_timing(refresh_rate=screen_refresh_rate, epoch_gap=epoch_gap)
+    return timing
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless dry run of a lab protocol, without screens, a GPU or a stimulus server.
+
+Instantiates a protocol class with run and protocol parameters from a preset YAML (presets/JBM) and
+drives it through a run as the visprotocol client does: prepare_run, then get_epoch_parameters and
+load_stimuli for every epoch, against a client that records the commands instead of sending them to a
+stimulus server. All trajectories in the epoch stim parameters are evaluated at every display frame of
+the stimulus. Reports per-epoch setup time, per-frame evaluation cost against the frame budget, and an
+estimate of the total run time.
+
+Usage:
+    python -m lab_package.benchmarks.dry_run MovingPatch [--preset NAME] [--module JBM_protocol] [--refresh_rate 144] [--precompile]
+"""
+import os
+import time
+import argparse
+import importlib
+import numpy as np
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def load_preset(protocol_name, preset_name=None, presets_dir=os.path.join(REPO_DIR, 'presets', 'JBM')):
+    """
+    returns: (preset name, {'run_parameters': ..., 'protocol_parameters': ...}), or (None, None) if there is no preset file
+    """
+    filepath = os.path.join(presets_dir, protocol_name + '.yaml')
+    if not os.path.exists(filepath):
+        return None, None
+    with open(filepath, 'r') as f:
+        presets = yaml.load(f, Loader=yaml.FullLoader)  # presets contain python tuples
+    if preset_name is None:
+        preset_name = next(iter(presets))
+    return preset_name, presets[preset_name]
+
+class DryRunManager():
+    """
+    Stands in for the stimulus server manager: records every command as (name, kwargs) and does nothing.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def record_call(*args, **kwargs):
+            self.calls.append((name, kwargs))
+        return record_call
+
+class DryRunClient():
+    def __init__(self):
+        self.manager = DryRunManager()
+        self.daq_device = None
+
+def get_trajectories(stim_parameters):
+    """
+    (path, trajectory) for every trajectory in the stim parameters (dict or list of dicts).
+    Trajectories are given as dicts with a 'name' key, e.g. {'name': 'tv_pairs', 'tv_pairs': [...], 'kind': 'linear'}.
+    """
+    from flystim import trajectory as ftrajectory
+    if stim_parameters is None:
+        return []
+    if isinstance(stim_parameters, dict):
+        stim_parameters = [stim_parameters]
+    trajectories = []
+    for i, parameters in enumerate(stim_parameters):
+        for key, value in parameters.items():
+            if isinstance(value, dict) and 'name' in value:
+                trajectories.append(('{}/{}'.format(i, key), ftrajectory.make_as_trajectory(value)))
+    return trajectories
+
+def evaluate_trajectories(trajectories, frame_times):
+    """
+    Evaluate every trajectory at every frame time, frame by frame as the renderer does.
+    returns: evaluation time (sec)
+    """
+    from flystim import trajectory as ftrajectory
+    t0 = time.perf_counter()
+    for t in frame_times:
+        for _, trajectory in trajectories:
+            ftrajectory.return_for_time_t(trajectory, t)
+    return time.perf_counter() - t0
+
+def run(protocol_name, preset_name=None, module='JBM_protocol', cfg_path=os.path.join(REPO_DIR, 'configs', 'JBM_config.yaml'),
+        rig_name='Laptop', refresh_rate=144.0, precompile=False, num_epochs=None, seed=0):
+    with open(cfg_path, 'r') as f:
+        cfg = yaml.safe_load(f)
+    cfg['current_rig_name'] = rig_name
+
+    protocol_module = importlib.import_module('lab_package.protocol.' + module)
+    protocol = getattr(protocol_module, protocol_name)(cfg)
+    preset_name, preset = load_preset(protocol_name, preset_name)
+    if preset is not None:
+        protocol.run_parameters.update(preset.get('run_parameters') or {})
+        protocol.protocol_parameters.update(preset.get('protocol_parameters') or {})
+    if num_epochs is not None:
+        protocol.run_parameters['num_epochs'] = num_epochs
+
+    result = {'protocol': protocol_name, 'preset': preset_name, 'refresh_rate': refresh_rate, 'epochs': []}
+    if precompile:
+        # Marks the protocol as precompiled. prepare_run compiles the schedule again for the run, with the same seed
+        protocol.precompile_epoch_schedule(seed=seed)
+
+    client = DryRunClient()
+    t0 = time.perf_counter()
+    protocol.prepare_run()
+    result['prepare_time'] = time.perf_counter() - t0
+    if protocol.epoch_schedule is not None:
+        result['schedule_hash'] = protocol.epoch_schedule.hash
+
+    while protocol.num_epochs_completed < protocol.run_parameters['num_epochs']:
+        n_calls = len(client.manager.calls)
+        t0 = time.perf_counter()
+        protocol.get_epoch_parameters()
+        protocol.load_stimuli(client)
+        setup_time = time.perf_counter() - t0
+
+        epoch_parameters = protocol.epoch_protocol_parameters
+        stim_time = float(epoch_parameters.get('stim_time', protocol.protocol_parameters.get('stim_time', 0)))
+        duration = stim_time + float(epoch_parameters.get('pre_time', 0)) + float(epoch_parameters.get('tail_time', 0))
+        frame_times = np.arange(0, stim_time, 1.0 / refresh_rate)
+        trajectories = get_trajectories(protocol.epoch_stim_parameters)
+        eval_time = evaluate_trajectories(trajectories, frame_times) if trajectories else 0.0
+
+        result['epochs'].append({'setup_time': setup_time,
+                                 'commands': [name for name, _ in client.manager.calls[n_calls:]],
+                                 'n_trajectories': len(trajectories),
+                                 'n_frames': frame_times.shape[0],
+                                 'frame_eval_time': eval_time / max(frame_times.shape[0], 1),
+                                 'duration': duration})
+        protocol.num_epochs_completed += 1
+
+    result['estimated_run_time'] = sum(e['duration'] + e['setup_time'] for e in result['epochs'])
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Dry run a protocol without screens and time its epochs.')
+    parser.add_argument('protocol', help='protocol class name, e.g. MovingPatch')
+    parser.add_argument('--preset', default=None, help='preset name in presets/JBM/<protocol>.yaml (default: first)')
+    parser.add_argument('--module', default='JBM_protocol', help='module in lab_package/protocol')
+    parser.add_argument('--rig', default='Laptop', help='rig name in the config')
+    parser.add_argument('--refresh_rate', type=float, default=144.0, help='display refresh rate (Hz)')
+    parser.add_argument('--num_epochs', type=int, default=None, help='override the number of epochs')
+    parser.add_argument('--precompile', action='store_true', help='precompile the epoch schedule first')
+    args = parser.parse_args()
+
+    result = run(args.protocol, preset_name=args.preset, module=args.module, rig_name=args.rig,
+                 refresh_rate=args.refresh_rate, precompile=args.precompile, num_epochs=args.num_epochs)
+
+    frame_budget = 1.0 / args.refresh_rate
+    print('{} (preset {!r}), {} epochs at {:.0f} Hz'.format(result['protocol'], result['preset'], len(result['epochs']), args.refresh_rate))
+    if 'schedule_hash' in result:
+        print('Precompiled schedule {} in {:.1f} ms'.format(result['schedule_hash'][:12], 1e3 * result['prepare_time']))
+    print('{:>6s} {:>10s} {:>6s} {:>8s} {:>14s} {:>8s} {:>9s}'.format('epoch', 'setup ms', 'traj', 'frames', 'eval us/frame', 'budget', 'duration'))
+    for i, epoch in enumerate(result['epochs']):
+        print('{:6d} {:10.3f} {:6d} {:8d} {:14.2f} {:7.2f}% {:8.2f}s'.format(
+            i, 1e3 * epoch['setup_time'], epoch['n_trajectories'], epoch['n_frames'], 1e6 * epoch['frame_eval_time'],
+            100 * epoch['frame_eval_time'] / frame_budget, epoch['duration']))
+    setup_times = np.array([e['setup_time'] for e in result['epochs']])
+    frame_eval_times = np.array([e['frame_eval_time'] for e in result['epochs']])
+    print('Setup: median {:.3f} ms, max {:.3f} ms'.format(1e3 * np.median(setup_times), 1e3 * setup_times.max()))
+    print('Per-frame evaluation: median {:.2f} us, max {:.2f} us ({:.2f}% of the frame budget)'.format(
+        1e6 * np.median(frame_eval_times), 1e6 * frame_eval_times.max(), 100 * frame_eval_times.max() / frame_budget))
+    print('Estimated run time: {:.1f} s'.format(result['estimated_run_time']))
+
+if __name__ == '__main__':
+    main()
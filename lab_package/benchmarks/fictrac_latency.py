@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Closed-loop latency benchmark against the fake FicTrac UDP sender in misc/fake_fictrac.py.
+
+Runs the receive path of FtClosedLoopManager (recv, FtLineParser, set-pose on a stand-in stimulus
+manager) with FtLatencyTracer, and prints per-epoch frame counts and latency percentiles.
+
+Usage:
+    python -m lab_package.benchmarks.fictrac_latency [--rate HZ] [--n_epochs N] [--epoch_duration SEC] [--drop_probability P]
+"""
+import os
+import sys
+import socket
+import subprocess
+import time
+import argparse
+
+from lab_package.device.loco_managers.fictrac_parser import FtLineParser
+from lab_package.device.loco_managers.fictrac_latency import FtLatencyTracer, FsManagerTimingProxy, LATENCY_STAGES, PERCENTILES
+
+FAKE_FICTRAC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'misc', 'fake_fictrac.py')
+
+class NullFsManager():
+    # Stands in for the flystim manager
+    def set_global_theta_offset(self, value):
+        pass
+
+def run(rate=200.0, n_epochs=3, epoch_duration=2.0, drop_probability=0.0, lines_per_datagram=1):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.5)
+    port = sock.getsockname()[1]
+    sender = subprocess.Popen([sys.executable, FAKE_FICTRAC, '--port', str(port), '--rate', str(rate), '--no_files',
+                               '--drop_probability', str(drop_probability), '--lines_per_datagram', str(lines_per_datagram)])
+
+    parser = FtLineParser(theta_idx=16, x_idx=14, y_idx=15, frame_num_idx=0, timestamp_idx=21)
+    tracer = FtLatencyTracer()
+    fs_manager = FsManagerTimingProxy(NullFsManager(), tracer)
+
+    summaries = []
+    try:
+        for _ in range(n_epochs):
+            tracer.start_epoch()
+            t_end = time.time() + epoch_duration
+            while time.time() < t_end:
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    continue
+                recv_time = time.time()
+                for line in data.split(b'\n'):
+                    frame = parser.parse_line(line) if len(line) > 1 else None
+                    if frame is None:
+                        continue
+                    tracer.record_frame(frame[0], frame[1], recv_time=recv_time)
+                fs_manager.set_global_theta_offset(parser.buffer.latest()['theta'])
+            summaries.append(tracer.get_epoch_summary())
+    finally:
+        sender.send_signal(2)
+        sender.wait(timeout=5)
+        sock.close()
+    return summaries
+
+def main():
+    parser = argparse.ArgumentParser(description='Trace closed-loop latency against a fake FicTrac sender.')
+    parser.add_argument('--rate', type=float, default=200.0, help='FicTrac frame rate (Hz)')
+    parser.add_argument('--n_epochs', type=int, default=3)
+    parser.add_argument('--epoch_duration', type=float, default=2.0, help='(sec)')
+    parser.add_argument('--drop_probability', type=float, default=0.0)
+    parser.add_argument('--lines_per_datagram', type=int, default=1)
+    args = parser.parse_args()
+
+    summaries = run(rate=args.rate, n_epochs=args.n_epochs, epoch_duration=args.epoch_duration,
+                    drop_probability=args.drop_probability, lines_per_datagram=args.lines_per_datagram)
+    header = ' '.join(['p{:<7d}'.format(p) for p in PERCENTILES])
+    for epoch, summary in enumerate(summaries):
+        print('Epoch {}: {} frames, {} dropped, {} out of order'.format(epoch, summary['n_frames'], summary['n_dropped'], summary['n_out_of_order']))
+        print('    {:10s} {} (ms)'.format('', header))
+        for stage in LATENCY_STAGES:
+            print('    {:10s} {}'.format(stage, ' '.join(['{:8.3f}'.format(1e3 * v) for v in summary[stage + '_percentiles']])))
+
+if __name__ == '__main__':
+    main()
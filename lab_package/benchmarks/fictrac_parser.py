@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of FicTrac line parsing: the original split-everything parser that returns a dict
+per frame, against FtLineParser writing into a ring buffer, line by line and per datagram.
+
+Usage:
+    python -m lab_package.benchmarks.fictrac_parser [--n_lines N] [--n_cols N] [--lines_per_datagram N]
+"""
+import argparse
+import timeit
+import numpy as np
+
+from lab_package.device.loco_managers.fictrac_parser import FtLineParser
+
+FT_FRAME_NUM_IDX = 0
+FT_X_IDX = 14
+FT_Y_IDX = 15
+FT_THETA_IDX = 16
+FT_TIMESTAMP_IDX = 21
+
+def parse_line_dict(line, ft_frame_num_idx=FT_FRAME_NUM_IDX, ft_timestamp_idx=FT_TIMESTAMP_IDX, ft_theta_idx=FT_THETA_IDX, ft_x_idx=FT_X_IDX, ft_y_idx=FT_Y_IDX):
+    # Parser as previously implemented in FtClosedLoopManager._parse_line
+    toks = line.split(", ")
+    if toks.pop(0) != "FT":
+        return None
+    frame_num = int(toks[ft_frame_num_idx])
+    ts = float(toks[ft_timestamp_idx])
+    theta = -float(toks[ft_theta_idx])
+    x = float(toks[ft_x_idx])
+    y = float(toks[ft_y_idx])
+    return {'theta': theta, 'x': x, 'y': y, 'z': 0, 'frame_num': frame_num, 'ts': ts}
+
+def make_lines(n_lines, n_cols=25, seed=0):
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(n_lines):
+        cols = ['{:.6f}'.format(v) for v in rng.standard_normal(n_cols)]
+        cols[FT_FRAME_NUM_IDX] = str(i)
+        cols[FT_TIMESTAMP_IDX] = '{:.3f}'.format(1.6e12 + 10.0 * i)
+        lines.append('FT, ' + ', '.join(cols))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FicTrac line parsers.')
+    parser.add_argument('--n_lines', type=int, default=20000)
+    parser.add_argument('--n_cols', type=int, default=25)
+    parser.add_argument('--lines_per_datagram', type=int, default=4)
+    args = parser.parse_args()
+
+    lines = make_lines(args.n_lines, n_cols=args.n_cols)
+    byte_lines = [line.encode() for line in lines]
+    k = args.lines_per_datagram
+    datagrams = [b'\n'.join(byte_lines[i:i+k]) + b'\n' for i in range(0, len(byte_lines), k)]
+
+    ft_parser = FtLineParser(theta_idx=FT_THETA_IDX, x_idx=FT_X_IDX, y_idx=FT_Y_IDX, frame_num_idx=FT_FRAME_NUM_IDX, timestamp_idx=FT_TIMESTAMP_IDX)
+
+    # Check that both parsers agree before timing them
+    for line in lines[:100]:
+        expected = parse_line_dict(line)
+        frame = ft_parser.parse_line(line.encode())
+        assert frame == (expected['frame_num'], expected['ts'], expected['theta'], expected['x'], expected['y'], expected['z'])
+
+    results = {'dict per line (original)': timeit.timeit(lambda: [parse_line_dict(line) for line in lines], number=3) / 3,
+               'FtLineParser.parse_line': timeit.timeit(lambda: [ft_parser.parse_line(line) for line in byte_lines], number=3) / 3,
+               'FtLineParser.parse_datagram ({} lines)'.format(k): timeit.timeit(lambda: [ft_parser.parse_datagram(d) for d in datagrams], number=3) / 3}
+
+    print('{} lines, {} columns'.format(args.n_lines, args.n_cols))
+    for name, t in results.items():
+        print('{:40s} {:8.3f} us/line'.format(name, 1e6 * t / args.n_lines))
+
+if __name__ == '__main__':
+    main()
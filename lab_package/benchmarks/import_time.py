@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import-time benchmark for lab_package modules and the Magneto server.
+
+Each module is imported in a fresh interpreter, so timings are cold-start times. Also reports which
+heavy dependencies got loaded as a side effect of the import.
+
+Usage:
+    python -m lab_package.benchmarks.import_time [--repeats N] [module ...]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_MODULES = ['lab_package.client',
+                   'lab_package.data',
+                   'lab_package.device.daq',
+                   'lab_package.protocol.JBM_protocol',
+                   'lab_package.stimulus.baccus.stimuli',
+                   'lab_package.stimulus.baccus.util',
+                   'Magneto']
+
+HEAVY_MODULES = ['cv2', 'labjack', 'labjack.ljm', 'h5py', 'matplotlib', 'scipy', 'flystim.stimuli']
+
+IMPORT_SCRIPT = """
+import sys, time, json
+sys.path[:0] = {paths!r}
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+print(json.dumps({{'time': dt, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def time_import(module, repeats=5):
+    """
+    Import module in repeats fresh interpreters.
+
+    returns: dict with 'module', 'times' (sec, per repeat), 'heavy' (heavy modules loaded) and 'error'
+    """
+    paths = [REPO_DIR, os.path.join(REPO_DIR, 'server')]
+    script = IMPORT_SCRIPT.format(paths=paths, module=module, heavy=HEAVY_MODULES)
+    result = {'module': module, 'times': [], 'heavy': [], 'error': None}
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+        if proc.returncode != 0:
+            result['error'] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'exit code {}'.format(proc.returncode)
+            break
+        out = json.loads(proc.stdout.strip().splitlines()[-1])
+        result['times'].append(out['time'])
+        result['heavy'] = out['heavy']
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold import time of lab_package modules.')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{:40s} {:>10s} {:>10s}  {}'.format('module', 'median ms', 'min ms', 'heavy deps loaded'))
+    for module in args.modules:
+        result = time_import(module, repeats=args.repeats)
+        if result['error'] is not None:
+            print('{:40s} {:>10s} {:>10s}  {}'.format(module, '-', '-', 'ERROR: ' + result['error']))
+            continue
+        times_ms = 1e3 * np.array(result['times'])
+        print('{:40s} {:10.1f} {:10.1f}  {}'.format(module, np.median(times_ms), times_ms.min(), ', '.join(result['heavy'])))
+
+if __name__ == '__main__':
+    main()
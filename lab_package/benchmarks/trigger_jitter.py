@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trigger pulse-width jitter simulation for LabJackTSeries, against the simulated LJM in device/ljm_sim.py.
+No device is involved: this compares the two trigger modes under simulated write latency, it does not
+measure the jitter of real hardware.
+
+Software-timed triggers (time.sleep between two writes) are measured from the timestamps of the
+simulated high and low writes, so their jitter is that of the host's sleep and the simulated latency.
+Hardware-timed pulses are computed by the simulator from the Pulse Out configuration, so their width
+is exact by construction; what this checks for them is the configured width and how long each
+send_trigger call blocks the caller.
+
+Usage:
+    python -m lab_package.benchmarks.trigger_jitter [--n_pulses N] [--width SEC] [--write_latency SEC]
+"""
+import time
+import argparse
+import numpy as np
+
+from lab_package.device import daq, ljm_sim
+
+def measure_software_widths(sim, channel):
+    widths = []
+    t_high = None
+    for t, name, value in sim.write_log:
+        if name != channel:
+            continue
+        if value == 1:
+            t_high = t
+        elif t_high is not None:
+            widths.append(t - t_high)
+            t_high = None
+    return np.array(widths)
+
+def run(n_pulses=200, width=0.005, write_latency=0.0005, interval=0.002, channel='FIO4'):
+    results = {}
+    for mode in ['software', 'hardware']:
+        sim = ljm_sim.SimulatedLJM(write_latency=write_latency)
+        daq.ljm = sim
+        dev = daq.LabJackTSeries(trigger_channel=[channel], hardware_timed_triggers=(mode == 'hardware'))
+        # Configure once up front, as the first trigger of a run would
+        if mode == 'hardware':
+            dev.setup_hardware_timed_pulse(output_channel=[channel], pulse_width=width)
+
+        call_times = []
+        for _ in range(n_pulses):
+            t0 = time.perf_counter()
+            dev.send_trigger(trigger_duration=width)
+            call_times.append(time.perf_counter() - t0)
+            time.sleep(interval)
+        dev.close()
+
+        if mode == 'software':
+            widths = measure_software_widths(sim, channel)
+        else:
+            widths = np.array([w for _, _, w in sim.pulse_log])
+        results[mode] = {'widths': widths, 'call_times': np.array(call_times)}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare software- and hardware-timed trigger pulse widths on the simulated LJM.')
+    parser.add_argument('--n_pulses', type=int, default=200)
+    parser.add_argument('--width', type=float, default=0.005, help='nominal pulse width (sec)')
+    parser.add_argument('--write_latency', type=float, default=0.0005, help='simulated duration of one LJM write (sec)')
+    args = parser.parse_args()
+
+    results = run(n_pulses=args.n_pulses, width=args.width, write_latency=args.write_latency)
+    print('simulated LJM (hardware-timed widths are exact by construction)')
+    print('nominal width: {:.3f} ms'.format(1e3 * args.width))
+    print('{:10s} {:>12s} {:>12s} {:>12s} {:>14s}'.format('mode', 'mean ms', 'std us', 'max err us', 'call mean ms'))
+    for mode, res in results.items():
+        err = res['widths'] - args.width
+        print('{:10s} {:12.4f} {:12.2f} {:12.2f} {:14.4f}'.format(mode, 1e3 * res['widths'].mean(), 1e6 * res['widths'].std(),
+                                                              1e6 * np.abs(err).max(), 1e3 * res['call_times'].mean()))
+
+if __name__ == '__main__':
+    main()
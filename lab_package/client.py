@@ -1,10 +1,5 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from flystim.stim_server import launch_stim_server
-from flyrpc.transceiver import MySocketClient
-from flystim.screen import Screen
-from flystim.draw import draw_screens
-
 from visprotocol import client
 
 
@@ -5,13 +5,271 @@ Data file class
 
 
 """
-import h5py
 import os
-from datetime import datetime
+import json
+import time
 import numpy as np
 
 from visprotocol import data
+from lab_package.lazy_import import lazy_import
+
+h5py = lazy_import('h5py')
+
+EPOCH_TABLE_NAME = 'epoch_table'
+EPOCH_INDEX_COLUMNS = ['epoch_number', 'start_time', 'end_time']
+
+def to_column_value(value):
+    """
+    Value as stored in an epoch parameter column: numbers and bools as they are, non-empty flat numeric
+    sequences as 1D arrays, and anything else (strings, nested dicts and lists, ragged or empty sequences...) as a string.
+    """
+    if isinstance(value, (bool, np.bool_, int, float, np.integer, np.floating)):
+        return value
+    if isinstance(value, (list, tuple, np.ndarray)):
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            # Ragged nesting, e.g. [[1, 2], [3]]
+            array = None
+        if array is not None and array.ndim == 1 and array.size > 0 and array.dtype.kind in 'biuf':
+            return array
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+def get_column_fill_value(dataset):
+    """
+    Value used for epochs that do not have a parameter: NaN for floats, -1 for ints, False, or ''.
+    """
+    kind = dataset.dtype.kind
+    if kind == 'f':
+        return np.nan
+    if kind in 'iu':
+        return -1
+    if kind == 'b':
+        return False
+    return ''
+
 
 class Data(data.BaseData):
+    """
+    cfg['epoch_parameter_storage'] sets how epoch parameters are saved:
+        'groups': as attributes of one group per epoch (visprotocol default)
+        'columns': as one row per epoch of typed, chunked datasets in the epoch run group, see append_epoch_parameter_row
+        'both'
+    """
     def __init__(self, cfg):
         super().__init__(cfg)  # call the parent class init method
+
+        self.epoch_parameter_storage = cfg.get('epoch_parameter_storage', 'groups') if isinstance(cfg, dict) else 'groups'
+        if self.epoch_parameter_storage not in ('groups', 'columns', 'both'):
+            raise ValueError('Unrecognized epoch_parameter_storage: {}'.format(self.epoch_parameter_storage))
+        self.epoch_table_chunk_rows = 256
+
+    def create_epoch(self, protocol_object):
+        if self.epoch_parameter_storage in ('groups', 'both'):
+            super().create_epoch(protocol_object)
+        if self.epoch_parameter_storage in ('columns', 'both') and self.experiment_file_name is not None:
+            self.append_epoch_parameter_row(protocol_object)
+
+    def end_epoch(self, protocol_object):
+        if self.epoch_parameter_storage in ('groups', 'both') and hasattr(super(), 'end_epoch'):
+            super().end_epoch(protocol_object)
+        if self.epoch_parameter_storage in ('columns', 'both') and self.experiment_file_name is not None:
+            self.set_epoch_end_time()
+
+    def get_experiment_filepath(self):
+        return os.path.join(self.data_directory, self.experiment_file_name + '.hdf5')
+
+    def get_epoch_run_group_path(self, series_number=None):
+        """
+        HDF5 path of the epoch run group for series_number (defaults to the current series).
+        """
+        if series_number is None:
+            series_number = self.series_count
+        return '/Subjects/{}/epoch_runs/series_{}'.format(self.current_subject, str(series_number).zfill(3))
+
+    def append_to_epoch_run_dataset(self, name, rows, attrs=None, series_number=None, chunk_rows=None):
+        """
+        Append rows to a resizable, chunked dataset in the epoch run group, creating it on first write.
+
+        name: (str) dataset path relative to the epoch run group, e.g. 'acquisition/ain'
+        rows: array whose first axis is appended, e.g. (n_scans, n_channels)
+        attrs: (dict) attributes set on the dataset when it is created
+        chunk_rows: (int) rows per HDF5 chunk, defaults to the size of the first write
+        returns: number of rows in the dataset after appending
+        """
+        rows = np.asarray(rows)
+        with h5py.File(self.get_experiment_filepath(), 'r+') as experiment_file:
+            epoch_run_group = experiment_file[self.get_epoch_run_group_path(series_number)]
+            if name in epoch_run_group:
+                dataset = epoch_run_group[name]
+                n_existing = dataset.shape[0]
+                dataset.resize(n_existing + rows.shape[0], axis=0)
+            else:
+                chunks = (max(chunk_rows or rows.shape[0], 1),) + rows.shape[1:]
+                dataset = epoch_run_group.create_dataset(name, shape=rows.shape, maxshape=(None,) + rows.shape[1:], dtype=rows.dtype, chunks=chunks)
+                n_existing = 0
+                for key, value in (attrs or {}).items():
+                    dataset.attrs[key] = value
+            dataset[n_existing:] = rows
+            return dataset.shape[0]
+
+    def get_acquisition_sink(self, name='acquisition/ain', channel_names=None, sample_rate=None, start_time=None, series_number=None):
+        """
+        Return a callable that appends chunks of acquired samples (n_samples, n_channels) to
+        dataset name in the epoch run group, e.g. as the sink of LabJackTSeries.start_ain_acquisition.
+        The series number is fixed when the sink is created.
+        Only for acquisitions in this process: a device on the server writes a file of its own, see link_acquisition_file.
+        """
+        if series_number is None:
+            series_number = self.series_count
+        attrs = {}
+        if channel_names is not None:
+            attrs['channel_names'] = [str(x) for x in channel_names]
+        if sample_rate is not None:
+            attrs['sample_rate'] = sample_rate
+        if start_time is not None:
+            attrs['start_time'] = start_time
+
+        def sink(chunk):
+            self.append_to_epoch_run_dataset(name, chunk, attrs=attrs, series_number=series_number)
+        return sink
+
+    def link_acquisition_file(self, name, filepath, dataset_name='ain', series_number=None):
+        """
+        Link dataset dataset_name of an HDF5 file written by another process, e.g. server-side acquisition
+        (see acquisition.H5FileSink), into the epoch run group as name. The link resolves as long as filepath
+        is reachable from where the experiment file is read, e.g. a shared data directory.
+        """
+        with h5py.File(self.get_experiment_filepath(), 'r+') as experiment_file:
+            epoch_run_group = experiment_file[self.get_epoch_run_group_path(series_number)]
+            epoch_run_group[name] = h5py.ExternalLink(filepath, dataset_name)
+
+    def write_epoch_run_attrs(self, name, attrs, series_number=None):
+        """
+        Set attributes on an object in the epoch run group, e.g. acquisition counters on the acquired dataset.
+        name None sets them on the epoch run group itself.
+        """
+        with h5py.File(self.get_experiment_filepath(), 'r+') as experiment_file:
+            obj = experiment_file[self.get_epoch_run_group_path(series_number)]
+            if name is not None:
+                obj = obj[name]
+            for key, value in attrs.items():
+                obj.attrs[key] = 'None' if value is None else value
+
+    def append_epoch_parameter_row(self, protocol_object, start_time=None, series_number=None):
+        """
+        Append the current epoch's parameters as one row of the epoch table in the epoch run group:
+            epoch_table/epoch_index: (epoch_number, start_time, end_time), end_time NaN until set_epoch_end_time
+            epoch_table/protocol_parameters/<key>: one column per epoch protocol parameter
+            epoch_table/stim_parameters/<key>: one column per epoch stim parameter. With several stims, keys are prefixed '<i>_'
+        A column that first appears after some epochs is filled for the earlier ones, and vice versa
+        (see get_column_fill_value). A parameter whose shape or type changes between epochs is stored as a string column.
+        """
+        if start_time is None:
+            start_time = time.time()
+        stim_parameters = protocol_object.epoch_stim_parameters
+        if isinstance(stim_parameters, (list, tuple)):
+            stim_parameters = {'{}_{}'.format(i, key): value for i, p in enumerate(stim_parameters) for key, value in p.items()}
+
+        with h5py.File(self.get_experiment_filepath(), 'r+') as experiment_file:
+            table = experiment_file[self.get_epoch_run_group_path(series_number)].require_group(EPOCH_TABLE_NAME)
+            n_epochs = table['epoch_index'].shape[0] if 'epoch_index' in table else 0
+            epoch_number = protocol_object.num_epochs_completed + 1 if hasattr(protocol_object, 'num_epochs_completed') else n_epochs + 1
+
+            self._append_column(table, 'epoch_index', np.array([epoch_number, start_time, np.nan]), n_epochs)
+            table['epoch_index'].attrs['columns'] = EPOCH_INDEX_COLUMNS
+            for group_name, parameters in (('protocol_parameters', protocol_object.epoch_protocol_parameters),
+                                           ('stim_parameters', stim_parameters)):
+                group = table.require_group(group_name)
+                for key, value in parameters.items():
+                    self._append_column(group, str(key), to_column_value(value), n_epochs)
+                # Parameters missing from this epoch
+                for key in group:
+                    dataset = group[key]
+                    if dataset.shape[0] == n_epochs:
+                        dataset.resize(n_epochs + 1, axis=0)
+                        dataset[n_epochs] = get_column_fill_value(dataset)
+
+    def set_epoch_end_time(self, end_time=None, series_number=None):
+        """
+        Set the end time of the last row of the epoch index.
+        """
+        if end_time is None:
+            end_time = time.time()
+        with h5py.File(self.get_experiment_filepath(), 'r+') as experiment_file:
+            table = experiment_file[self.get_epoch_run_group_path(series_number)].get(EPOCH_TABLE_NAME)
+            if table is None or 'epoch_index' not in table or table['epoch_index'].shape[0] == 0:
+                return
+            table['epoch_index'][-1, 2] = end_time
+
+    def get_epoch_parameter_table(self, series_number=None):
+        """
+        Read the whole epoch table of a run.
+
+        returns: dict with 'epoch_index' (n_epochs, 3) and 'protocol_parameters' and 'stim_parameters', each a dict of column name -> array
+        """
+        with h5py.File(self.get_experiment_filepath(), 'r') as experiment_file:
+            table = experiment_file[self.get_epoch_run_group_path(series_number)][EPOCH_TABLE_NAME]
+            result = {'epoch_index': table['epoch_index'][:]}
+            for group_name in ('protocol_parameters', 'stim_parameters'):
+                group = table.get(group_name, {})
+                result[group_name] = {key: group[key].asstr()[:] if h5py.check_string_dtype(group[key].dtype) else group[key][:]
+                                      for key in group}
+            return result
+
+    def _append_column(self, group, name, value, row):
+        """
+        Write value at row of column name, creating or growing the column as needed.
+        Earlier rows of a new column are filled. A value that does not fit the column turns it into a string column.
+        """
+        if not isinstance(value, str) and np.size(value) == 0:
+            # Zero-size values cannot be stored in a chunked column
+            value = json.dumps(np.asarray(value).tolist())
+        is_string = isinstance(value, str)
+        value = np.asarray(value)
+        if name not in group:
+            if is_string:
+                dataset = group.create_dataset(name, shape=(row + 1,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(self.epoch_table_chunk_rows,))
+            else:
+                dataset = group.create_dataset(name, shape=(row + 1,) + value.shape, maxshape=(None,) + value.shape, dtype=value.dtype,
+                                               chunks=(self.epoch_table_chunk_rows,) + value.shape)
+                if row > 0:
+                    dataset[:row] = get_column_fill_value(dataset)
+            dataset[row] = value
+            return
+
+        dataset = group[name]
+        column_is_string = h5py.check_string_dtype(dataset.dtype) is not None
+        if not column_is_string and not is_string and dataset.shape[1:] == value.shape and not np.can_cast(value.dtype, dataset.dtype, casting='same_kind'):
+            # e.g. a float in an int column: widen the column
+            dataset = self._convert_column(group, name, np.result_type(dataset.dtype, value.dtype))
+        elif column_is_string != is_string or (not is_string and dataset.shape[1:] != value.shape):
+            dataset = self._convert_column(group, name, h5py.string_dtype())
+            if not is_string:
+                value = np.asarray(json.dumps(value.tolist()))
+        if dataset.shape[0] <= row:
+            dataset.resize(row + 1, axis=0)
+        dataset[row] = value
+
+    def _convert_column(self, group, name, dtype):
+        """
+        Rewrite column name with dtype. Converting to a string column stores earlier values as JSON.
+        """
+        old = group[name]
+        if h5py.check_string_dtype(old.dtype) is not None:
+            return old
+        values = old[:]
+        del group[name]
+        if h5py.check_string_dtype(dtype) is not None:
+            values = [json.dumps(v.tolist()) for v in values]
+            dataset = group.create_dataset(name, shape=(len(values),), maxshape=(None,), dtype=dtype, chunks=(self.epoch_table_chunk_rows,))
+        else:
+            dataset = group.create_dataset(name, shape=values.shape, maxshape=(None,) + values.shape[1:], dtype=dtype,
+                                           chunks=(self.epoch_table_chunk_rows,) + values.shape[1:])
+        if len(values) > 0:
+            dataset[:] = values
+        return dataset
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Continuous analog input acquisition from a LabJack stream.
+
+A reader thread calls ljm.eStreamRead into a preallocated ring buffer, and a writer thread drains
+the ring buffer in chunks into a sink. The reader never waits on disk.
+
+Where the data lands depends on where the device is:
+    - DAQ in the client process: Data.get_acquisition_sink() appends to a resizable dataset in the
+      epoch run's HDF5 group.
+    - DAQ on the server: Data lives in the client process, so the server appends to an HDF5 file of
+      its own with H5FileSink (see LabJackTSeries.start_ain_acquisition(filepath=...)), and the client
+      links that file into the epoch run with Data.link_acquisition_file.
+"""
+import threading
+import time
+import numpy as np
+
+from lab_package.lazy_import import lazy_import
+
+h5py = lazy_import('h5py')
+
+SKIPPED_SCAN_VALUE = -9999.0  # LJM marks scans the device had to skip with this value
+
+
+class RingBuffer():
+    """
+    Preallocated single-producer, single-consumer ring buffer of (n_samples, n_channels) rows.
+    If the consumer falls behind by more than capacity rows, the oldest rows are overwritten
+    and counted in n_overwritten.
+    """
+    def __init__(self, capacity, n_channels, dtype=np.float64):
+        self.data = np.zeros((int(capacity), int(n_channels)), dtype=dtype)
+        self.capacity = int(capacity)
+        self.lock = threading.Lock()
+        self.write_idx = 0  # total rows ever written
+        self.read_idx = 0  # total rows ever read
+        self.n_overwritten = 0
+
+    def write(self, rows):
+        n_rows = rows.shape[0]
+        rows = rows[-self.capacity:]
+        n = rows.shape[0]
+        with self.lock:
+            self.write_idx += n_rows - n  # rows that would be overwritten within this write anyway
+            start = self.write_idx % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[start:start+first] = rows[:first]
+            self.data[:n-first] = rows[first:]
+            self.write_idx += n
+            if self.write_idx - self.read_idx > self.capacity:
+                self.n_overwritten += self.write_idx - self.read_idx - self.capacity
+                self.read_idx = self.write_idx - self.capacity
+
+    def read(self, max_rows=None):
+        """
+        Return a copy of all unread rows (at most max_rows), oldest first.
+        """
+        with self.lock:
+            n = self.write_idx - self.read_idx
+            if max_rows is not None:
+                n = min(n, max_rows)
+            start = self.read_idx % self.capacity
+            first = min(n, self.capacity - start)
+            rows = np.concatenate([self.data[start:start+first], self.data[:n-first]])
+            self.read_idx += n
+        return rows
+
+    def __len__(self):
+        with self.lock:
+            return self.write_idx - self.read_idx
+
+    def get_n_overwritten(self):
+        with self.lock:
+            return self.n_overwritten
+
+
+class H5FileSink():
+    """
+    Sink that appends chunks of rows to a resizable, chunked dataset in an HDF5 file, creating it on first write.
+    For acquisitions running in another process than Data, e.g. on the server.
+
+    :filepath: HDF5 file, created if needed
+    :name: dataset path in the file
+    :attrs: attributes set on the dataset when it is created
+    :chunk_rows: rows per HDF5 chunk. If None, the number of rows in the first write
+    """
+    def __init__(self, filepath, name='ain', attrs=None, chunk_rows=None):
+        self.filepath = filepath
+        self.name = name
+        self.attrs = {} if attrs is None else dict(attrs)
+        self.chunk_rows = chunk_rows
+        self.n_rows = 0
+
+    def __call__(self, chunk):
+        chunk = np.asarray(chunk)
+        with h5py.File(self.filepath, 'a') as f:
+            if self.name in f:
+                dataset = f[self.name]
+                n_existing = dataset.shape[0]
+                dataset.resize(n_existing + chunk.shape[0], axis=0)
+            else:
+                dataset = f.create_dataset(self.name, shape=chunk.shape, maxshape=(None,) + chunk.shape[1:], dtype=chunk.dtype,
+                                           chunks=(self.chunk_rows or max(chunk.shape[0], 1),) + chunk.shape[1:])
+                n_existing = 0
+                for key, value in self.attrs.items():
+                    dataset.attrs[key] = value
+            dataset[n_existing:] = chunk
+            self.n_rows = dataset.shape[0]
+
+
+class AinAcquisition():
+    """
+    Reader and writer threads for an analog input stream that has already been started.
+
+    :ljm: ljm module (or a stand-in, see device/ljm_sim.py)
+    :handle: open device handle
+    :channel_names: names of the scanned channels, in scan list order
+    :scan_rate: (Hz) actual scan rate of the stream
+    :sink: callable taking a (n_scans, n_channels) array, called from the writer thread. None to only keep counters
+    :ring_seconds: (sec) capacity of the ring buffer
+    :flush_interval: (sec) how often the writer drains the ring buffer
+    """
+    def __init__(self, ljm, handle, channel_names, scan_rate, sink=None, ring_seconds=10.0, flush_interval=0.5):
+        self.ljm = ljm
+        self.handle = handle
+        self.channel_names = list(channel_names)
+        self.scan_rate = scan_rate
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.ring = RingBuffer(capacity=max(int(ring_seconds * scan_rate), 1), n_channels=len(self.channel_names))
+
+        self.stop_event = threading.Event()
+        self.error = None
+        self.start_time = None
+
+        # Counters
+        self.n_reads = 0
+        self.n_scans = 0
+        self.n_skipped_scans = 0
+        self.n_scans_written = 0
+        self.max_device_backlog = 0
+        self.max_ljm_backlog = 0
+
+        self.reader = threading.Thread(target=self._read_loop, name='ain_reader', daemon=True)
+        self.writer = threading.Thread(target=self._write_loop, name='ain_writer', daemon=True)
+
+    def start(self):
+        self.start_time = time.time()
+        self.reader.start()
+        self.writer.start()
+
+    def stop_reading(self, timeout=None):
+        """
+        Stop the reader thread. Call before stopping the device stream.
+        """
+        self.stop_event.set()
+        if self.reader.is_alive():
+            self.reader.join(timeout=timeout)
+
+    def finish(self, timeout=None):
+        """
+        Wait for the writer to drain the ring buffer into the sink.
+        """
+        self.stop_event.set()
+        if self.writer.is_alive():
+            self.writer.join(timeout=timeout)
+
+    def is_running(self):
+        return self.reader.is_alive()
+
+    def get_counters(self):
+        return {'reads': self.n_reads,
+                'scans': self.n_scans,
+                'skipped_scans': self.n_skipped_scans,
+                'scans_written': self.n_scans_written,
+                'ring_overwritten_scans': self.ring.get_n_overwritten(),
+                'max_device_backlog': self.max_device_backlog,
+                'max_ljm_backlog': self.max_ljm_backlog,
+                'error': None if self.error is None else repr(self.error)}
+
+    def _read_loop(self):
+        n_channels = len(self.channel_names)
+        try:
+            while not self.stop_event.is_set():
+                aData, device_backlog, ljm_backlog = self.ljm.eStreamRead(self.handle)
+                scans = np.asarray(aData, dtype=np.float64).reshape(-1, n_channels)
+
+                self.n_reads += 1
+                self.n_scans += scans.shape[0]
+                self.n_skipped_scans += int(np.count_nonzero(np.any(scans == SKIPPED_SCAN_VALUE, axis=1)))
+                self.max_device_backlog = max(self.max_device_backlog, device_backlog)
+                self.max_ljm_backlog = max(self.max_ljm_backlog, ljm_backlog)
+
+                self.ring.write(scans)
+        except Exception as e:
+            self.error = e
+            print('AIN acquisition stopped: {}'.format(e))
+
+    def _write_loop(self):
+        while True:
+            stopping = self.stop_event.wait(timeout=self.flush_interval)
+            # Drain only what the reader has finished writing once it has stopped
+            if stopping and self.reader.is_alive():
+                self.reader.join()
+            chunk = self.ring.read()
+            if chunk.shape[0] > 0 and self.sink is not None:
+                try:
+                    self.sink(chunk)
+                    self.n_scans_written += chunk.shape[0]
+                except Exception as e:
+                    self.error = e
+                    print('AIN acquisition could not write data: {}'.format(e))
+            if stopping:
+                return
@@ -4,59 +4,209 @@
 from visprotocol.device import daq
 from flyrpc.multicall import MyMultiCall
 
-from labjack import ljm
+from lab_package.lazy_import import lazy_import
+from lab_package.device.scheduler import DeviceScheduler, ChannelConflictError, chain_future
+from lab_package.device.acquisition import AinAcquisition, H5FileSink
 import numpy as np
 import time
-import threading
+import hashlib
+from functools import lru_cache, partial
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+# LJM is only needed once a LabJack is opened, so that this module also loads on machines without it
+ljm = lazy_import('labjack.ljm')
+
+DIO_EF_CORE_CLOCK = 80e6  # (Hz) DIO extended feature core clock on T4 and T7
+DIO_EF_CLOCK_DIVISORS = [1, 2, 4, 8, 16, 32, 64, 256]
+DIO_EF_PULSE_OUT_INDEX = 2
+DIO_PREFIX_OFFSETS = {'DIO': 0, 'FIO': 0, 'EIO': 8, 'CIO': 16, 'MIO': 20}
+STREAM_OUT_BUFFER_BYTES = 16384  # largest stream out buffer on T4 and T7
+STREAM_OUT_MAX_SAMPLES = STREAM_OUT_BUFFER_BYTES // 2  # 2 bytes per sample
+BUFFERED_STEP_MAX_SCAN_RATE = 5000  # (Hz)
+
+def get_dio_name(channel):
+    """
+    Convert a digital line name (e.g. 'FIO4', 'EIO0') to its DIO# name (e.g. 'DIO4', 'DIO8').
+    """
+    prefix, number = channel[:3], channel[3:]
+    if prefix not in DIO_PREFIX_OFFSETS or not number.isdigit():
+        raise ValueError('Not a digital I/O line: {}'.format(channel))
+    return 'DIO{}'.format(DIO_PREFIX_OFFSETS[prefix] + int(number))
+
+@lru_cache(maxsize=64)
+def get_pulse_waveform(scanRate, freq, amp, pulse_width):
+    """
+    One period of a pulse wave sampled at scanRate, cached for repeated calls with the same parameters.
+    The returned array is read-only.
+    """
+    waveform = np.zeros(int(scanRate/freq))
+    waveform[0:int(scanRate*pulse_width)] = amp
+    waveform.flags.writeable = False
+    return waveform
+
+def hash_waveform(waveform):
+    return hashlib.sha1(np.ascontiguousarray(waveform, dtype=np.float64).tobytes()).hexdigest()
+
+def check_stream_out_waveform(waveform):
+    if len(waveform) > STREAM_OUT_MAX_SAMPLES:
+        raise ValueError('Waveform of {} samples does not fit in the stream out buffer ({} samples). '
+                         'Lower scanRate or shorten the waveform'.format(len(waveform), STREAM_OUT_MAX_SAMPLES))
 
 # %%
 class DAQonServer(daq.DAQonServer):
     '''
     Dummy DAQ class for when the DAQ resides on the server, so that we can call methods as if the DAQ is on the client side.
     Assumes that server has registered functions "daq_sendTrigger" and "daq_outputStep".
+
+    Stream commands can be batched: between begin_batch() and flush() (or inside a "with daq.batch():" block),
+    commands are buffered instead of sent, then flushed in one multicall, or added to a caller's multicall
+    so that they go out together with the stimulus load.
+    Round trips are counted in round_trips, see get_round_trip_stats().
     '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)  # call the parent class init method
+        self.command_buffer = None
+        self.reset_round_trip_stats()
+
     def setup_pulse_wave_stream_out(self, multicall=None, **kwargs):
-        if multicall is not None and isinstance(multicall, MyMultiCall):
-            multicall.daq_setup_pulse_wave_streamOut(**kwargs)
-            return multicall
-        if self.manager is not None:
-            self.manager.daq_setup_pulse_wave_streamOut(**kwargs)
+        return self._send('daq_setup_pulse_wave_streamOut', multicall=multicall, **kwargs)
 
     def start_stream(self, multicall=None, **kwargs):
-        if multicall is not None and isinstance(multicall, MyMultiCall):
-            multicall.daq_start_stream(**kwargs)
-            return multicall
-        if self.manager is not None:
-            self.manager.daq_start_stream(**kwargs)
+        return self._send('daq_start_stream', multicall=multicall, **kwargs)
 
     def stop_stream(self, multicall=None, **kwargs):
+        return self._send('daq_stop_stream', multicall=multicall, **kwargs)
+
+    def stream_with_timing(self, multicall=None, **kwargs):
+        return self._send('daq_stream_with_timing', multicall=multicall, **kwargs)
+
+    def start_ain_acquisition(self, filepath, multicall=None, **kwargs):
+        """
+        Start acquisition on the server, into an HDF5 file at filepath on the server's disk.
+        Link it into the epoch run with Data.link_acquisition_file.
+        """
+        return self._send('daq_start_ain_acquisition', multicall=multicall, filepath=filepath, **kwargs)
+
+    def stop_ain_acquisition(self, multicall=None, **kwargs):
+        return self._send('daq_stop_ain_acquisition', multicall=multicall, **kwargs)
+
+    def _send(self, function_name, multicall=None, **kwargs):
         if multicall is not None and isinstance(multicall, MyMultiCall):
-            multicall.daq_stop_stream(**kwargs)
+            getattr(multicall, function_name)(**kwargs)
+            self.commands_sent += 1
+            self.round_trips_saved += 1
             return multicall
+        if self.command_buffer is not None:
+            self.command_buffer.append((function_name, kwargs))
+            return None
         if self.manager is not None:
-            self.manager.daq_stop_stream(**kwargs)
+            t0 = time.perf_counter()
+            getattr(self.manager, function_name)(**kwargs)
+            self.round_trip_time += time.perf_counter() - t0
+            self.round_trips += 1
+            self.commands_sent += 1
+
+    def begin_batch(self):
+        """
+        Start buffering DAQ commands instead of sending them.
+        """
+        if self.command_buffer is None:
+            self.command_buffer = []
+
+    def flush(self, multicall=None):
+        """
+        Send buffered DAQ commands and stop buffering.
+
+        multicall: MyMultiCall to add the commands to, e.g. the one carrying the stimulus load, which the caller then sends.
+                   If None, the commands are sent now in one multicall of their own.
+        returns: the multicall the commands were added to, or None if there was nothing to send
+        """
+        commands = self.command_buffer or []
+        self.command_buffer = None
+        if len(commands) == 0:
+            return multicall
 
-    def stream_with_timing(self, multicall=None, **kwargs):
         if multicall is not None and isinstance(multicall, MyMultiCall):
-            multicall.daq_stream_with_timing(**kwargs)
+            for function_name, kwargs in commands:
+                getattr(multicall, function_name)(**kwargs)
+            self.commands_sent += len(commands)
+            self.round_trips_saved += len(commands)
             return multicall
-        if self.manager is not None:
-            self.manager.daq_stream_with_timing(**kwargs)
+
+        if self.manager is None:
+            return None
+        multicall = MyMultiCall(self.manager)
+        for function_name, kwargs in commands:
+            getattr(multicall, function_name)(**kwargs)
+        t0 = time.perf_counter()
+        multicall()
+        self.round_trip_time += time.perf_counter() - t0
+        self.round_trips += 1
+        self.commands_sent += len(commands)
+        self.round_trips_saved += len(commands) - 1
+        return multicall
+
+    @contextmanager
+    def batch(self, multicall=None):
+        """
+        Context manager that buffers DAQ commands and flushes them on exit (see flush).
+        Commands are dropped if the block raises.
+        """
+        self.begin_batch()
+        try:
+            yield self
+        except BaseException:
+            self.command_buffer = None
+            raise
+        self.flush(multicall=multicall)
+
+    def reset_round_trip_stats(self):
+        self.round_trips = 0
+        self.round_trips_saved = 0
+        self.commands_sent = 0
+        self.round_trip_time = 0.0
+
+    def get_round_trip_stats(self):
+        """
+        returns: dict with the number of DAQ round trips made, round trips saved by batching, commands sent,
+                 mean measured round trip latency (sec) and the latency saved by batching (sec), estimated from that mean
+        """
+        mean_latency = self.round_trip_time / self.round_trips if self.round_trips > 0 else None
+        return {'round_trips': self.round_trips,
+                'round_trips_saved': self.round_trips_saved,
+                'commands_sent': self.commands_sent,
+                'mean_round_trip_latency': mean_latency,
+                'latency_saved': None if mean_latency is None else mean_latency * self.round_trips_saved}
 
 # %% LabJack
 
 class LabJackTSeries(daq.DAQ):
-    def __init__(self, dev=None, trigger_channel=['FIO4'], init_device=True):
+    def __init__(self, dev=None, trigger_channel=['FIO4'], init_device=True, hardware_timed_triggers=False):
         super().__init__()  # call the parent class init method
         self.serial_number = dev
         self.trigger_channel = trigger_channel
+        self.hardware_timed_triggers = hardware_timed_triggers
+
+        self.hardware_pulse_config = None
+        self.stream_futures = None
+        self.stream_setup_future = None
+        self.ain_acquisition = None
+        self.ain_reservation = None
 
-        self.stream_thread = None
+        # Waveform currently loaded in each stream out buffer: streamOutIndex -> (target address, scanRate, waveform hash)
+        self.stream_out_buffers = {}
+        self.stream_out_uploads = 0
+        self.stream_out_uploads_skipped = 0
+
+        # Runs all timed device jobs (stream start/stop, triggers, DAC writes) from one worker thread
+        self.scheduler = DeviceScheduler(name='labjack_scheduler')
 
         self.init_device()
 
     def init_device(self):
         # Initialize ljm T4/T7 handle
+        self.invalidate_stream_out_buffers()
         self.handle = ljm.openS("TSERIES", "ANY", "ANY" if self.serial_number is None else self.serial_number)
         self.info = ljm.getHandleInfo(self.handle)
         self.deviceType = self.info[0]
@@ -100,15 +250,27 @@ class LabJackTSeries(daq.DAQ):
     def write(self, names, vals):
         ljm.eWriteNames(self.handle, len(names), names, vals)
 
-    def send_trigger(self, trigger_channel=None, trigger_duration=0.05):
+    def send_trigger(self, trigger_channel=None, trigger_duration=0.05, hardware_timed=None):
         if trigger_channel is None:
             trigger_channel = self.trigger_channel
-        self.output_step(output_channel=trigger_channel, low_time=0, high_time=trigger_duration, initial_delay=0)
+        self.output_step(output_channel=trigger_channel, low_time=0, high_time=trigger_duration, initial_delay=0, hardware_timed=hardware_timed)
+
+    def output_step(self, output_channel=['FIO4'], low_time=0.001, high_time=0.100, initial_delay=0.00, hardware_timed=None):
+        """
+        Output a digital step: low for low_time, then high for high_time, then low.
 
-    def output_step(self, output_channel=['FIO4'], low_time=0.001, high_time=0.100, initial_delay=0.00):
+        hardware_timed: (bool) if True, the step is generated by the device (see output_hardware_timed_pulse)
+                        and this call returns immediately. Defaults to self.hardware_timed_triggers.
+        """
         if not isinstance(output_channel, list):
             output_channel = [output_channel]
 
+        if hardware_timed is None:
+            hardware_timed = self.hardware_timed_triggers
+        if hardware_timed:
+            self.output_hardware_timed_pulse(output_channel=output_channel, pulse_width=high_time, initial_delay=initial_delay+low_time)
+            return
+
         write_states = np.ones(len(output_channel), dtype=int)
         if initial_delay > 0:
             time.sleep(initial_delay)
@@ -120,7 +282,68 @@ class LabJackTSeries(daq.DAQ):
             time.sleep(high_time)
         self.write(output_channel, (write_states*0).tolist())
 
-    def analog_output_step(self, output_channel='DAC0', pre_time=0.5, step_time=1, tail_time=0.5, step_amp=0.5, dt=0.01):
+    def setup_hardware_timed_pulse(self, output_channel=['FIO4'], pulse_width=0.05, initial_delay=0.0):
+        """
+        Configure DIO extended feature Pulse Out on the output lines, so that a pulse can later be fired with one command.
+        Pulse Out is only available on some lines (T7: FIO0, FIO2-FIO5. T4: FIO6, FIO7).
+
+        output_channel: (list of str) digital output lines
+        pulse_width: (sec) high time of the pulse
+        initial_delay: (sec) time from firing until the line goes high
+        """
+        if not isinstance(output_channel, list):
+            output_channel = [output_channel]
+
+        # Use the smallest clock divisor, i.e. finest resolution, whose 32 bit roll value fits the whole pulse
+        period = initial_delay + pulse_width
+        for divisor in DIO_EF_CLOCK_DIVISORS:
+            tick = divisor / DIO_EF_CORE_CLOCK
+            if (period / tick) + 2 < 2**32:
+                break
+        else:
+            raise ValueError('Pulse of {} sec is too long for hardware timing'.format(period))
+        high_tick = int(round(initial_delay / tick))
+        low_tick = high_tick + max(int(round(pulse_width / tick)), 1)
+
+        names = ['DIO_EF_CLOCK0_ENABLE', 'DIO_EF_CLOCK0_DIVISOR', 'DIO_EF_CLOCK0_ROLL_VALUE', 'DIO_EF_CLOCK0_ENABLE']
+        values = [0, divisor, low_tick + 1, 1]
+        for channel in output_channel:
+            dio = get_dio_name(channel)
+            names += [dio + '_EF_ENABLE', dio + '_EF_INDEX', dio + '_EF_OPTIONS',
+                      dio + '_EF_CONFIG_A', dio + '_EF_CONFIG_B', dio + '_EF_CONFIG_C']
+            # Pulse Out: the line goes low at CONFIG_A and high at CONFIG_B clock ticks
+            values += [0, DIO_EF_PULSE_OUT_INDEX, 0, low_tick, high_tick, 1]
+        self.write(names, values)
+
+        self.hardware_pulse_config = (tuple(output_channel), pulse_width, initial_delay)
+
+    def output_hardware_timed_pulse(self, output_channel=['FIO4'], pulse_width=0.05, initial_delay=0.0):
+        """
+        Fire a hardware-timed pulse on all output lines with a single command and return immediately.
+        The pulse is timed by the device clock, so its width does not depend on OS scheduling.
+        The device is only reconfigured if the lines, width or delay changed since the last pulse.
+        """
+        if not isinstance(output_channel, list):
+            output_channel = [output_channel]
+
+        if self.hardware_pulse_config != (tuple(output_channel), pulse_width, initial_delay):
+            self.setup_hardware_timed_pulse(output_channel=output_channel, pulse_width=pulse_width, initial_delay=initial_delay)
+
+        # Disabling then enabling Pulse Out restarts it
+        names = []
+        for channel in output_channel:
+            dio = get_dio_name(channel)
+            names += [dio + '_EF_ENABLE', dio + '_EF_ENABLE']
+        self.write(names, [0, 1] * len(output_channel))
+
+    def disable_hardware_timed_pulse(self):
+        if self.hardware_pulse_config is None:
+            return
+        names = [get_dio_name(channel) + '_EF_ENABLE' for channel in self.hardware_pulse_config[0]]
+        self.write(names, [0] * len(names))
+        self.hardware_pulse_config = None
+
+    def analog_output_step(self, output_channel='DAC0', pre_time=0.5, step_time=1, tail_time=0.5, step_amp=0.5, dt=0.01, buffered=False, scanRate=None, scansPerRead=1000):
         """
         Generate a voltage step with defined amplitude
             Step comes on at pre_time and goes off at pre_time+step_time
@@ -131,8 +354,15 @@ class LabJackTSeries(daq.DAQ):
         tail_time: (sec) duration after step (v=0)
         step_amp: (V) amplitude of output step
         dt: (sec) time step size used to generate waveform
+        buffered: (bool) if True, play the step as a stream-out waveform (see buffered_analog_output_step)
+                  and return a completion future instead of blocking
+        scanRate: (Hz) sampling rate of the waveform in buffered mode, see buffered_analog_output_step
+        scansPerRead: (int) number of samples to read at a time in buffered mode
 
         """
+        if buffered:
+            return self.buffered_analog_output_step(output_channel=output_channel, pre_time=pre_time, step_time=step_time, tail_time=tail_time,
+                                                    step_amp=step_amp, scanRate=scanRate, scansPerRead=scansPerRead)
 
         total_time = pre_time + step_time + tail_time
         t0 = time.time()
@@ -150,18 +380,81 @@ class LabJackTSeries(daq.DAQ):
             ljm.eWriteName(self.handle, output_channel, value)
             time.sleep(dt)
 
+    def buffered_analog_output_step(self, output_channel='DAC0', pre_time=0.5, step_time=1, tail_time=0.5, step_amp=0.5, scanRate=None, scansPerRead=1000, min_guard_time=0.1):
+        """
+        Generate a voltage step with defined amplitude, sampled at scanRate and played once through stream out.
+            Step edges are placed by the device clock, and nothing is sent over USB per sample.
+            Returns immediately with a concurrent.futures.Future that resolves once the stream has been stopped.
+
+        output_channel: (str) name of analog output channel on device
+        pre_time: (sec) time duration before the step comes on (v=0)
+        step_time: (sec) duration that step is on
+        tail_time: (sec) duration after step (v=0)
+        step_amp: (V) amplitude of output step
+        scanRate: (Hz) sampling rate of waveform. If None, the highest rate up to BUFFERED_STEP_MAX_SCAN_RATE
+                  at which the whole waveform fits in the stream out buffer (STREAM_OUT_MAX_SAMPLES)
+        scansPerRead: (int) number of samples to read at a time
+        min_guard_time: (sec) minimum duration of zeros after the step
+
+        Stream out repeats its buffer, so the stream is stopped halfway through the trailing zeros.
+        Any lateness in stopping up to half of that time still leaves the output at 0 V.
+        """
+        guard_time = max(tail_time, min_guard_time)
+        if scanRate is None:
+            scanRate = float(min(BUFFERED_STEP_MAX_SCAN_RATE, np.floor(STREAM_OUT_MAX_SAMPLES / (pre_time + step_time + guard_time))))
+        waveform = np.zeros(int(round((pre_time + step_time + guard_time) * scanRate)))
+        waveform[int(round(pre_time * scanRate)):int(round((pre_time + step_time) * scanRate))] = step_amp
+
+        # Uploaded by the scheduler job ahead of the stream start, once the stream is known not to overlap another one
+        check_stream_out_waveform(waveform)
+        start_time = self.scheduler.now()
+        return self.schedule_stream(start_time=start_time, stop_time=start_time + pre_time + step_time + guard_time / 2,
+                                    scanListNames=["STREAM_OUT0"], scanRate=scanRate, scansPerRead=scansPerRead, output_channel=output_channel,
+                                    setup=partial(self.setup_stream_output, output_channel=output_channel, waveform=waveform, scanRate=scanRate))
+
     def set_analog_output_to_zero(self, output_channel='DAC0'):
         ljm.eWriteName(self.handle, output_channel, 0)
 
-    def setup_periodic_stream_out(self, output_channel='DAC0', waveform=[0], streamOutIndex=0, scanRate=5000):
+    def setup_periodic_stream_out(self, output_channel='DAC0', waveform=[0], streamOutIndex=0, scanRate=5000, force_upload=False):
         """
         Setup periodic stream out for a defined waveform
+            The waveform is only uploaded to the device if it differs from the one already in the stream out buffer.
+            It is recorded as loaded only once periodicStreamOut has returned. While a stream may be playing,
+            call this from the device scheduler (see schedule_stream) rather than directly.
 
         output_channel: (str) name of analog output channel on device
-        waveform: (V) waveform to output repeatedly
+        waveform: (V) waveform to output repeatedly, at most STREAM_OUT_MAX_SAMPLES long
         scanRate: (Hz) sampling rate of waveform
+        force_upload: (bool) upload even if the same waveform is already loaded
+        """
+        check_stream_out_waveform(waveform)
+        target_address = ljm.nameToAddress(output_channel)[0]
+        buffer_key = (target_address, scanRate, hash_waveform(waveform))
+        if not force_upload and self.stream_out_buffers.get(streamOutIndex) == buffer_key:
+            self.stream_out_uploads_skipped += 1
+            return
+
+        # Forget the old contents first, in case the upload fails partway
+        self.stream_out_buffers.pop(streamOutIndex, None)
+        ljm.periodicStreamOut(self.handle, streamOutIndex, target_address, scanRate, len(waveform), waveform)
+        self.stream_out_buffers[streamOutIndex] = buffer_key
+        self.stream_out_uploads += 1
+
+    def setup_stream_output(self, output_channel='DAC0', waveform=[0], scanRate=5000):
+        """
+        Upload waveform for the next stream, and zero output_channel when it is stopped. Run by the device scheduler (see schedule_stream).
+        """
+        self.stream_output_channel = output_channel
+        self.setup_periodic_stream_out(output_channel=output_channel, waveform=waveform, scanRate=scanRate)
+
+    def invalidate_stream_out_buffers(self, streamOutIndex=None):
+        """
+        Forget which waveforms are loaded, so the next setup re-uploads. E.g. after the device was reset externally.
         """
-        ljm.periodicStreamOut(self.handle, streamOutIndex, ljm.nameToAddress(output_channel)[0], scanRate, len(waveform), waveform)
+        if streamOutIndex is None:
+            self.stream_out_buffers = {}
+        else:
+            self.stream_out_buffers.pop(streamOutIndex, None)
 
     def setup_pulse_wave_stream_out(self, output_channel='DAC0', freq=1, amp=2.5, pulse_width=0.1, streamOutIndex=0, scanRate=5000):
         """
@@ -176,9 +469,8 @@ class LabJackTSeries(daq.DAQ):
         """
 
         self.stream_output_channel = output_channel
-        waveform = np.zeros(int(scanRate/freq))
-        waveform[0:int(scanRate*pulse_width)] = amp
-        self.setup_periodic_stream_out(output_channel=output_channel, waveform=waveform, scanRate=scanRate)
+        waveform = get_pulse_waveform(scanRate, freq, amp, pulse_width)
+        self.setup_periodic_stream_out(output_channel=output_channel, waveform=waveform, streamOutIndex=streamOutIndex, scanRate=scanRate)
 
     def start_stream(self, scanListNames=["STREAM_OUT0"], scanRate=5000, scansPerRead=1000):
         scanList = ljm.namesToAddresses(len(scanListNames), scanListNames)[0]
@@ -188,16 +480,98 @@ class LabJackTSeries(daq.DAQ):
         ljm.eStreamStop(self.handle)
         ljm.eWriteName(self.handle, self.stream_output_channel, 0)
 
+    def schedule_stream(self, start_time, stop_time, scanListNames=["STREAM_OUT0"], scanRate=5000, scansPerRead=1000, output_channel=None, setup=None):
+        """
+        Queue a stream start and stop at absolute times on the device scheduler's clock (self.scheduler.now()).
+            The stream, and output_channel if given, are reserved from start_time to stop_time,
+            and a stream overlapping another scheduled stream raises scheduler.ChannelConflictError.
+
+        setup: optional callable run on the scheduler thread right away, e.g. to upload the stream out waveform.
+               The channels are then reserved from now on, so nothing is written to the device if the stream
+               conflicts with another one, and the stream is not started if setup raises
+        returns: Future that resolves once the stream has been stopped, or with the exception raised
+                 by the setup, stream start or stop. Use cancel_stream() to cancel.
+        """
+        channels = ['STREAM'] if output_channel is None else ['STREAM', output_channel]
+        setup_time = min(self.scheduler.now(), start_time) if setup is not None else start_time
+        conflicts = self.scheduler.get_conflicts(channels, setup_time, stop_time)
+        if conflicts:
+            raise ChannelConflictError('Stream on {} overlaps job {} on {}'.format(sorted(channels), conflicts[0].name, sorted(conflicts[0].channels)))
+
+        setup_future = None
+        start_stream = self.start_stream
+        if setup is not None:
+            setup_future = self.scheduler.submit_at(setup_time, setup, channels=channels, until=start_time, name='stream setup')
+
+            def start_stream(**kwargs):
+                # Runs after the setup job, which is queued first: don't start on a failed or cancelled setup
+                setup_future.result(timeout=0)
+                self.start_stream(**kwargs)
+        try:
+            start_future = self.scheduler.submit_at(start_time, start_stream, scanListNames=scanListNames, scanRate=scanRate, scansPerRead=scansPerRead,
+                                                    channels=channels, until=stop_time, name='stream')
+        except Exception:
+            if setup_future is not None:
+                setup_future.cancel()
+            raise
+        stop_future = self.scheduler.submit_at(stop_time, self.stop_stream)
+        stream_future = Future()
+
+        def start_done_helper(future):
+            # Don't stop a stream that never started, and pass on why it didn't
+            if future.cancelled():
+                stream_future.cancel()
+                stop_future.cancel()
+            elif future.exception() is not None:
+                stream_future.set_exception(future.exception())
+                stop_future.cancel()
+        start_future.add_done_callback(start_done_helper)
+        chain_future(stop_future, stream_future)
+
+        self.stream_futures = (start_future, stop_future, stream_future)
+        self.stream_setup_future = setup_future
+        return stream_future
+
+    def cancel_stream(self):
+        """
+        Cancel the last scheduled stream. If it is already running, it is stopped right away.
+        """
+        if self.stream_futures is None:
+            return
+        start_future, stop_future, stream_future = self.stream_futures
+        if start_future.cancel():
+            stop_future.cancel()
+            if self.stream_setup_future is not None:
+                self.stream_setup_future.cancel()
+        elif stop_future.cancel():
+            early_stop_future = self.scheduler.submit(self.stop_stream)
+            # The channels are free once stopped, rather than at the planned stop time
+            early_stop_future.add_done_callback(lambda future: self.scheduler.release(start_future))
+            chain_future(early_stop_future, stream_future)
+
     def stream_with_timing(self, scanListNames=["STREAM_OUT0"], scanRate=5000, scansPerRead=1000, pre_time=0.5, stim_time=1):
-        def timing_helper():
-            time.sleep(pre_time)
-            self.start_stream(scanListNames=scanListNames, scanRate=scanRate, scansPerRead=scansPerRead)
-            time.sleep(stim_time)
-            self.stop_stream()
-        self.stream_thread = threading.Thread(target=timing_helper, daemon=True)
-        self.stream_thread.start()
+        """
+        Start the stream after pre_time and stop it stim_time later, without blocking.
+
+        returns: Future that resolves once the stream has been stopped
+        """
+        start_time = self.scheduler.now() + pre_time
+        return self.schedule_stream(start_time=start_time, stop_time=start_time + stim_time,
+                                    scanListNames=scanListNames, scanRate=scanRate, scansPerRead=scansPerRead)
+
+    def send_trigger_at(self, deadline, **kwargs):
+        """
+        Queue send_trigger(**kwargs) at an absolute time on the scheduler clock. Returns a Future.
+        """
+        return self.scheduler.submit_at(deadline, self.send_trigger, **kwargs)
+
+    def set_analog_output_at(self, deadline, output_channel='DAC0', value=0):
+        """
+        Queue a DAC write at an absolute time on the scheduler clock. Returns a Future.
+        """
+        return self.scheduler.submit_at(deadline, ljm.eWriteName, self.handle, output_channel, value, channels=[output_channel], name='dac')
 
-    def analog_periodic_output(self, output_channel='DAC0', pre_time=0.5, stim_time=1, waveform=[0], scanRate=5000, scansPerRead = 1000):
+    def analog_periodic_output(self, output_channel='DAC0', pre_time=0.5, stim_time=1, waveform=[0], scanRate=5000, scansPerRead = 1000, blocking=True):
         """
         Repeat waveform for a defined duration.
             stim comes on at pre_time and goes off at pre_time+stim_time
@@ -208,16 +582,20 @@ class LabJackTSeries(daq.DAQ):
         waveform: (V) waveform to output repeatedly
         scanRate: (Hz) sampling rate of waveform
         scansPerRead: (int) number of samples to read at a time
+        blocking: (bool) if False, return a Future right away instead of waiting until the stim is off
+            The waveform is uploaded by the device scheduler, once the stream is known not to overlap another one
         """
 
-        self.setup_periodic_stream_out(output_channel=output_channel, waveform=waveform, scanRate=scanRate)
-        time.sleep(pre_time)
-        actualScanRate = ljm.eStreamStart(self.handle, scansPerRead, 1, [ljm.nameToAddress("STREAM_OUT0")[0]], scanRate)
-        time.sleep(stim_time)
-        ljm.eStreamStop(self.handle)
-        ljm.eWriteName(self.handle, output_channel, 0)
+        check_stream_out_waveform(waveform)
+        start_time = self.scheduler.now() + pre_time
+        completion = self.schedule_stream(start_time=start_time, stop_time=start_time + stim_time,
+                                          scanListNames=["STREAM_OUT0"], scanRate=scanRate, scansPerRead=scansPerRead, output_channel=output_channel,
+                                          setup=partial(self.setup_stream_output, output_channel=output_channel, waveform=waveform, scanRate=scanRate))
+        if blocking:
+            completion.result()
+        return completion
 
-    def square_wave(self, output_channel='DAC0', pre_time=0.5, stim_time=1, freq=1, amp=2.5, scanRate=5000, scansPerRead = 1000):
+    def square_wave(self, output_channel='DAC0', pre_time=0.5, stim_time=1, freq=1, amp=2.5, scanRate=5000, scansPerRead = 1000, blocking=True):
         """
         Generate a square wave with defined frequency and amplitude
             stim comes on at pre_time and goes off at pre_time+stim_time
@@ -229,11 +607,12 @@ class LabJackTSeries(daq.DAQ):
         amp: (V) amplitude of output square wave
         scanRate: (Hz) sampling rate of waveform
         scansPerRead: (int) number of samples to read at a time
+        blocking: (bool) if False, return a Future right away instead of waiting until the stim is off
         """
 
-        self.pulse_wave(output_channel=output_channel, pre_time=pre_time, stim_time=stim_time, pulse_width=0.5/freq, freq=freq, amp=amp, scanRate=scanRate, scansPerRead=scansPerRead)
+        return self.pulse_wave(output_channel=output_channel, pre_time=pre_time, stim_time=stim_time, pulse_width=0.5/freq, freq=freq, amp=amp, scanRate=scanRate, scansPerRead=scansPerRead, blocking=blocking)
 
-    def pulse_wave(self, output_channel='DAC0', pre_time=0.5, stim_time=1, freq=1, amp=2.5, pulse_width=0.1, scanRate=5000, scansPerRead = 1000):
+    def pulse_wave(self, output_channel='DAC0', pre_time=0.5, stim_time=1, freq=1, amp=2.5, pulse_width=0.1, scanRate=5000, scansPerRead = 1000, blocking=True):
         """
         Generate a square wave with defined frequency and amplitude
             stim comes on at pre_time and goes off at pre_time+stim_time
@@ -246,13 +625,84 @@ class LabJackTSeries(daq.DAQ):
         pulse_width: (sec) duration of pulse
         scanRate: (Hz) sampling rate of waveform
         scansPerRead: (int) number of samples to read at a time
+        blocking: (bool) if False, return a Future right away instead of waiting until the stim is off
+        """
+
+        waveform = get_pulse_waveform(scanRate, freq, amp, pulse_width)
+        return self.analog_periodic_output(output_channel=output_channel, pre_time=pre_time, stim_time=stim_time, waveform=waveform, scanRate=scanRate, scansPerRead=scansPerRead, blocking=blocking)
+
+    def start_ain_acquisition(self, channels=['AIN0'], scanRate=10000, scansPerRead=1000, sink=None, ring_seconds=10.0, flush_interval=0.5, stream_out_names=[], filepath=None):
+        """
+        Start continuous analog input acquisition.
+            A reader thread calls eStreamRead into a ring buffer, and a writer thread passes chunks of
+            (n_scans, n_channels) samples to sink, e.g. Data.get_acquisition_sink(...) in the process that holds Data,
+            or with filepath, to dataset 'ain' of an HDF5 file written by this process (see acquisition.H5FileSink).
+            The stream is reserved on the scheduler until stop_ain_acquisition, so timed streams cannot overlap it.
+
+        channels: (list of str) analog input channels to record, e.g. ['AIN0', 'AIN1']
+        scanRate: (Hz) scans per second (all channels are sampled once per scan)
+        scansPerRead: (int) number of scans returned per eStreamRead
+        sink: callable taking each chunk of scans, or None
+        ring_seconds: (sec) ring buffer capacity
+        flush_interval: (sec) how often chunks are passed to sink
+        stream_out_names: (list of str) stream out channels (e.g. ['STREAM_OUT0']) to run in the same stream
+        filepath: HDF5 file to append the samples to when sink is None, e.g. when the DAQ is on the server
+        returns: AinAcquisition, with counters available from get_counters()
+        """
+        if self.ain_acquisition is not None and self.ain_acquisition.is_running():
+            raise ChannelConflictError('AIN acquisition is already running')
+        now = self.scheduler.now()
+        conflicts = self.scheduler.get_conflicts(['STREAM'], now, float('inf'))
+        if conflicts:
+            raise ChannelConflictError('Cannot start AIN acquisition while a stream is scheduled until {:.3f} sec from now'.format(conflicts[0].end - now))
+
+        scanListNames = list(stream_out_names) + list(channels)
+        scanList = ljm.namesToAddresses(len(scanListNames), scanListNames)[0]
+        actualScanRate = ljm.eStreamStart(self.handle, scansPerRead, len(scanList), scanList, scanRate)
+        if sink is None and filepath is not None:
+            sink = H5FileSink(filepath, name='ain', attrs={'channel_names': [str(x) for x in channels],
+                                                           'sample_rate': actualScanRate,
+                                                           'start_time': time.time()})
+
+        # eStreamRead returns stream out channels too, but they carry no data
+        self.ain_acquisition = AinAcquisition(ljm=ljm, handle=self.handle, channel_names=scanListNames, scan_rate=actualScanRate,
+                                              sink=None if sink is None else self._drop_stream_out_columns(sink, len(stream_out_names)),
+                                              ring_seconds=ring_seconds, flush_interval=flush_interval)
+        self.ain_reservation = self.scheduler.submit_at(now, lambda: None, channels=['STREAM'], until=float('inf'), name='ain_acquisition')
+        self.ain_acquisition.start()
+        return self.ain_acquisition
+
+    def stop_ain_acquisition(self, timeout=5):
         """
+        Stop the analog input stream and wait for the remaining data to reach the sink.
 
-        waveform = np.zeros(int(scanRate/freq))
-        waveform[0:int(scanRate*pulse_width)] = amp
-        self.analog_periodic_output(output_channel=output_channel, pre_time=pre_time, stim_time=stim_time, waveform=waveform, scanRate=scanRate, scansPerRead=scansPerRead)
+        returns: dict of acquisition counters
+        """
+        if self.ain_acquisition is None:
+            return None
+        acquisition = self.ain_acquisition
+        acquisition.stop_reading(timeout=timeout)
+        try:
+            ljm.eStreamStop(self.handle)
+        except Exception as e:
+            print('Could not stop AIN stream: {}'.format(e))
+        acquisition.finish(timeout=timeout)
+        self.scheduler.release(self.ain_reservation)
+        self.ain_acquisition = None
+        self.ain_reservation = None
+        return acquisition.get_counters()
+
+    @staticmethod
+    def _drop_stream_out_columns(sink, n_stream_out):
+        if n_stream_out == 0:
+            return sink
+        return lambda chunk: sink(chunk[:, n_stream_out:])
 
     def close(self):
         if self.is_open:
+            self.stop_ain_acquisition()
+            self.cancel_stream()
+            self.scheduler.shutdown()
+            self.disable_hardware_timed_pulse()
             ljm.close(self.handle)
             self.is_open = False
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Simulated stand-in for the labjack.ljm module, for benchmarks and testing without a LabJack attached.
+
+Implements the subset of the LJM API used by lab_package.device.daq. Register writes are logged with
+timestamps, DIO extended-feature pulses are logged with the width the device would produce, and
+streams deliver scans at the requested scan rate from per-channel signal functions.
+
+Usage:
+    from lab_package.device import daq, ljm_sim
+    daq.ljm = ljm_sim.SimulatedLJM()
+    dev = daq.LabJackTSeries()
+"""
+import time
+import threading
+import numpy as np
+
+DIO_EF_CORE_CLOCK = 80e6
+SKIPPED_SCAN_VALUE = -9999.0
+STREAM_OUT_BUFFER_BYTES = 16384  # largest stream out buffer, 2 bytes per sample
+
+
+class LJMError(Exception):
+    def __init__(self, errorCode=0, errorString=''):
+        super().__init__(errorString)
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+
+class Constants():
+    dtANY = 0
+    dtT4 = 4
+    dtT7 = 7
+    ctANY = 0
+    ctUSB = 1
+    FLOAT32 = 3
+    UINT32 = 1
+    UINT16 = 0
+
+
+class SimulatedLJM():
+    """
+    :device_type: Constants.dtT4 or Constants.dtT7
+    :serial_number: serial number reported by getHandleInfo
+    :write_latency: (sec) simulated duration of one eWriteName(s) command
+    :signals: dict mapping AIN channel name -> function of time array (sec) returning voltages.
+              Channels without a signal function read as low-amplitude noise.
+    :skip_probability: probability that a scan delivered by eStreamRead is marked as skipped (-9999.0)
+    """
+    constants = Constants
+    LJMError = LJMError
+
+    def __init__(self, device_type=Constants.dtT7, serial_number=470000000, write_latency=0.0, signals=None, skip_probability=0.0, seed=0):
+        self.device_type = device_type
+        self.serial_number = serial_number
+        self.write_latency = write_latency
+        self.signals = {} if signals is None else signals
+        self.skip_probability = skip_probability
+        self.rng = np.random.default_rng(seed)
+
+        self.registers = {}
+        self.write_log = []  # (time, name, value)
+        self.pulse_log = []  # (channel, start time, width)
+        self.stream_out = {}  # stream out index -> dict(target, scanRate, waveform)
+        self.periodic_stream_out_calls = 0
+
+        self.lock = threading.Lock()
+        self.open_handles = set()
+        self.next_handle = 1
+        self.addresses = {}
+        self.names = {}
+        self.stream = None
+
+    # # # Device handles # # #
+    def openS(self, deviceType='ANY', connectionType='ANY', identifier='ANY'):
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.open_handles.add(handle)
+        return handle
+
+    def getHandleInfo(self, handle):
+        self._check_handle(handle)
+        return (self.device_type, Constants.ctUSB, int(self.serial_number), 0, 0, 64)
+
+    def close(self, handle):
+        self._check_handle(handle)
+        self.open_handles.discard(handle)
+
+    def _check_handle(self, handle):
+        if handle not in self.open_handles:
+            raise LJMError(1224, 'LJME_DEVICE_NOT_OPEN')
+
+    # # # Addresses # # #
+    def nameToAddress(self, name):
+        if name not in self.addresses:
+            address = self._default_address(name)
+            self.addresses[name] = address
+            self.names[address] = name
+        return self.addresses[name], Constants.FLOAT32
+
+    def namesToAddresses(self, numFrames, names, aNumRegs=None):
+        addresses = [self.nameToAddress(name)[0] for name in names[:numFrames]]
+        return addresses, [Constants.FLOAT32] * len(addresses)
+
+    def _default_address(self, name):
+        for prefix, base, step in (('AIN', 0, 2), ('DAC', 1000, 2), ('FIO', 2000, 1), ('EIO', 2008, 1),
+                                   ('CIO', 2016, 1), ('MIO', 2020, 1), ('STREAM_OUT', 4800, 1)):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                return base + step * int(suffix)
+        return 60000 + len(self.addresses)
+
+    # # # Register access # # #
+    def eWriteName(self, handle, name, value):
+        self.eWriteNames(handle, 1, [name], [value])
+
+    def eWriteNames(self, handle, numFrames, aNames, aValues):
+        self._check_handle(handle)
+        if self.write_latency > 0:
+            time.sleep(self.write_latency)
+        t = time.perf_counter()
+        with self.lock:
+            for name, value in zip(aNames[:numFrames], aValues[:numFrames]):
+                self.registers[name] = value
+                self.write_log.append((t, name, value))
+                if name.endswith('_EF_ENABLE') and name.startswith('DIO') and value == 1:
+                    self._fire_dio_ef(name[:-len('_EF_ENABLE')], t)
+
+    def eReadName(self, handle, name):
+        self._check_handle(handle)
+        return self.registers.get(name, 0.0)
+
+    def eReadNames(self, handle, numFrames, aNames):
+        return [self.eReadName(handle, name) for name in aNames[:numFrames]]
+
+    def _fire_dio_ef(self, dio, t):
+        # Pulse out (EF index 2): line goes low (high to low) at CONFIG_A and high (low to high) at CONFIG_B clock ticks,
+        # counted within a clock period of ROLL_VALUE ticks
+        if self.registers.get(dio + '_EF_INDEX') != 2:
+            return
+        divisor = self.registers.get('DIO_EF_CLOCK0_DIVISOR', 1) or 1
+        tick = divisor / DIO_EF_CORE_CLOCK
+        roll_value = self.registers.get('DIO_EF_CLOCK0_ROLL_VALUE', 0) or 2**32
+        config_a = self.registers.get(dio + '_EF_CONFIG_A', 0)
+        config_b = self.registers.get(dio + '_EF_CONFIG_B', 0)
+        for _ in range(int(self.registers.get(dio + '_EF_CONFIG_C', 1))):
+            self.pulse_log.append((dio, t + config_b * tick, ((config_a - config_b) % roll_value) * tick))
+
+    # # # Streaming # # #
+    def periodicStreamOut(self, handle, streamOutIndex, targetAddr, scanRate, numValues, aValues):
+        self._check_handle(handle)
+        self.periodic_stream_out_calls += 1
+        if 2 * numValues > STREAM_OUT_BUFFER_BYTES:
+            raise LJMError(errorString='Stream out buffer of {} bytes is too small for {} values'.format(STREAM_OUT_BUFFER_BYTES, numValues))
+        self.stream_out[streamOutIndex] = {'target': targetAddr,
+                                           'scanRate': scanRate,
+                                           'waveform': np.array(aValues[:numValues], dtype=float)}
+
+    def eStreamStart(self, handle, scansPerRead, numAddresses, aScanList, scanRate):
+        self._check_handle(handle)
+        if self.stream is not None:
+            raise LJMError(2605, 'STREAM_IS_ACTIVE')
+        self.stream = {'t0': time.perf_counter(),
+                       'scansPerRead': int(scansPerRead),
+                       'scanList': [self.names.get(a, str(a)) for a in aScanList[:numAddresses]],
+                       'scanRate': float(scanRate),
+                       'scans_read': 0}
+        return float(scanRate)
+
+    def eStreamRead(self, handle):
+        """
+        Block until scansPerRead scans are available, then return (aData, deviceScanBacklog, ljmScanBacklog).
+        """
+        self._check_handle(handle)
+        stream = self.stream
+        if stream is None:
+            raise LJMError(2620, 'STREAM_NOT_RUNNING')
+        n = stream['scansPerRead']
+        first_scan = stream['scans_read']
+        t_ready = stream['t0'] + (first_scan + n) / stream['scanRate']
+        delay = t_ready - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        stream['scans_read'] += n
+
+        t = (first_scan + np.arange(n)) / stream['scanRate']
+        columns = []
+        for name in stream['scanList']:
+            if name in self.signals:
+                columns.append(np.asarray(self.signals[name](t), dtype=float))
+            else:
+                columns.append(0.001 * self.rng.standard_normal(n))
+        data = np.stack(columns, axis=1) if columns else np.zeros((n, 0))
+        if self.skip_probability > 0:
+            data[self.rng.random(n) < self.skip_probability] = SKIPPED_SCAN_VALUE
+
+        available = int((time.perf_counter() - stream['t0']) * stream['scanRate']) - stream['scans_read']
+        backlog = max(available, 0)
+        return data.reshape(-1).tolist(), backlog, backlog
+
+    def eStreamStop(self, handle):
+        self._check_handle(handle)
+        if self.stream is None:
+            raise LJMError(2620, 'STREAM_NOT_RUNNING')
+        self.stream = None
@@ -0,0 +1,171 @@
+"""
+Closed-loop latency tracing from FicTrac frame to screen update.
+
+Per frame, FtLatencyTracer records the FicTrac timestamp, when the line was received, when it was
+parsed and when the pose was handed to the stimulus manager (set-pose). Frame numbers are checked for
+drops and out-of-order arrival. Latencies are summarized per epoch as percentiles and histograms,
+which can be written into the epoch run group of the data file.
+
+All times are wall-clock seconds (time.time()), so that they can be compared with the FicTrac
+timestamp column, which is in ms since the epoch when FicTrac runs from a live camera.
+"""
+import time
+import numpy as np
+
+LATENCY_DTYPE = np.dtype([('frame_num', np.int64),
+                          ('ft_ts', np.float64),
+                          ('recv_time', np.float64),
+                          ('parse_time', np.float64),
+                          ('set_pose_time', np.float64)])
+
+# name: (start field, end field). ft_ts is converted from ms to sec
+LATENCY_STAGES = {'transport': ('ft_ts', 'recv_time'),
+                  'parse': ('recv_time', 'parse_time'),
+                  'set_pose': ('parse_time', 'set_pose_time'),
+                  'total': ('ft_ts', 'set_pose_time')}
+
+PERCENTILES = (50, 90, 95, 99, 100)
+
+
+class FtLatencyTracer():
+    """
+    :capacity: number of frames kept. An epoch longer than this is summarized over its last capacity frames
+    :hist_bins: histogram bin edges (sec), with an extra overflow bin for larger latencies
+    :ft_ts_scale: factor converting the FicTrac timestamp to sec
+    """
+    def __init__(self, capacity=2**16, hist_bins=np.arange(0, 0.1005, 0.001), ft_ts_scale=1e-3):
+        self.capacity = int(capacity)
+        self.records = np.zeros(self.capacity, dtype=LATENCY_DTYPE)
+        self.hist_bins = np.append(np.asarray(hist_bins, dtype=float), np.inf)
+        self.ft_ts_scale = ft_ts_scale
+
+        self.count = 0  # total frames ever recorded
+        self.last_frame_num = None
+        self.pending_recv_time = None
+        self.n_dropped = 0
+        self.n_out_of_order = 0
+
+        self.epoch_start_count = 0
+        self.epoch_start_dropped = 0
+        self.epoch_start_out_of_order = 0
+        self.epoch_start_time = time.time()
+
+    def mark_received(self, recv_time=None):
+        """
+        Record the socket receive time of the next frame, e.g. right after recv() returns.
+        """
+        self.pending_recv_time = time.time() if recv_time is None else recv_time
+
+    def record_frame(self, frame_num, ft_ts, parse_time=None, recv_time=None):
+        """
+        Record a parsed frame. recv_time defaults to the time given to mark_received, else parse_time.
+        """
+        if parse_time is None:
+            parse_time = time.time()
+        if recv_time is None:
+            recv_time = parse_time if self.pending_recv_time is None else self.pending_recv_time
+        self.pending_recv_time = None
+
+        if self.last_frame_num is not None:
+            if frame_num <= self.last_frame_num:
+                self.n_out_of_order += 1
+            elif frame_num > self.last_frame_num + 1:
+                self.n_dropped += frame_num - self.last_frame_num - 1
+        if self.last_frame_num is None or frame_num > self.last_frame_num:
+            self.last_frame_num = frame_num
+
+        self.records[self.count % self.capacity] = (frame_num, ft_ts * self.ft_ts_scale, recv_time, parse_time, np.nan)
+        self.count += 1
+
+    def mark_set_pose(self, set_pose_time=None):
+        """
+        Record when the most recent frame was handed to the stimulus manager. Only the first call per frame counts.
+        """
+        if self.count == 0:
+            return
+        idx = (self.count - 1) % self.capacity
+        set_pose_times = self.records['set_pose_time']
+        if np.isnan(set_pose_times[idx]):
+            set_pose_times[idx] = time.time() if set_pose_time is None else set_pose_time
+
+    def start_epoch(self):
+        self.epoch_start_count = self.count
+        self.epoch_start_dropped = self.n_dropped
+        self.epoch_start_out_of_order = self.n_out_of_order
+        self.epoch_start_time = time.time()
+
+    def get_epoch_records(self):
+        """
+        Copy of the records since start_epoch (at most capacity), oldest first.
+        """
+        n = min(self.count - self.epoch_start_count, self.capacity)
+        if n <= 0:
+            return np.zeros(0, dtype=LATENCY_DTYPE)
+        start = (self.count - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.records[start:start+n].copy()
+        return np.concatenate([self.records[start:], self.records[:start + n - self.capacity]])
+
+    def get_epoch_summary(self):
+        """
+        Frame counts and, per latency stage, percentiles (sec) and a histogram over the current epoch.
+
+        returns: dict with 'n_frames', 'n_dropped', 'n_out_of_order', 'duration', and for each stage in
+                 LATENCY_STAGES, '<stage>_percentiles' (aligned with PERCENTILES) and '<stage>_histogram'
+        """
+        records = self.get_epoch_records()
+        summary = {'n_frames': self.count - self.epoch_start_count,
+                   'n_dropped': self.n_dropped - self.epoch_start_dropped,
+                   'n_out_of_order': self.n_out_of_order - self.epoch_start_out_of_order,
+                   'duration': time.time() - self.epoch_start_time}
+        for stage, (start_field, end_field) in LATENCY_STAGES.items():
+            latency = records[end_field] - records[start_field]
+            latency = latency[np.isfinite(latency)]
+            if latency.size > 0:
+                summary[stage + '_percentiles'] = np.percentile(latency, PERCENTILES)
+            else:
+                summary[stage + '_percentiles'] = np.full(len(PERCENTILES), np.nan)
+            summary[stage + '_histogram'] = np.histogram(latency, bins=self.hist_bins)[0]
+        return summary
+
+    def write_epoch_summary(self, data, summary=None, name='fictrac_latency', series_number=None):
+        """
+        Append one row per epoch to datasets in the epoch run group of data (lab_package.data.Data):
+            <name>/counts: (n_frames, n_dropped, n_out_of_order, duration)
+            <name>/<stage>_percentiles: latencies (sec) at PERCENTILES
+            <name>/<stage>_histogram: counts per bin of the hist_bins attribute
+        """
+        if summary is None:
+            summary = self.get_epoch_summary()
+        counts = np.array([[summary['n_frames'], summary['n_dropped'], summary['n_out_of_order'], summary['duration']]], dtype=float)
+        data.append_to_epoch_run_dataset(name + '/counts', counts, attrs={'columns': ['n_frames', 'n_dropped', 'n_out_of_order', 'duration']},
+                                         series_number=series_number)
+        for stage in LATENCY_STAGES:
+            data.append_to_epoch_run_dataset('{}/{}_percentiles'.format(name, stage), summary[stage + '_percentiles'][np.newaxis, :],
+                                             attrs={'percentiles': list(PERCENTILES)}, series_number=series_number)
+            data.append_to_epoch_run_dataset('{}/{}_histogram'.format(name, stage), summary[stage + '_histogram'][np.newaxis, :],
+                                             attrs={'hist_bins': self.hist_bins}, series_number=series_number)
+        return summary
+
+
+class FsManagerTimingProxy():
+    """
+    Forwards everything to fs_manager, and marks the set-pose time on tracer after each call to a
+    method whose name starts with one of method_prefixes.
+    """
+    def __init__(self, fs_manager, tracer, method_prefixes=('set_',)):
+        self.fs_manager = fs_manager
+        self.tracer = tracer
+        self.method_prefixes = tuple(method_prefixes)
+
+    def __getattr__(self, name):
+        attr = getattr(self.fs_manager, name)
+        if not (callable(attr) and name.startswith(self.method_prefixes)):
+            return attr
+
+        tracer = self.tracer
+        def timed_call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            tracer.mark_set_pose()
+            return result
+        return timed_call
@@ -3,9 +3,15 @@ import signal
 import os
 import random
 import shutil
+import gzip
 from time import sleep
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
 
 from visprotocol.device.loco_managers import LocoManager, LocoClosedLoopManager
+from lab_package.device.loco_managers.fictrac_parser import FtLineParser
+from lab_package.device.loco_managers.fictrac_latency import FtLatencyTracer, FsManagerTimingProxy
+from lab_package.device.loco_managers.fictrac_predictor import HeadingPredictor
+from lab_package.device.loco_managers.fictrac_recorder import make_file_recorder
 
 FT_FRAME_NUM_IDX = 0
 FT_X_IDX = 14
@@ -17,20 +23,40 @@ FICTRAC_HOST = '127.0.0.1'  # The server's hostname or IP address
 FICTRAC_PORT = 33334         # The port used by the server
 FICTRAC_BIN =    os.path.join(os.path.expanduser("~"), "src/fictrac/bin/fictrac")
 FICTRAC_CONFIG = os.path.join(os.path.expanduser("~"), "src/fictrac/config.txt")
+FICTRAC_FRAMES_FILENAME = 'fictrac_frames.hdf5'
 
 class FtManager(LocoManager):
-    def __init__(self, ft_bin=FICTRAC_BIN, ft_config=FICTRAC_CONFIG, save_directory=None, start_at_init=True):
+    """
+    :finalize_async: if True, close() signals FicTrac and returns a Future right away. Waiting for the
+                     process and moving its files to save_directory happen on a background worker
+    :compress: gzip the FicTrac output files into save_directory instead of moving them
+    :max_retries: number of further passes over files that could not be moved (e.g. still being written)
+    :retry_delay: (sec) delay before the first retry, doubled for each further retry
+    """
+    def __init__(self, ft_bin=FICTRAC_BIN, ft_config=FICTRAC_CONFIG, save_directory=None, start_at_init=True,
+                 finalize_async=False, compress=False, max_retries=5, retry_delay=0.2):
         self.ft_bin = ft_bin
         self.ft_config = ft_config
-        self.cwd = os.path.join(os.path.expanduser("~"), 'fictrac_temp_data', str(random.randint(0, 2**31)))
+        self.cwd = self._new_cwd()
         self.save_directory = save_directory
 
+        self.finalize_async = finalize_async
+        self.compress = compress
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.finalize_executor = None
+        self.finalize_futures = []
+
         self.started = False
         self.p = None
 
         if start_at_init:
             self.start()
 
+    @staticmethod
+    def _new_cwd():
+        return os.path.join(os.path.expanduser("~"), 'fictrac_temp_data', str(random.randint(0, 2**31)))
+
     def set_save_directory(self, save_directory):
         self.save_directory = save_directory
 
@@ -42,39 +68,105 @@ class FtManager(LocoManager):
             self.p = subprocess.Popen([self.ft_bin, self.ft_config, "-v","ERR"], cwd=self.cwd, start_new_session=True)
             self.started = True
 
-    def close(self, timeout=5):
-        if self.started:
-            self.p.send_signal(signal.SIGINT)
-            
+    def close(self, timeout=5, blocking=None):
+        """
+        Stop FicTrac and move (or compress) its output files to save_directory, or delete them if there is none.
+
+        blocking: wait for all of it before returning. Defaults to not finalize_async
+        returns: Future for the list of saved file paths, or None if FicTrac was not started
+        """
+        if not self.started:
+            print("Fictrac hasn't been started yet. Cannot be closed.")
+            return None
+
+        self.p.send_signal(signal.SIGINT)
+        p, cwd, save_directory = self.p, self.cwd, self.save_directory
+        self.p = None
+        self.started = False
+
+        if blocking is None:
+            blocking = not self.finalize_async
+        if blocking:
+            future = Future()
             try:
-                self.p.wait(timeout=timeout)
-            except:
-                print("Timeout expired for closing Fictrac. Killing process...")
-                self.p.kill()
-                self.p.terminate()
-
-            self.p = None
-            self.started = False
-
-            if self.save_directory is None or self.save_directory=="":
-                print("Deleting Fictrac files from preview.")
-                shutil.rmtree(self.cwd)
-            else:
-                print("Moving Fictrac files then deleting.")
-                os.makedirs(self.save_directory, exist_ok=True)
-                while os.listdir(self.cwd):
-                    for fn in os.listdir(self.cwd):
-                        shutil.move(os.path.join(self.cwd, fn), self.save_directory)
-                shutil.rmtree(self.cwd)
+                future.set_result(self._finalize(p, cwd, save_directory, timeout))
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            return future
+
+        # The next run writes into a fresh directory while this one is finalized
+        self.cwd = self._new_cwd()
+        if self.finalize_executor is None:
+            self.finalize_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fictrac_finalize')
+        future = self.finalize_executor.submit(self._finalize, p, cwd, save_directory, timeout)
+        self.finalize_futures = [f for f in self.finalize_futures if not f.done()] + [future]
+        return future
+
+    def wait_for_finalize(self, timeout=None):
+        """
+        Wait for all pending background finalizations. Returns True if all finished.
+        """
+        done, not_done = futures_wait(self.finalize_futures, timeout=timeout)
+        self.finalize_futures = list(not_done)
+        return len(not_done) == 0
+
+    def _finalize(self, p, cwd, save_directory, timeout):
+        try:
+            p.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            print("Timeout expired for closing Fictrac. Killing process...")
+            p.kill()
+            p.wait()
+
+        if save_directory is None or save_directory=="":
+            print("Deleting Fictrac files from preview.")
+            shutil.rmtree(cwd, ignore_errors=True)
+            return []
 
+        print("Moving Fictrac files then deleting.")
+        os.makedirs(save_directory, exist_ok=True)
+        saved_paths = []
+        last_error = None
+        remaining = os.listdir(cwd)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                sleep(self.retry_delay * 2**(attempt - 1))
+            failed = []
+            for fn in remaining:
+                try:
+                    saved_paths.append(self._save_file(os.path.join(cwd, fn), save_directory))
+                except OSError as e:
+                    failed.append(fn)
+                    last_error = e
+            remaining = failed + [fn for fn in os.listdir(cwd) if fn not in failed]
+            if not remaining:
+                break
+
+        if remaining:
+            print("Could not move Fictrac files {} from {}: {}".format(remaining, cwd, last_error or 'files kept appearing'))
         else:
-            print("Fictrac hasn't been started yet. Cannot be closed.")
+            shutil.rmtree(cwd, ignore_errors=True)
+        return saved_paths
+
+    def _save_file(self, src, save_directory):
+        if not self.compress or src.endswith('.gz'):
+            return shutil.move(src, save_directory)
+        dst = os.path.join(save_directory, os.path.basename(src) + '.gz')
+        with open(src, 'rb') as f_in, gzip.open(dst, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(src)
+        return dst
 
     def sleep(self, duration):
         sleep(duration)
 
 class FtClosedLoopManager(LocoClosedLoopManager):
-    def __init__(self, fs_manager, host=FICTRAC_HOST, port=FICTRAC_PORT, save_directory=None, start_at_init=False, udp=True, ft_bin=FICTRAC_BIN, ft_config=FICTRAC_CONFIG, ft_theta_idx=FT_THETA_IDX, ft_x_idx=FT_X_IDX, ft_y_idx=FT_Y_IDX, ft_frame_num_idx=FT_FRAME_NUM_IDX, ft_timestamp_idx=FT_TIMESTAMP_IDX):
+    def __init__(self, fs_manager, host=FICTRAC_HOST, port=FICTRAC_PORT, save_directory=None, start_at_init=False, udp=True, ft_bin=FICTRAC_BIN, ft_config=FICTRAC_CONFIG, ft_theta_idx=FT_THETA_IDX, ft_x_idx=FT_X_IDX, ft_y_idx=FT_Y_IDX, ft_frame_num_idx=FT_FRAME_NUM_IDX, ft_timestamp_idx=FT_TIMESTAMP_IDX, trace_latency=False, predictor=None, ft_finalize_async=False, ft_compress=False, ft_supervisor=None):
+        # Latency tracing: set-pose times are marked by wrapping fs_manager
+        self.latency_tracer = FtLatencyTracer() if trace_latency else None
+        if self.latency_tracer is not None:
+            fs_manager = FsManagerTimingProxy(fs_manager, self.latency_tracer)
         super().__init__(fs_manager=fs_manager, host=host, port=port, save_directory=save_directory, start_at_init=False, udp=udp)
 
         self.ft_frame_num_idx = ft_frame_num_idx
@@ -82,37 +174,166 @@ class FtClosedLoopManager(LocoClosedLoopManager):
         self.ft_theta_idx = ft_theta_idx
         self.ft_x_idx = ft_x_idx
         self.ft_y_idx = ft_y_idx
-        self.ft_manager = FtManager(ft_bin=ft_bin, ft_config=ft_config, save_directory=save_directory, start_at_init=False)
+        self.ft_parser = FtLineParser(theta_idx=ft_theta_idx, x_idx=ft_x_idx, y_idx=ft_y_idx, frame_num_idx=ft_frame_num_idx, timestamp_idx=ft_timestamp_idx)
+        self.ft_frames = self.ft_parser.buffer  # ring buffer of all parsed frames
+        self.ft_manager = FtManager(ft_bin=ft_bin, ft_config=ft_config, save_directory=save_directory, start_at_init=False,
+                                    finalize_async=ft_finalize_async, compress=ft_compress)
+        self.predictor = None
+        self.set_predictor(predictor)
+        self.recorder = None
+        # FtSupervisor keeping a warm FicTrac across runs. If given, FicTrac is not started or stopped with this manager
+        self.ft_supervisor = ft_supervisor
+        if ft_supervisor is not None and save_directory is not None:
+            ft_supervisor.set_save_directory(save_directory)
 
         if start_at_init:    self.start()
 
     def set_save_directory(self, save_directory):
         self.save_directory = save_directory
         self.ft_manager.set_save_directory(save_directory)
+        # With a supervisor, its FtManager runs FicTrac and saves the output files
+        if self.ft_supervisor is not None:
+            self.ft_supervisor.set_save_directory(save_directory)
 
     def start(self):
-        super().start()
-        self.ft_manager.start()
+        if self.ft_supervisor is not None:
+            # The supervisor releases the UDP port to this manager and watches the frames it receives
+            self.ft_supervisor.attach_frames(self.ft_frames)
+            self.ft_supervisor.ensure_running()
+            super().start()
+        else:
+            super().start()
+            self.ft_manager.start()
 
     def close(self):
+        """
+        returns: Future for the saved FicTrac file paths (see FtManager.close), or None with a supervisor
+        """
+        self.stop_recording()
         super().close()
-        self.ft_manager.close()
+        if self.ft_supervisor is not None:
+            self.ft_supervisor.detach_frames()
+            return None
+        return self.ft_manager.close()
+
+    def start_recording(self, filepath=None, name='fictrac', flush_interval=1.0):
+        """
+        Record received frames, in chunks while running, into an HDF5 file on this (the server's) side:
+            <name>/frames: frame_num, ts, theta, x, y, z per frame
+            <name>/epoch_index: epoch frame number ranges, see mark_epoch_start and fictrac_recorder.EPOCH_INDEX_DTYPE
+        The client links them into its epoch run with Data.link_acquisition_file.
+
+        filepath: defaults to FICTRAC_FRAMES_FILENAME in the save directory
+        returns: filepath
+        """
+        if filepath is None:
+            if self.save_directory is None:
+                raise ValueError('Recording FicTrac frames needs a filepath or a save directory')
+            filepath = os.path.join(self.save_directory, FICTRAC_FRAMES_FILENAME)
+        if self.ft_supervisor is not None:
+            self.ft_supervisor.start_recording(filepath, name=name, flush_interval=flush_interval)
+            return filepath
+        if self.recorder is not None:
+            self.stop_recording()
+        self.recorder = make_file_recorder(self.ft_frames, filepath, name=name, flush_interval=flush_interval)
+        self.recorder.start()
+        return filepath
+
+    def stop_recording(self, timeout=5):
+        """
+        Write the remaining frames and stop recording. Returns the recorder counters, or None if not recording.
+        """
+        if self.ft_supervisor is not None:
+            return self.ft_supervisor.stop_recording(timeout=timeout)
+        if self.recorder is None:
+            return None
+        counters = self.recorder.stop(timeout=timeout)
+        self.recorder = None
+        return counters
+
+    def mark_epoch_start(self, epoch_number):
+        """
+        Frames from the next one received on belong to epoch epoch_number, until mark_epoch_end.
+        """
+        if self.ft_supervisor is not None:
+            self.ft_supervisor.mark_epoch_start(epoch_number)
+        elif self.recorder is not None:
+            self.recorder.mark_epoch_start(epoch_number)
+
+    def mark_epoch_end(self):
+        if self.ft_supervisor is not None:
+            self.ft_supervisor.mark_epoch_end()
+        elif self.recorder is not None:
+            self.recorder.mark_epoch_end()
+
+    def set_predictor(self, predictor, vsync_reference=None):
+        """
+        Extrapolate each pose to the next vsync before it is passed on, e.g. per protocol.
+
+        predictor: HeadingPredictor, dict of HeadingPredictor parameters (mode 'none' for no predictor),
+                   or None to pass on the last received pose
+        vsync_reference: vsync time, or callable returning one, for a predictor built from parameters with a refresh_rate
+        """
+        if isinstance(predictor, dict):
+            predictor = HeadingPredictor.from_parameters(predictor, vsync_reference=vsync_reference)
+        self.predictor = predictor
+
+    def get_predictor_parameters(self):
+        """
+        returns: predictor parameters, with mode 'none' if no predictor is set
+        """
+        if self.predictor is None:
+            return {'mode': 'none'}
+        return self.predictor.get_parameters()
+
+    def write_predictor_parameters(self, data):
+        """
+        Log the predictor parameters as attributes (prefixed 'heading_predictor_') on the current epoch run group of data.
+        """
+        attrs = {'heading_predictor_' + key: value for key, value in self.get_predictor_parameters().items()}
+        data.write_epoch_run_attrs(None, attrs)
+
+    def _predict(self, frame_num, ts, theta, x, y):
+        predictor = self.predictor
+        predictor.update(ts, theta, x, y)
+        theta, x, y = predictor.predict()
+        return {'theta': theta, 'x': x, 'y': y, 'z': 0, 'frame_num': frame_num, 'ts': ts}
+
+    def start_latency_epoch(self):
+        if self.latency_tracer is not None:
+            self.latency_tracer.start_epoch()
+
+    def end_latency_epoch(self, data=None):
+        """
+        Summarize closed-loop latency over the epoch, and write it into the current epoch run of data (lab_package.data.Data) if given.
+        returns: summary dict (see FtLatencyTracer.get_epoch_summary), or None if latency tracing is off
+        """
+        if self.latency_tracer is None:
+            return None
+        if data is None:
+            return self.latency_tracer.get_epoch_summary()
+        return self.latency_tracer.write_epoch_summary(data)
 
     def _parse_line(self, line):
-        toks = line.split(", ")
+        # The receive loop hands each line over right after recv(), so entering here stands in for the receive time
+        # unless latency_tracer.mark_received() was called
+        tracer = self.latency_tracer
+        if tracer is not None and tracer.pending_recv_time is None:
+            tracer.mark_received()
+
+        frame = self.ft_parser.parse_line(line)
 
         # Fictrac lines always starts with FT
-        if toks.pop(0) != "FT":
+        if frame is None:
             print('Bad read')
+            if tracer is not None:
+                tracer.pending_recv_time = None
             return None
-        
-        frame_num = int(toks[self.ft_frame_num_idx])
-        ts = float(toks[self.ft_timestamp_idx])
-
-        theta = -float(toks[self.ft_theta_idx])
-        x = float(toks[self.ft_x_idx])
-        y = float(toks[self.ft_y_idx])
-        z = 0
-        
-        return {'theta': theta, 'x': x, 'y': y, 'z':z, 'frame_num': frame_num, 'ts': ts}
-    
\ No newline at end of file
+
+        if tracer is not None:
+            tracer.record_frame(frame[0], frame[1])
+        if self.predictor is not None:
+            return self._predict(*frame[:5])
+        # A new dict per frame: the closed-loop manager keeps earlier poses (e.g. pos_0), and ring rows get overwritten
+        frame_num, ts, theta, x, y, z = frame
+        return {'theta': theta, 'x': x, 'y': y, 'z': z, 'frame_num': frame_num, 'ts': ts}
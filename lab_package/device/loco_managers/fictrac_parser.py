@@ -0,0 +1,121 @@
+"""
+FicTrac output parsing for the closed-loop hot path.
+
+FicTrac sends one line per camera frame: "FT, <col 0>, <col 1>, ...". Only the configured columns
+are converted, and parsed frames are written into a preallocated structured NumPy ring buffer
+instead of keeping one dict per frame. Rows are overwritten once the ring wraps around, so poses handed
+to closed-loop code are built from the parsed values rather than being views into the ring.
+parse_datagram handles any number of lines in one UDP datagram.
+"""
+from operator import itemgetter
+
+import numpy as np
+
+FT_FRAME_DTYPE = np.dtype([('frame_num', np.int64),
+                           ('ts', np.float64),
+                           ('theta', np.float64),
+                           ('x', np.float64),
+                           ('y', np.float64),
+                           ('z', np.float64)])  # always 0, FicTrac tracks position in the plane
+
+
+class FtFrameBuffer():
+    """
+    Ring buffer of parsed FicTrac frames, with fields frame_num, ts, theta, x, y, z.
+
+    :capacity: number of frames kept
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = int(capacity)
+        self.frames = np.zeros(self.capacity, dtype=FT_FRAME_DTYPE)
+        self.count = 0  # total frames ever written
+
+    def append(self, frame_num, ts, theta, x, y, z=0.0):
+        self.frames[self.count % self.capacity] = (frame_num, ts, theta, x, y, z)
+        self.count += 1
+
+    def latest(self):
+        """
+        Most recent frame as a numpy record, or None if empty.
+        """
+        if self.count == 0:
+            return None
+        return self.frames[(self.count - 1) % self.capacity]
+
+    def get_since(self, count):
+        """
+        Copy of frames written since the total count was count (at most capacity frames), oldest first.
+        """
+        n = min(self.count - count, self.capacity)
+        if n <= 0:
+            return np.zeros(0, dtype=FT_FRAME_DTYPE)
+        start = (self.count - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.frames[start:start+n].copy()
+        return np.concatenate([self.frames[start:], self.frames[:start + n - self.capacity]])
+
+    def clear(self):
+        self.count = 0
+
+
+class FtLineParser():
+    """
+    Parses only the configured columns of FicTrac lines. Column indices count from the first value after "FT".
+    Theta is negated, as in FtClosedLoopManager.
+
+    :buffer: FtFrameBuffer that parsed frames are written into (one is created if None)
+    """
+    def __init__(self, theta_idx, x_idx, y_idx, frame_num_idx, timestamp_idx, buffer=None):
+        self.theta_idx = theta_idx + 1  # +1 for the leading "FT" token
+        self.x_idx = x_idx + 1
+        self.y_idx = y_idx + 1
+        self.frame_num_idx = frame_num_idx + 1
+        self.timestamp_idx = timestamp_idx + 1
+        # Split no further than the last column we need
+        self.max_split = max(self.theta_idx, self.x_idx, self.y_idx, self.frame_num_idx, self.timestamp_idx) + 1
+        # Fetches the needed tokens in one C call, in frame field order
+        self.get_columns = itemgetter(self.frame_num_idx, self.timestamp_idx, self.theta_idx, self.x_idx, self.y_idx)
+        self.buffer = FtFrameBuffer() if buffer is None else buffer
+
+        self.n_bad_lines = 0
+
+    def parse_line(self, line):
+        """
+        Parse one line (bytes or str) and append it to the buffer.
+
+        returns: (frame_num, ts, theta, x, y, z), or None for a malformed line
+        """
+        # float() and int() ignore surrounding whitespace, so the line needs no strip()
+        if type(line) is str:
+            toks = line.split(', ', self.max_split)
+            is_ft = toks[0] == 'FT'
+        else:
+            toks = line.split(b', ', self.max_split)
+            is_ft = toks[0] == b'FT'
+        if not is_ft or len(toks) < self.max_split:
+            self.n_bad_lines += 1
+            return None
+        try:
+            frame_num, ts, theta, x, y = self.get_columns(toks)
+            frame = (int(frame_num), float(ts), -float(theta), float(x), float(y), 0.0)
+        except ValueError:
+            self.n_bad_lines += 1
+            return None
+        buffer = self.buffer
+        buffer.frames[buffer.count % buffer.capacity] = frame
+        buffer.count += 1
+        return frame
+
+    def parse_datagram(self, data):
+        """
+        Parse every line in a datagram (bytes or str) and append them to the buffer.
+
+        returns: number of frames parsed
+        """
+        lines = data.split('\n' if type(data) is str else b'\n')
+        count = self.buffer.count
+        parse_line = self.parse_line
+        for line in lines:
+            if len(line) > 1:
+                parse_line(line)
+        return self.buffer.count - count
@@ -0,0 +1,136 @@
+"""
+Heading and position prediction for closed-loop rendering.
+
+FicTrac runs at camera rate and the displays at 120-144 Hz, so the last received pose is already one
+camera frame plus transport old when it is drawn. HeadingPredictor keeps an alpha-beta (or plain
+constant-velocity) estimate of (theta, x, y) and their velocities over the FicTrac timestamps, and
+extrapolates the pose to the expected time of the next vsync. Each update and prediction is O(1).
+"""
+import math
+import time
+
+TWO_PI = 2 * math.pi
+
+
+class HeadingPredictor():
+    """
+    :mode: 'alpha_beta' (smoothed position and velocity) or 'constant_velocity' (velocity from the last two samples)
+    :alpha: alpha-beta position gain, in (0, 1]
+    :beta: alpha-beta velocity gain, in [0, 2)
+    :lead_time: (sec) constant delay added to the prediction horizon, e.g. transport latency plus display scan-out
+    :refresh_rate: (Hz) display refresh rate. If given, predictions target the next vsync, else now
+    :vsync_reference: (sec, time.time()) time of a past vsync, which sets the vsync phase, or a callable returning one,
+                      e.g. the last buffer swap time reported by the display. Required with refresh_rate
+    :max_horizon: (sec) predictions are clipped to this far ahead of the last sample
+    :max_gap: (sec) a gap between samples longer than this resets the velocity estimate
+    :ts_scale: factor converting the FicTrac timestamp to sec
+    """
+    def __init__(self, mode='alpha_beta', alpha=0.85, beta=0.05, lead_time=0.0, refresh_rate=None, vsync_reference=None,
+                 max_horizon=0.05, max_gap=0.1, ts_scale=1e-3):
+        if mode not in ('alpha_beta', 'constant_velocity'):
+            raise ValueError('Unrecognized predictor mode: {}'.format(mode))
+        if refresh_rate and vsync_reference is None:
+            raise ValueError('Predicting to the next vsync needs a vsync_reference')
+        self.mode = mode
+        self.alpha = alpha
+        self.beta = beta
+        self.lead_time = lead_time
+        self.refresh_rate = refresh_rate
+        self.vsync_reference = vsync_reference
+        self.max_horizon = max_horizon
+        self.max_gap = max_gap
+        self.ts_scale = ts_scale
+
+        self.reset()
+
+    @classmethod
+    def from_parameters(cls, parameters, vsync_reference=None):
+        """
+        Predictor from a parameter dict as returned by get_parameters, e.g. from a protocol's parameters.
+        None if parameters is empty or None, or has mode 'none' (see FtClosedLoopManager.get_predictor_parameters).
+        vsync_reference: see __init__, as it is not part of the parameters
+        """
+        if not parameters or parameters.get('mode') == 'none':
+            return None
+        kwargs = dict(parameters)
+        if vsync_reference is not None:
+            kwargs['vsync_reference'] = vsync_reference
+        return cls(**kwargs)
+
+    def reset(self):
+        self.last_ts = None  # (sec) FicTrac time of the last sample
+        self.last_recv_time = None  # (sec) time.time() when the last sample arrived
+        self.theta_offset = 0.0  # unwrapped theta = measured theta + theta_offset
+        self.last_theta = None
+        self.pos = [0.0, 0.0, 0.0]  # theta (unwrapped), x, y
+        self.vel = [0.0, 0.0, 0.0]
+        self.n_updates = 0
+
+    def get_parameters(self):
+        return {'mode': self.mode,
+                'alpha': self.alpha,
+                'beta': self.beta,
+                'lead_time': self.lead_time,
+                'refresh_rate': self.refresh_rate,
+                'max_horizon': self.max_horizon,
+                'max_gap': self.max_gap}
+
+    def update(self, ts, theta, x, y, recv_time=None):
+        """
+        Add a sample. ts is the FicTrac timestamp (see ts_scale), theta in radians.
+        """
+        ts = ts * self.ts_scale
+        self.last_recv_time = time.time() if recv_time is None else recv_time
+
+        # Unwrap theta so that velocities do not jump at +/- pi
+        if self.last_theta is not None:
+            self.theta_offset -= TWO_PI * round((theta - self.last_theta) / TWO_PI)
+        self.last_theta = theta
+        meas = (theta + self.theta_offset, x, y)
+
+        dt = None if self.last_ts is None else ts - self.last_ts
+        self.last_ts = ts
+        self.n_updates += 1
+        if dt is None or dt <= 0 or dt > self.max_gap:
+            self.pos = list(meas)
+            self.vel = [0.0, 0.0, 0.0]
+            return
+
+        pos, vel = self.pos, self.vel
+        if self.mode == 'constant_velocity':
+            for i in range(3):
+                vel[i] = (meas[i] - pos[i]) / dt
+                pos[i] = meas[i]
+        else:
+            alpha, beta = self.alpha, self.beta
+            for i in range(3):
+                predicted = pos[i] + vel[i] * dt
+                residual = meas[i] - predicted
+                pos[i] = predicted + alpha * residual
+                vel[i] += beta * residual / dt
+
+    def get_target_time(self, now=None):
+        """
+        Time (time.time()) the prediction is for: the next vsync after now if refresh_rate is set, else now.
+        """
+        if now is None:
+            now = time.time()
+        if not self.refresh_rate:
+            return now
+        vsync_reference = self.vsync_reference() if callable(self.vsync_reference) else self.vsync_reference
+        period = 1.0 / self.refresh_rate
+        return vsync_reference + math.ceil((now - vsync_reference) / period) * period
+
+    def predict(self, now=None):
+        """
+        returns: (theta, x, y) extrapolated to the target time plus lead_time. theta is on the same
+                 branch as the last measured theta. None before the first sample.
+        """
+        if self.last_ts is None:
+            return None
+        horizon = self.get_target_time(now) - self.last_recv_time + self.lead_time
+        horizon = min(max(horizon, 0.0), self.max_horizon)
+        pos, vel = self.pos, self.vel
+        return (pos[0] + vel[0] * horizon - self.theta_offset,
+                pos[1] + vel[1] * horizon,
+                pos[2] + vel[2] * horizon)
@@ -0,0 +1,175 @@
+"""
+Recording of the FicTrac frames received by FtClosedLoopManager.
+
+FicTrac runs on the server, while Data (the experiment HDF5 file) lives in the client process, so frames are
+recorded into an HDF5 file of the server's own (make_file_recorder), which the client links into the epoch run
+with Data.link_acquisition_file. A writer thread drains the manager's FtFrameBuffer in chunks into
+<name>/frames, a resizable compound dataset with fields frame_num, ts, theta, x, y, z.
+
+Epoch boundaries are stored in <name>/epoch_index (see EPOCH_INDEX_DTYPE) both by FicTrac frame number and
+timestamp, and by row in <name>/frames. Rows are resolved once the frames are written, counting frames lost from
+the ring buffer, so an epoch's frames are read with one slice (read_epoch_frames).
+"""
+import threading
+import numpy as np
+
+from lab_package.device.acquisition import H5FileSink
+
+# An epoch holds the frames with start_frame_num <= frame_num < end_frame_num, which are rows start_row:end_row
+# of <name>/frames. start_ts and end_ts are the timestamps of the last frame received before the epoch started and ended
+EPOCH_INDEX_DTYPE = np.dtype([('epoch_number', np.int64),
+                              ('start_frame_num', np.int64),
+                              ('start_ts', np.float64),
+                              ('end_frame_num', np.int64),
+                              ('end_ts', np.float64),
+                              ('start_row', np.int64),
+                              ('end_row', np.int64)])
+FRAMES_CHUNK_ROWS = 4096
+EPOCH_INDEX_CHUNK_ROWS = 256
+
+
+class FtRecorder():
+    """
+    :buffer: FtFrameBuffer the frames are received into
+    :sink: callable taking a structured array of frames, called from the writer thread
+    :epoch_index_sink: callable taking a structured array of EPOCH_INDEX_DTYPE rows
+    :flush_interval: (sec) how often the writer drains the buffer
+    """
+    def __init__(self, buffer, sink, epoch_index_sink=None, flush_interval=1.0):
+        self.buffer = buffer
+        self.sink = sink
+        self.epoch_index_sink = epoch_index_sink
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.start_count = None  # buffer.count when recording started, i.e. of row 0
+        self.read_count = None  # buffer.count up to which frames have been handed to the sink
+        self.lost_ranges = []  # [first, last) buffer counts of frames overwritten before they were written
+        self.epoch_rows = []  # finished epochs not yet written: (epoch_number, start_frame_num, start_ts, end_frame_num, end_ts, start_count, end_count)
+        self.current_epoch = None  # (epoch_number, start_frame_num, start_ts, start_count)
+        self.error = None
+
+        # Counters
+        self.n_frames_written = 0
+        self.n_frames_lost = 0  # overwritten in the ring buffer before they could be written
+        self.n_epochs_written = 0
+
+        self.writer = threading.Thread(target=self._write_loop, name='fictrac_recorder', daemon=True)
+
+    def start(self):
+        self.start_count = self.read_count = self.buffer.count
+        self.writer.start()
+
+    def stop(self, timeout=None):
+        """
+        Write the remaining frames and epoch rows and stop the writer thread. Returns the counters.
+        """
+        if self.current_epoch is not None:
+            self.mark_epoch_end()
+        self.stop_event.set()
+        if self.writer.is_alive():
+            self.writer.join(timeout=timeout)
+        return self.get_counters()
+
+    def get_boundary(self):
+        """
+        (buffer count, frame number of the next frame, timestamp of the last received frame), with frame number 0
+        and timestamp NaN before the first frame.
+        """
+        count = self.buffer.count
+        if count == 0:
+            return 0, 0, np.nan
+        frame = self.buffer.frames[(count - 1) % self.buffer.capacity]
+        return count, int(frame['frame_num']) + 1, float(frame['ts'])
+
+    def mark_epoch_start(self, epoch_number):
+        with self.lock:
+            count, frame_num, ts = self.get_boundary()
+            if self.current_epoch is not None:
+                self._end_epoch(count, frame_num, ts)
+            self.current_epoch = (epoch_number, frame_num, ts, count)
+
+    def mark_epoch_end(self):
+        with self.lock:
+            if self.current_epoch is None:
+                return
+            self._end_epoch(*self.get_boundary())
+            self.current_epoch = None
+
+    def _end_epoch(self, count, frame_num, ts):
+        epoch_number, start_frame_num, start_ts, start_count = self.current_epoch
+        self.epoch_rows.append((epoch_number, start_frame_num, start_ts, frame_num, ts, start_count, count))
+
+    def get_row(self, count):
+        """
+        Row in the frames dataset of the frame with buffer count count, or of the next written frame if it was lost.
+        Only final for counts up to read_count.
+        """
+        count = max(count, self.start_count)
+        n_lost = sum(min(last, count) - first for first, last in self.lost_ranges if first < count)
+        return count - self.start_count - n_lost
+
+    def get_counters(self):
+        return {'frames_written': self.n_frames_written,
+                'frames_lost': self.n_frames_lost,
+                'epochs_written': self.n_epochs_written,
+                'error': None if self.error is None else repr(self.error)}
+
+    def _flush(self):
+        count = self.buffer.count
+        n_new = count - self.read_count
+        if n_new > self.buffer.capacity:
+            self.n_frames_lost += n_new - self.buffer.capacity
+            self.lost_ranges.append((self.read_count, count - self.buffer.capacity))
+        frames = self.buffer.get_since(self.read_count)
+        self.read_count = count
+        if frames.shape[0] > 0:
+            self.sink(frames)
+            self.n_frames_written += frames.shape[0]
+
+        # Epochs ending after the frames written so far wait for the next flush, as their rows are not known yet
+        with self.lock:
+            epoch_rows = [row for row in self.epoch_rows if row[-1] <= count]
+            self.epoch_rows = [row for row in self.epoch_rows if row[-1] > count]
+        if epoch_rows and self.epoch_index_sink is not None:
+            rows = [row[:5] + (self.get_row(row[5]), self.get_row(row[6])) for row in epoch_rows]
+            self.epoch_index_sink(np.array(rows, dtype=EPOCH_INDEX_DTYPE))
+            self.n_epochs_written += len(epoch_rows)
+
+    def _write_loop(self):
+        while True:
+            stopping = self.stop_event.wait(timeout=self.flush_interval)
+            try:
+                self._flush()
+            except Exception as e:
+                self.error = e
+                print('FicTrac recorder could not write data: {}'.format(e))
+            if stopping:
+                return
+
+
+def make_file_recorder(buffer, filepath, name='fictrac', flush_interval=1.0):
+    """
+    FtRecorder writing into the HDF5 file at filepath, created if needed:
+        <name>/frames: frame_num, ts, theta, x, y, z per frame
+        <name>/epoch_index: EPOCH_INDEX_DTYPE row per epoch
+    """
+    frames_sink = H5FileSink(filepath, name=name + '/frames', chunk_rows=FRAMES_CHUNK_ROWS)
+    epoch_index_sink = H5FileSink(filepath, name=name + '/epoch_index', chunk_rows=EPOCH_INDEX_CHUNK_ROWS)
+    return FtRecorder(buffer, frames_sink, epoch_index_sink=epoch_index_sink, flush_interval=flush_interval)
+
+
+def read_epoch_frames(group, epoch_number, name='fictrac'):
+    """
+    Frames recorded during one epoch, from an open h5py group holding <name>, e.g. the recorder's file
+    or an epoch run group it is linked into.
+
+    returns: structured array with fields frame_num, ts, theta, x, y, z
+    """
+    epoch_index = group[name + '/epoch_index']
+    rows = np.flatnonzero(epoch_index['epoch_number'] == epoch_number)
+    if rows.size == 0:
+        raise KeyError('No FicTrac frames recorded for epoch {}'.format(epoch_number))
+    epoch = epoch_index[rows[-1]]
+    return group[name + '/frames'][epoch['start_row']:epoch['end_row']]
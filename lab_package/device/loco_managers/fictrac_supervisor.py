@@ -0,0 +1,251 @@
+"""
+Supervised, warm FicTrac instances.
+
+FicTrac takes seconds to load its config and calibrate before the first frame, so FtSupervisor keeps
+one instance per rig running across closed-loop runs instead of spawning one per run. A watchdog thread
+checks that frames keep arriving over UDP and restarts FicTrac if the process exits or stalls.
+Recording frames into the data file is started and stopped without respawning FicTrac.
+
+Frames are counted from an attached FtFrameBuffer, e.g. FtClosedLoopManager.ft_frames. While nothing
+is attached, the supervisor listens on the FicTrac UDP port itself.
+
+Usage:
+    supervisor = get_supervisor('Magneto', ft_bin=..., ft_config=...)
+    manager = FtClosedLoopManager(fs_manager, ft_supervisor=supervisor)
+"""
+import socket
+import threading
+import time
+
+from lab_package.device.loco_managers.fictrac_parser import FtLineParser
+from lab_package.device.loco_managers.fictrac_recorder import make_file_recorder
+
+_supervisors = {}
+_supervisors_lock = threading.Lock()
+
+def get_supervisor(rig_name, **kwargs):
+    """
+    The FtSupervisor for rig_name, created (and started) with kwargs on first use.
+    """
+    with _supervisors_lock:
+        if rig_name not in _supervisors:
+            _supervisors[rig_name] = FtSupervisor(**kwargs)
+        supervisor = _supervisors[rig_name]
+    supervisor.ensure_running()
+    return supervisor
+
+
+class FtSupervisor():
+    """
+    :ft_manager: FtManager that runs the FicTrac process. One is created from ft_manager_kwargs if None
+    :host, port: FicTrac UDP output, listened on while no frame buffer is attached
+    :parser_kwargs: column indices for the FtLineParser used while listening, see FtLineParser
+    :stall_timeout: (sec) restart FicTrac if no frame arrives for this long
+    :startup_timeout: (sec) time allowed for the first frame after (re)starting FicTrac
+    :check_interval: (sec) watchdog period
+    :max_restarts: stop restarting after this many restarts (None for no limit)
+    """
+    def __init__(self, ft_manager=None, host='127.0.0.1', port=33334, parser_kwargs=None, stall_timeout=2.0, startup_timeout=30.0,
+                 check_interval=0.5, max_restarts=None, **ft_manager_kwargs):
+        if ft_manager is None:
+            from lab_package.device.loco_managers.fictrac_managers import FtManager
+            ft_manager_kwargs.setdefault('finalize_async', True)
+            ft_manager = FtManager(start_at_init=False, **ft_manager_kwargs)
+        self.ft_manager = ft_manager
+        self.host = host
+        self.port = port
+        self.parser_kwargs = {'theta_idx': 16, 'x_idx': 14, 'y_idx': 15, 'frame_num_idx': 0, 'timestamp_idx': 21}
+        self.parser_kwargs.update(parser_kwargs or {})
+        self.stall_timeout = stall_timeout
+        self.startup_timeout = startup_timeout
+        self.check_interval = check_interval
+        self.max_restarts = max_restarts
+
+        self.lock = threading.RLock()
+        self.frames = None  # FtFrameBuffer frames are counted from
+        self.attached = False
+        self.listener = None
+        self.listen_stop = threading.Event()
+        self.recorder = None
+
+        self.started_time = None
+        self.last_count = 0
+        self.last_frame_time = None
+        self.n_restarts = 0
+        self.restart_reasons = []
+
+        self.watchdog_stop = threading.Event()
+        self.watchdog = None
+
+    # # # Process # # #
+    def ensure_running(self):
+        """
+        Start FicTrac and the watchdog if they are not running. Does nothing to a running instance.
+        """
+        with self.lock:
+            if not self.ft_manager.started:
+                self._start_fictrac()
+            if self.frames is None:
+                self._start_listening()
+            if self.watchdog is None or not self.watchdog.is_alive():
+                self.watchdog_stop.clear()
+                self.watchdog = threading.Thread(target=self._watchdog_loop, name='fictrac_watchdog', daemon=True)
+                self.watchdog.start()
+
+    def shutdown(self, timeout=5):
+        """
+        Stop recording, the watchdog and FicTrac. Returns the FtManager.close future.
+        """
+        self.stop_recording()
+        self.watchdog_stop.set()
+        if self.watchdog is not None and self.watchdog is not threading.current_thread():
+            self.watchdog.join(timeout=timeout)
+        self._stop_listening()
+        with self.lock:
+            return self.ft_manager.close(timeout=timeout)
+
+    def set_save_directory(self, save_directory):
+        """
+        Directory FicTrac's output files are saved to when the process is restarted or shut down. Without one they are deleted.
+        """
+        with self.lock:
+            self.ft_manager.set_save_directory(save_directory)
+
+    def restart(self, reason='requested'):
+        with self.lock:
+            print('Restarting Fictrac: {}'.format(reason))
+            self.n_restarts += 1
+            self.restart_reasons.append((time.time(), reason))
+            if self.ft_manager.started:
+                self.ft_manager.close(blocking=False)
+            self._start_fictrac()
+
+    def is_healthy(self):
+        """
+        True if FicTrac is running and a frame arrived within stall_timeout.
+        """
+        with self.lock:
+            if not self.ft_manager.started or self.ft_manager.p.poll() is not None:
+                return False
+            return self.last_frame_time is not None and time.monotonic() - self.last_frame_time < self.stall_timeout
+
+    def get_status(self):
+        with self.lock:
+            return {'running': self.ft_manager.started and self.ft_manager.p.poll() is None,
+                    'healthy': self.is_healthy(),
+                    'frames': 0 if self.frames is None else self.frames.count,
+                    'seconds_since_last_frame': None if self.last_frame_time is None else time.monotonic() - self.last_frame_time,
+                    'uptime': None if self.started_time is None else time.monotonic() - self.started_time,
+                    'n_restarts': self.n_restarts,
+                    'recording': self.recorder is not None}
+
+    def _start_fictrac(self):
+        self.ft_manager.start()
+        self.started_time = time.monotonic()
+        self.last_frame_time = None
+
+    def _watchdog_loop(self):
+        while not self.watchdog_stop.wait(timeout=self.check_interval):
+            with self.lock:
+                if not self.ft_manager.started:
+                    continue
+                now = time.monotonic()
+                count = 0 if self.frames is None else self.frames.count
+                if count != self.last_count:
+                    self.last_count = count
+                    self.last_frame_time = now
+
+                if self.max_restarts is not None and self.n_restarts >= self.max_restarts:
+                    continue
+                if self.ft_manager.p.poll() is not None:
+                    self.restart('process exited with code {}'.format(self.ft_manager.p.returncode))
+                elif self.last_frame_time is None:
+                    if now - self.started_time > self.startup_timeout:
+                        self.restart('no frame within {} s of starting'.format(self.startup_timeout))
+                elif now - self.last_frame_time > self.stall_timeout:
+                    self.restart('no frame for {} s'.format(self.stall_timeout))
+
+    # # # Frame source # # #
+    def attach_frames(self, frames):
+        """
+        Count frames from frames (an FtFrameBuffer filled by e.g. FtClosedLoopManager) and release the UDP port.
+        """
+        with self.lock:
+            if self.recorder is not None and frames is not self.frames:
+                print('Cannot switch the FicTrac frame source while recording.')
+                return
+            self._stop_listening()
+            self.frames = frames
+            self.last_count = frames.count
+            self.attached = True
+
+    def detach_frames(self):
+        """
+        Go back to listening on the UDP port, e.g. when the closed-loop manager closes its socket.
+        """
+        with self.lock:
+            if self.recorder is not None:
+                print('Cannot switch the FicTrac frame source while recording.')
+                return
+            self.attached = False
+            self.frames = None
+            if self.watchdog is not None and self.watchdog.is_alive():
+                self._start_listening()
+
+    def _start_listening(self):
+        parser = FtLineParser(**self.parser_kwargs)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, self.port))
+        sock.settimeout(self.check_interval)
+        self.frames = parser.buffer
+        self.last_count = 0
+        self.listen_stop.clear()
+        self.listener = threading.Thread(target=self._listen_loop, args=(sock, parser), name='fictrac_listener', daemon=True)
+        self.listener.start()
+
+    def _stop_listening(self):
+        self.listen_stop.set()
+        if self.listener is not None and self.listener is not threading.current_thread():
+            self.listener.join()
+        self.listener = None
+
+    def _listen_loop(self, sock, parser):
+        with sock:
+            while not self.listen_stop.is_set():
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    continue
+                parser.parse_datagram(data)
+
+    # # # Recording # # #
+    def start_recording(self, filepath, name='fictrac', flush_interval=1.0):
+        """
+        Record frames into the HDF5 file at filepath, without restarting FicTrac.
+        See fictrac_recorder.make_file_recorder for the datasets written.
+        """
+        with self.lock:
+            if self.recorder is not None:
+                self.stop_recording()
+            if self.frames is None:
+                raise RuntimeError('FicTrac supervisor is not running')
+            self.recorder = make_file_recorder(self.frames, filepath, name=name, flush_interval=flush_interval)
+            self.recorder.start()
+
+    def stop_recording(self, timeout=5):
+        """
+        Returns the recorder counters, or None if not recording.
+        """
+        with self.lock:
+            if self.recorder is None:
+                return None
+            recorder, self.recorder = self.recorder, None
+        return recorder.stop(timeout=timeout)
+
+    def mark_epoch_start(self, epoch_number):
+        if self.recorder is not None:
+            self.recorder.mark_epoch_start(epoch_number)
+
+    def mark_epoch_end(self):
+        if self.recorder is not None:
+            self.recorder.mark_epoch_end()
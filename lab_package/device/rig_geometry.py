@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Screen geometry of a rig, loaded from the rig config.
+
+Each screen is a flat rectangle given by three corners in fly-centered coordinates (z up): pa lower
+left, pb lower right and pc upper left, as for flystim SubScreen. The fly's eye sits at the origin.
+ScreenGeometry computes the off-axis (generalized perspective) projection and view matrices of a screen
+once, and maps many visual-field directions to screen pixels in one vectorized call.
+
+Config, under rig_config.<rig name>:
+    screens:
+      l: {pa: [-14, -7, -2], pb: [0, 10, -2], pc: [-14, -7, 10],
+          viewport_ll: [-1.0, -1.0], viewport_width: 2, viewport_height: 2,
+          resolution: [1920, 1080]}  # resolution (pixels) is optional
+
+Visual-field directions follow flystim's spherical convention, in degrees: theta is the azimuth about
++z, measured from +x toward +y, and phi is the polar angle from +z (phi = 90 on the horizon).
+
+Usage:
+    geometry = get_rig_geometry('Magneto', cfg_path)
+    pixels, visible = geometry.screens['l'].angles_to_pixels(theta, phi)
+"""
+import os
+from functools import lru_cache
+import numpy as np
+import yaml
+
+NEAR = 0.01
+FAR = 1000.0
+
+
+def angles_to_directions(theta, phi):
+    """
+    Unit vectors (..., 3) for visual-field angles theta, phi (degrees, broadcast against each other).
+    """
+    theta = np.radians(np.asarray(theta, dtype=float))
+    phi = np.radians(np.asarray(phi, dtype=float))
+    sin_phi = np.sin(phi)
+    return np.stack(np.broadcast_arrays(sin_phi * np.cos(theta), sin_phi * np.sin(theta), np.cos(phi)), axis=-1)
+
+
+@lru_cache(maxsize=64)
+def get_screen_matrices(pa, pb, pc, pe=(0.0, 0.0, 0.0), near=NEAR, far=FAR):
+    """
+    Off-axis projection and view matrices (4x4, OpenGL convention) of the screen with corners pa, pb, pc
+    seen from pe. Arguments are tuples, so that the result is cached per geometry. The returned arrays are read-only.
+    returns: (projection, view)
+    """
+    pa, pb, pc, pe = (np.array(p, dtype=float) for p in (pa, pb, pc, pe))
+    vr = (pb - pa) / np.linalg.norm(pb - pa)
+    vu = (pc - pa) / np.linalg.norm(pc - pa)
+    vn = np.cross(vr, vu)
+    vn /= np.linalg.norm(vn)
+
+    va, vb, vc = pa - pe, pb - pe, pc - pe
+    distance = -np.dot(va, vn)
+    if distance <= 0:
+        raise ValueError('Screen {}, {}, {} faces away from the eye at {}'.format(pa, pb, pc, pe))
+    left = np.dot(vr, va) * near / distance
+    right = np.dot(vr, vb) * near / distance
+    bottom = np.dot(vu, va) * near / distance
+    top = np.dot(vu, vc) * near / distance
+
+    projection = np.array([[2*near/(right-left), 0, (right+left)/(right-left), 0],
+                           [0, 2*near/(top-bottom), (top+bottom)/(top-bottom), 0],
+                           [0, 0, -(far+near)/(far-near), -2*far*near/(far-near)],
+                           [0, 0, -1, 0]])
+    view = np.eye(4)
+    view[:3, :3] = np.stack([vr, vu, vn])
+    view[:3, 3] = -view[:3, :3] @ pe
+
+    projection.flags.writeable = False
+    view.flags.writeable = False
+    return projection, view
+
+
+class ScreenGeometry():
+    """
+    :pa, pb, pc: lower left, lower right and upper left corners of the screen
+    :viewport_ll, viewport_width, viewport_height: part of the window drawn into, in normalized device coordinates
+    :resolution: (width, height) of the window in pixels, or None if unknown
+    :pe: eye position
+    """
+    def __init__(self, pa, pb, pc, viewport_ll=(-1.0, -1.0), viewport_width=2, viewport_height=2, resolution=None, pe=(0.0, 0.0, 0.0)):
+        self.pa = tuple(float(v) for v in pa)
+        self.pb = tuple(float(v) for v in pb)
+        self.pc = tuple(float(v) for v in pc)
+        self.pe = tuple(float(v) for v in pe)
+        self.viewport_ll = tuple(float(v) for v in viewport_ll)
+        self.viewport_width = float(viewport_width)
+        self.viewport_height = float(viewport_height)
+        self.resolution = None if resolution is None else tuple(int(v) for v in resolution)
+
+        self.projection, self.view = get_screen_matrices(self.pa, self.pb, self.pc, self.pe)
+        self.transform = self.projection @ self.view
+
+    @classmethod
+    def from_config(cls, screen_config):
+        return cls(**screen_config)
+
+    def get_key(self):
+        """
+        Hashable description of the geometry, e.g. for caching objects built from it.
+        """
+        return (self.pa, self.pb, self.pc, self.pe, self.viewport_ll, self.viewport_width, self.viewport_height, self.resolution)
+
+    def get_subscreen_kwargs(self):
+        return {'pa': self.pa, 'pb': self.pb, 'pc': self.pc,
+                'viewport_ll': self.viewport_ll, 'viewport_width': self.viewport_width, 'viewport_height': self.viewport_height}
+
+    def directions_to_ndc(self, directions):
+        """
+        Window normalized device coordinates (..., 2) of directions (..., 3) from the eye.
+        returns: (ndc, visible), visible being False for directions that miss the screen
+        """
+        directions = np.asarray(directions, dtype=float)
+        points = np.empty(directions.shape[:-1] + (4,))
+        points[..., :3] = np.asarray(self.pe) + directions
+        points[..., 3] = 1
+        clip = points @ self.transform.T
+        w = clip[..., 3]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            screen_ndc = clip[..., :2] / w[..., np.newaxis]
+        visible = (w > 0) & np.all(np.abs(screen_ndc) <= 1, axis=-1)
+
+        # Screen normalized device coordinates to the viewport within the window
+        ndc = np.empty_like(screen_ndc)
+        ndc[..., 0] = self.viewport_ll[0] + 0.5 * (screen_ndc[..., 0] + 1) * self.viewport_width
+        ndc[..., 1] = self.viewport_ll[1] + 0.5 * (screen_ndc[..., 1] + 1) * self.viewport_height
+        return ndc, visible
+
+    def angles_to_ndc(self, theta, phi):
+        return self.directions_to_ndc(angles_to_directions(theta, phi))
+
+    def angles_to_pixels(self, theta, phi, resolution=None):
+        """
+        Window pixel coordinates (..., 2) as (column, row), rows counted from the top, of visual-field angles (degrees).
+        :resolution: (width, height) in pixels, defaults to self.resolution
+        returns: (pixels, visible)
+        """
+        resolution = self.resolution if resolution is None else resolution
+        if resolution is None:
+            raise ValueError('Screen resolution is not known: pass resolution or set it in the rig config')
+        ndc, visible = self.angles_to_ndc(theta, phi)
+        pixels = np.empty_like(ndc)
+        pixels[..., 0] = 0.5 * (ndc[..., 0] + 1) * resolution[0]
+        pixels[..., 1] = 0.5 * (1 - ndc[..., 1]) * resolution[1]
+        return pixels, visible
+
+    def get_coverage(self, theta, phi):
+        """
+        Fraction of the visual-field points theta, phi (degrees, broadcast against each other) that land on the screen.
+        """
+        _, visible = self.angles_to_ndc(theta, phi)
+        return np.count_nonzero(visible) / max(visible.size, 1)
+
+
+class RigGeometry():
+    """
+    :screens: dict of screen name -> ScreenGeometry
+    """
+    def __init__(self, screens):
+        self.screens = dict(screens)
+
+    @classmethod
+    def from_config(cls, rig_config):
+        if 'screens' not in rig_config:
+            raise ValueError('Rig config has no screens')
+        return cls({name: ScreenGeometry.from_config(screen_config) for name, screen_config in rig_config['screens'].items()})
+
+    def angles_to_ndc(self, theta, phi):
+        """
+        returns: dict of screen name -> (ndc, visible), see ScreenGeometry.directions_to_ndc
+        """
+        directions = angles_to_directions(theta, phi)
+        return {name: screen.directions_to_ndc(directions) for name, screen in self.screens.items()}
+
+    def get_visible(self, theta, phi):
+        """
+        True for the visual-field points that land on any screen.
+        """
+        visible = [v for _, v in self.angles_to_ndc(theta, phi).values()]
+        return np.logical_or.reduce(visible) if visible else np.zeros(np.broadcast(theta, phi).shape, dtype=bool)
+
+
+@lru_cache(maxsize=16)
+def _load_rig_geometry(cfg_path, rig_name, mtime):
+    with open(cfg_path, 'r') as f:
+        cfg = yaml.safe_load(f)
+    if rig_name not in cfg.get('rig_config', {}):
+        raise ValueError('Rig {} not found in {}'.format(rig_name, cfg_path))
+    return RigGeometry.from_config(cfg['rig_config'][rig_name])
+
+
+def get_rig_geometry(rig_name, cfg_path):
+    """
+    RigGeometry of rig_name in the config at cfg_path, cached until the config file changes.
+    """
+    return _load_rig_geometry(cfg_path, rig_name, os.path.getmtime(cfg_path))
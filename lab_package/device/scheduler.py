@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deadline scheduler for device jobs.
+
+One worker thread per device runs jobs (stream start/stop, triggers, DAC writes...) at absolute
+deadlines taken from a priority queue. Submitting returns a concurrent.futures.Future that can be
+cancelled until the job starts. Jobs can reserve device channels over a time window, and a job whose
+window overlaps a live reservation on the same channel is rejected at submit time.
+"""
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+
+class ChannelConflictError(Exception):
+    pass
+
+
+def chain_future(source, target):
+    """
+    Once source is done, resolve target with its result or exception. Cancellation of source is not passed on.
+    """
+    def chain_helper(future):
+        if future.cancelled() or target.done():
+            return
+        if future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(chain_helper)
+
+
+class Reservation():
+    """
+    Channels reserved over [start, end] for the job whose future is given. Live until its end time
+    has passed, or until the job is cancelled or fails.
+    """
+    def __init__(self, channels, start, end, future, name=''):
+        self.channels = frozenset(channels)
+        self.start = start
+        self.end = end
+        self.future = future
+        self.name = name
+
+    def is_live(self, now):
+        if self.future.cancelled():
+            return False
+        if self.future.done() and self.future.exception() is not None:
+            return False
+        return self.end > now
+
+    def overlaps(self, channels, start, end):
+        return bool(self.channels & frozenset(channels)) and start < self.end and self.start < end
+
+
+class DeviceScheduler():
+    """
+    :name: name of the worker thread
+    :clock: monotonic clock used for deadlines (sec)
+    """
+    def __init__(self, name='device_scheduler', clock=time.monotonic):
+        self.clock = clock
+        self.queue = []  # heap of (deadline, sequence number, future, fn, args, kwargs)
+        self.reservations = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.worker = threading.Thread(target=self._loop, name=name, daemon=True)
+        self.worker.start()
+
+    def now(self):
+        return self.clock()
+
+    def submit_at(self, deadline, fn, *args, channels=(), until=None, name='', **kwargs):
+        """
+        Run fn(*args, **kwargs) on the worker thread at time deadline (on self.clock).
+
+        channels: device channels the job uses, e.g. ['STREAM', 'DAC0']
+        until: end of the channel reservation, defaults to deadline. E.g. for a stream start, the time the stream will be stopped
+        name: label used in conflict errors
+        returns: Future for the return value of fn
+        """
+        future = Future()
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('Scheduler has been shut down')
+            if channels:
+                end = deadline if until is None else until
+                self._reserve(channels, deadline, end, future, name)
+            heapq.heappush(self.queue, (deadline, next(self.counter), future, fn, args, kwargs))
+            self.condition.notify()
+        return future
+
+    def submit_after(self, delay, fn, *args, **kwargs):
+        return self.submit_at(self.now() + delay, fn, *args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_at(self.now(), fn, *args, **kwargs)
+
+    def get_conflicts(self, channels, start, end):
+        with self.condition:
+            now = self.now()
+            return [r for r in self.reservations if r.is_live(now) and r.overlaps(channels, start, end)]
+
+    def release(self, future):
+        """
+        Drop the channel reservation held by the job with this future, e.g. when an open-ended job is stopped.
+        """
+        with self.condition:
+            self.reservations = [r for r in self.reservations if r.future is not future]
+
+    def cancel_all(self):
+        """
+        Cancel all jobs that have not started yet. Returns the number of cancelled jobs.
+        """
+        with self.condition:
+            n_cancelled = sum([item[2].cancel() for item in self.queue])
+            self.condition.notify()
+        return n_cancelled
+
+    def pending(self):
+        with self.condition:
+            return len([item for item in self.queue if not item[2].cancelled()])
+
+    def shutdown(self, wait=True, cancel_pending=True):
+        if cancel_pending:
+            self.cancel_all()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if wait and threading.current_thread() is not self.worker:
+            self.worker.join()
+
+    def _reserve(self, channels, start, end, future, name):
+        now = self.now()
+        self.reservations = [r for r in self.reservations if r.is_live(now)]
+        for r in self.reservations:
+            if r.overlaps(channels, start, end):
+                raise ChannelConflictError('Job {} on {} over [{:.3f}, {:.3f}] overlaps job {} on {} over [{:.3f}, {:.3f}]'.format(
+                    name, sorted(channels), start - now, end - now, r.name, sorted(r.channels), r.start - now, r.end - now))
+        self.reservations.append(Reservation(channels, start, end, future, name))
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    # Drop cancelled jobs from the front of the queue
+                    while self.queue and self.queue[0][2].cancelled():
+                        heapq.heappop(self.queue)
+                    if not self.running and not self.queue:
+                        return
+                    if self.queue:
+                        wait_time = self.queue[0][0] - self.now()
+                        if wait_time <= 0:
+                            _, _, future, fn, args, kwargs = heapq.heappop(self.queue)
+                            break
+                        self.condition.wait(timeout=wait_time)
+                    else:
+                        self.condition.wait()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
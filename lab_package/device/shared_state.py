@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Closed-loop pose relay between a loco manager and the screens.
+
+flystim renders each Screen in its own process, and the server relays stimulus and pose commands to
+all of them over RPC. CoalescingFsManagerProxy stands in for the stimulus manager of a closed-loop
+manager: pose calls (set_*) return immediately, and a relay thread forwards only the latest call per
+method at the display rate, so a slow screen does not hold up the FicTrac receive loop.
+"""
+import threading
+import time
+
+
+class CoalescingFsManagerProxy():
+    """
+    Forwards everything to fs_manager. Calls to methods starting with one of method_prefixes are queued,
+    keeping only the latest call per method, and forwarded by a relay thread at rate (Hz).
+    """
+    def __init__(self, fs_manager, rate=144.0, method_prefixes=('set_',)):
+        self.fs_manager = fs_manager
+        self.period = 1.0 / rate
+        self.method_prefixes = tuple(method_prefixes)
+
+        self.lock = threading.Lock()
+        self.pending = {}  # method name -> (args, kwargs)
+        self.n_calls = 0
+        self.n_forwarded = 0
+        self.error = None
+        self.stop_event = threading.Event()
+        self.relay = threading.Thread(target=self._relay_loop, name='pose_relay', daemon=True)
+        self.relay.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self.fs_manager, name)
+        if not (callable(attr) and name.startswith(self.method_prefixes)):
+            return attr
+
+        def queued_call(*args, **kwargs):
+            with self.lock:
+                self.pending[name] = (args, kwargs)
+                self.n_calls += 1
+        return queued_call
+
+    def flush(self):
+        """
+        Forward the pending calls now. If a call raises, it is dropped, and the calls not forwarded yet
+        stay queued (unless newer calls to the same methods came in meanwhile) before the error is raised.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        try:
+            while pending:
+                name = next(iter(pending))
+                args, kwargs = pending.pop(name)
+                getattr(self.fs_manager, name)(*args, **kwargs)
+                self.n_forwarded += 1
+        finally:
+            if pending:
+                with self.lock:
+                    pending.update(self.pending)
+                    self.pending = pending
+
+    def get_counters(self):
+        return {'calls': self.n_calls,
+                'forwarded': self.n_forwarded,
+                'error': None if self.error is None else repr(self.error)}
+
+    def close(self):
+        self.stop_event.set()
+        self.relay.join()
+        self.flush()
+
+    def _relay_loop(self):
+        next_time = time.perf_counter()
+        while not self.stop_event.is_set():
+            next_time += self.period
+            try:
+                self.flush()
+            except Exception as e:
+                self.error = e
+                print('Pose relay could not forward a call: {}'.format(e))
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                self.stop_event.wait(timeout=delay)
+            else:
+                next_time = time.perf_counter()
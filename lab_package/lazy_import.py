@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deferred module imports.
+
+Heavy or hardware-specific dependencies (OpenCV, LJM, h5py, matplotlib...) are imported on first
+use rather than when a lab_package module is loaded, so e.g. the protocol module loads on a machine
+without LJM installed, and client/server startup does not pay for code paths that never run.
+"""
+import importlib
+import threading
+
+
+class LazyModule():
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    :name: full module name, e.g. 'labjack.ljm'
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with self.__dict__['_lock']:
+                module = self.__dict__['_module']
+                if module is None:
+                    module = importlib.import_module(self.__dict__['_name'])
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return "<LazyModule '{}' ({})>".format(self.__dict__['_name'], state)
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+def lazy_attributes(module_globals, attributes):
+    """
+    Build a module-level __getattr__ (PEP 562) that imports attributes on first access
+    and stores them in the module namespace.
+
+    module_globals: globals() of the calling module
+    attributes: dict mapping attribute name -> (module name, attribute in that module or None for the module itself)
+    """
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError("module '{}' has no attribute '{}'".format(module_globals['__name__'], name))
+        module_name, attr = attributes[name]
+        value = importlib.import_module(module_name)
+        if attr is not None:
+            value = getattr(value, attr)
+        module_globals[name] = value
+        return value
+    return __getattr__
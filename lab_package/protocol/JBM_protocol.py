@@ -1,5 +1,7 @@
 from lab_package.protocol import base_protocol
-import cv2
+from lab_package.stimulus.baccus import util
+from lab_package.stimulus.baccus.noise import WhiteNoiseFrames
+from lab_package.stimulus.baccus import cache
 from visprotocol import protocol as vpprotocol
 from flystim.util import generate_lowercase_barcode
 
@@ -8,8 +10,80 @@ class BaseProtocol(base_protocol.BaseProtocol):
         super().__init__(cfg)  # call the parent class init method
 
 
+class PixMapProtocol(BaseProtocol, vpprotocol.SharedPixMapProtocol):
+    """
+    Shared pixmap protocol that can render the next epoch's frames in the background.
+
+    If protocol parameter 'prefetch_frames' is True, the run's epochs are precompiled in prepare_run, so the
+    parameters of epoch n+1 are known during epoch n. After loading the stimuli of epoch n, the server is asked to
+    render the frames of epoch n+1 into its stimulus cache (see SharedPixMapServer.prefetch) while epoch n plays out.
+    """
+    def __init__(self, cfg):
+        super().__init__(cfg)
+
+        self.next_memname = generate_lowercase_barcode(10)
+
+    def make_shared_pixmap_stim_parameters(self, **parameters):
+        """
+        Shared pixmap stimulus parameters. With protocol parameter 'use_stimulus_cache' (default True), the stimulus
+        is marked to be served from the server's stimulus cache (see MagnetoServer.load_shared_pixmap_stim).
+        Servers other than MagnetoServer need use_stimulus_cache False.
+        """
+        if self.protocol_parameters.get('use_stimulus_cache', True):
+            parameters['stimulus_cache'] = True
+        return parameters
+
+    def get_next_memname(self):
+        memname = self.next_memname
+        self.next_memname = generate_lowercase_barcode(10)
+        return memname
+
+    def prepare_run(self, *args, **kwargs):
+        super().prepare_run(*args, **kwargs)
+        # The next epoch's frames can only be prefetched if its parameters are known ahead of time
+        if self.protocol_parameters.get('prefetch_frames', False) and self.precompiled_epochs is None:
+            self.precompile_epoch_schedule()
+
+    def get_next_epoch_shared_pixmap_stim_parameters(self):
+        """
+        Shared pixmap parameters of the next epoch, from the precompiled epochs.
+        returns: None without precompiled epochs, or during the last epoch of the run
+        """
+        if self.precompiled_epochs is None:
+            return None
+        next_epoch = self.get_precompiled_epoch(self.num_epochs_completed + 1)
+        if next_epoch is None:
+            return None
+        return dict(next_epoch['epoch_shared_pixmap_stim_parameters'])
+
+    def get_frames(self, shared_pixmap_stim_parameters, stimulus_cache=None):
+        return cache.get_pixmap_frames(shared_pixmap_stim_parameters, stimulus_cache=stimulus_cache)
+
+    def get_epoch_frames(self, stimulus_cache=None):
+        """
+        Rendered frames for the current epoch, served from the on-disk stimulus cache.
+        """
+        return self.get_frames(self.epoch_shared_pixmap_stim_parameters, stimulus_cache=stimulus_cache)
+
+    def load_stimuli(self, client, *args, **kwargs):
+        super().load_stimuli(client, *args, **kwargs)
+        self.prefetch_next_epoch(client)
+
+    def prefetch_next_epoch(self, client):
+        """
+        Ask the server to render the next epoch's frames into its stimulus cache. Rendering errors are
+        logged by the server, and raised when the epoch is loaded.
+        """
+        if self.precompiling or not self.protocol_parameters.get('prefetch_frames', False):
+            return
+        next_parameters = self.get_next_epoch_shared_pixmap_stim_parameters()
+        if next_parameters is None or not next_parameters.pop('stimulus_cache', False):
+            return
+        client.manager.prefetch_shared_pixmap_stim(**next_parameters)
+
+
 # %% # # # SIMPLE SYNTHETIC STIMS # # # # # # # # #
-class MovieFilePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
+class MovieFilePixMap(PixMapProtocol):
     def __init__(self, cfg):
         super().__init__(cfg)
 
@@ -19,20 +93,23 @@ class MovieFilePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
     def get_epoch_parameters(self):
         super().get_epoch_parameters()
 
-        self.epoch_protocol_parameters['memname'] = generate_lowercase_barcode(10)
-
-        filepath = self.protocol_parameters['filepath']
-        cap = cv2.VideoCapture(filepath)
-        ret,frame = cap.read()
+        self.epoch_protocol_parameters['memname'] = self.get_next_memname()
 
-        frame_shape = frame.shape
+        # Frames are resized to protocol parameter 'frame_shape' (h, w) by the stimulus cache, else shown at the movie's size
+        resize = self.protocol_parameters.get('frame_shape') is not None and self.protocol_parameters.get('use_stimulus_cache', True)
+        if resize:
+            frame_shape = tuple(int(x) for x in self.protocol_parameters['frame_shape'][:2]) + (3,)
+        else:
+            frame_shape = util.get_video_dim(self.protocol_parameters['filepath'])
 
-        self.epoch_shared_pixmap_stim_parameters = {'name': 'StreamMovie',
-                                                    'memname': self.epoch_protocol_parameters['memname'],
-                                                    'filepath': self.protocol_parameters['filepath'],
-                                                    'nominal_frame_rate': self.epoch_protocol_parameters['frame_rate'],
-                                                    'duration': self.epoch_protocol_parameters['stim_time'],
-                                                    'start_frame': self.epoch_protocol_parameters['start_frame']}
+        self.epoch_shared_pixmap_stim_parameters = self.make_shared_pixmap_stim_parameters(name='StreamMovie',
+                                                                                           memname=self.epoch_protocol_parameters['memname'],
+                                                                                           filepath=self.protocol_parameters['filepath'],
+                                                                                           nominal_frame_rate=self.epoch_protocol_parameters['frame_rate'],
+                                                                                           duration=self.epoch_protocol_parameters['stim_time'],
+                                                                                           start_frame=self.epoch_protocol_parameters['start_frame'])
+        if resize:
+            self.epoch_shared_pixmap_stim_parameters['frame_shape'] = frame_shape
 
         self.epoch_stim_parameters = {'name': 'PixMap',
                                       'memname': self.epoch_protocol_parameters['memname'],
@@ -43,7 +120,6 @@ class MovieFilePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
                                       'n_steps': self.epoch_protocol_parameters['render_n_steps'],
                                       'surface': self.epoch_protocol_parameters['render_surface']}
 
-
     def get_protocol_parameter_defaults(self):
         return {'pre_time': 1.0,
                 'stim_time': 4.0,
@@ -51,10 +127,13 @@ class MovieFilePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
                 'start_frame': 1000,
                 'angular_width': 360,
                 'filepath': '/home/baccuslab/Videos/threesixty.mp4', 
+                'frame_shape': None,  # (h, w) to resize frames to, with the stimulus cache. None for the movie's size
                 'frame_rate': 10.0,
                 'render_n_steps': 16,
                 'render_surface': 'spherical', # cylindrical, cylindrical_with_phi
                 'render_radius': 1,
+                'prefetch_frames': False,
+                'use_stimulus_cache': True,
                 }
 
     def get_run_parameter_defaults(self):
@@ -63,9 +142,12 @@ class MovieFilePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
                 'all_combinations': True,
                 'randomize_order': True}
 
-class WhiteNoisePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
+class WhiteNoisePixMap(PixMapProtocol):
     """
-    Drifting square wave grating, painted on a cylinder
+    White noise pixmap. With protocol parameter 'use_stimulus_cache' True (default), frames come from
+    lab_package.stimulus.baccus.noise.WhiteNoiseFrames via the server's stimulus cache (needs MagnetoServer),
+    so get_noise_source regenerates what was shown. With it False, flystim's own WhiteNoise generator is used,
+    which draws different frames for the same seed.
     """
     def __init__(self, cfg):
         super().__init__(cfg)
@@ -76,17 +158,17 @@ class WhiteNoisePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
     def get_epoch_parameters(self):
         super().get_epoch_parameters()
 
-        self.epoch_protocol_parameters['memname'] = generate_lowercase_barcode(10)
+        self.epoch_protocol_parameters['memname'] = self.get_next_memname()
         # print(f"Created memname: {self.epoch_protocol_parameters['memname']}")
 
         frame_shape = (int(self.epoch_protocol_parameters['boxes_h']), int(self.epoch_protocol_parameters['boxes_w']), 3)
 
-        self.epoch_shared_pixmap_stim_parameters = {'name': 'WhiteNoise',
-                                                    'memname': self.epoch_protocol_parameters['memname'],
-                                                    'frame_shape': frame_shape,
-                                                    'nominal_frame_rate': self.epoch_protocol_parameters['frame_rate'],
-                                                    'dur': self.epoch_protocol_parameters['stim_time'],
-                                                    'seed': self.epoch_protocol_parameters['seed']}
+        self.epoch_shared_pixmap_stim_parameters = self.make_shared_pixmap_stim_parameters(name='WhiteNoise',
+                                                                                           memname=self.epoch_protocol_parameters['memname'],
+                                                                                           frame_shape=frame_shape,
+                                                                                           nominal_frame_rate=self.epoch_protocol_parameters['frame_rate'],
+                                                                                           dur=self.epoch_protocol_parameters['stim_time'],
+                                                                                           seed=self.epoch_protocol_parameters['seed'])
 
         self.epoch_stim_parameters = {'name': 'PixMap',
                                       'memname': self.epoch_protocol_parameters['memname'],
@@ -97,6 +179,14 @@ class WhiteNoisePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
                                       'n_steps': self.epoch_protocol_parameters['render_n_steps'],
                                       'surface': self.epoch_protocol_parameters['render_surface']}
 
+    def get_noise_source(self):
+        """
+        Seekable white noise source for the current epoch, e.g. to regenerate frames offline.
+        Only matches the presented frames if they were served from the stimulus cache.
+        """
+        return WhiteNoiseFrames(frame_shape=self.epoch_shared_pixmap_stim_parameters['frame_shape'],
+                                seed=self.epoch_shared_pixmap_stim_parameters['seed'],
+                                frame_rate=self.epoch_shared_pixmap_stim_parameters['nominal_frame_rate'])
 
     def get_protocol_parameter_defaults(self):
         return {'pre_time': 1.0,
@@ -110,6 +200,8 @@ class WhiteNoisePixMap(BaseProtocol, vpprotocol.SharedPixMapProtocol):
                 'render_n_steps': 16,
                 'render_surface': 'spherical', # cylindrical, cylindrical_with_phi
                 'render_radius': 1,
+                'prefetch_frames': False,
+                'use_stimulus_cache': True,
                 }
 
     def get_run_parameter_defaults(self):
@@ -228,12 +320,29 @@ class SyncPulse(BaseProtocol):
         self.epoch_stim_parameters = {'name': 'SyncPulse',
                                       'color': [1.0, 1.0, 1.0, 1.0]}
 
+    def setup_epoch_daq(self, daq_device):
+        """
+        With protocol parameter 'daq_output_channel' set, the DAQ also plays a pulse train on that channel while
+        the sync pulse is on, e.g. to check the photodiode against the DAQ clock.
+        """
+        if self.protocol_parameters.get('daq_output_channel') is None:
+            return
+        daq_device.setup_pulse_wave_stream_out(output_channel=self.protocol_parameters['daq_output_channel'],
+                                               freq=self.protocol_parameters['daq_pulse_freq'],
+                                               amp=self.protocol_parameters['daq_pulse_amp'],
+                                               pulse_width=self.protocol_parameters['daq_pulse_width'])
+        daq_device.stream_with_timing(pre_time=self.protocol_parameters['pre_time'],
+                                      stim_time=self.protocol_parameters['stim_time'])
 
     def get_protocol_parameter_defaults(self):
         return {'pre_time': 1.0,
                 'stim_time': 1.0,
                 'tail_time': 1.0,
-                'color': [1, 1, 1, 1]}
+                'color': [1, 1, 1, 1],
+                'daq_output_channel': None,  # e.g. 'DAC0'
+                'daq_pulse_freq': 10.0,
+                'daq_pulse_amp': 2.5,
+                'daq_pulse_width': 0.01}
 
     def get_run_parameter_defaults(self):
         return {'num_epochs': 5,
@@ -10,14 +10,167 @@ Protocol parent class. Override any methods in here in the user protocol subclas
 -epoch_stim_parameters: parameter set used to define flystim stimulus
                      *saved as attributes at the individual epoch level
 """
+import copy
+import functools
 from visprotocol import protocol
 from time import sleep
 import flyrpc
+from flyrpc.multicall import MyMultiCall
+
+from lab_package.protocol.schedule import EpochSchedule
+
+# Per-epoch attributes set by get_epoch_parameters that are stored by precompile_epoch_schedule
+PRECOMPILED_EPOCH_ATTRIBUTES = ('epoch_protocol_parameters', 'epoch_stim_parameters', 'epoch_shared_pixmap_stim_parameters')
+
+
+def use_precompiled_epochs(get_epoch_parameters):
+    """
+    Wrap a get_epoch_parameters method so that, once the run's epochs are precompiled, it hands out the
+    stored epoch instead. Applied to every get_epoch_parameters override (see BaseProtocol.__init_subclass__).
+    """
+    @functools.wraps(get_epoch_parameters)
+    def wrapper(self):
+        if self.precompiled_epochs is not None and not self.precompiling:
+            return self.get_precompiled_epoch_parameters()
+        return get_epoch_parameters(self)
+    return wrapper
+
 
 class BaseProtocol(protocol.BaseProtocol):
     def __init__(self, cfg):
         super().__init__(cfg)  # call the parent class init method
 
+        self.epoch_schedule = None
+        self.epoch_schedule_seed = None
+        self.replay_epoch_schedule = False
+        self.precompiled_epochs = None
+        self.precompiling = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'get_epoch_parameters' in cls.__dict__:
+            cls.get_epoch_parameters = use_precompiled_epochs(cls.__dict__['get_epoch_parameters'])
+
+    def prepare_run(self, *args, **kwargs):
+        """
+        A precompiled epoch schedule is compiled again for each run, so that per-epoch values such as
+        shared memory names are not reused. A schedule built from the parameters is drawn again (with
+        the same seed, if one was given), and a schedule passed to precompile_epoch_schedule is replayed.
+        """
+        super().prepare_run(*args, **kwargs)
+        if self.epoch_schedule is not None:
+            self.precompile_epoch_schedule(schedule=self.epoch_schedule if self.replay_epoch_schedule else None,
+                                           seed=self.epoch_schedule_seed)
+
+    @use_precompiled_epochs
+    def get_epoch_parameters(self):
+        """
+        With an epoch schedule, the epoch protocol parameters are taken from it instead of drawn by visprotocol.
+        """
+        if self.epoch_schedule is None:
+            return super().get_epoch_parameters()
+        self.epoch_protocol_parameters = self.epoch_schedule.get_epoch_protocol_parameters(self.num_epochs_completed % len(self.epoch_schedule))
+
+    def load_stimuli(self, client, multicall=None):
+        """
+        Per-epoch DAQ commands (see setup_epoch_daq) go out in the same multicall as the stimulus load.
+        If no multicall is given, one is made here and sent once both are added (see DAQonServer.batch).
+        """
+        daq_device = getattr(client, 'daq_device', None)
+        if not hasattr(daq_device, 'batch'):
+            return super().load_stimuli(client, multicall)
+
+        send_multicall = multicall is None
+        if send_multicall:
+            multicall = MyMultiCall(client.manager)
+        with daq_device.batch(multicall=multicall):
+            self.setup_epoch_daq(daq_device)
+        super().load_stimuli(client, multicall)
+        if send_multicall:
+            multicall()
+
+    def setup_epoch_daq(self, daq_device):
+        """
+        Override to issue this epoch's DAQ commands, e.g. daq_device.setup_pulse_wave_stream_out(...) and
+        daq_device.stream_with_timing(...). Called from load_stimuli with the commands batched.
+        """
+        pass
+
+    def precompile_epoch_schedule(self, schedule=None, seed=None):
+        """
+        Build the whole run's epoch schedule (see protocol/schedule.py), and run this protocol's
+        get_epoch_parameters once per epoch ahead of time. Afterwards, get_epoch_parameters hands out
+        the stored parameter dicts in O(1), and prepare_run compiles them again for each run. Call again after changing protocol or run parameters,
+        or clear_epoch_schedule() to go back to drawing epochs one at a time.
+
+        schedule: EpochSchedule to replay, e.g. EpochSchedule.read() from a saved run. Built from the current parameters if None
+        seed: seed for visprotocol's draws (randomize_order) when building
+        returns: the EpochSchedule
+        """
+        self.clear_epoch_schedule()
+        self.replay_epoch_schedule = schedule is not None
+        self.epoch_schedule_seed = seed
+        if schedule is None:
+            schedule = EpochSchedule.record(self.protocol_parameters, self.run_parameters['num_epochs'],
+                                            self.draw_epoch_protocol_parameters, seed=seed)
+        self.epoch_schedule = schedule
+
+        num_epochs_completed = getattr(self, 'num_epochs_completed', 0)
+        precompiled_epochs = []
+        self.precompiling = True
+        try:
+            for epoch_index in range(len(schedule)):
+                self.num_epochs_completed = epoch_index
+                self.get_epoch_parameters()
+                precompiled_epochs.append({name: copy.deepcopy(getattr(self, name)) for name in PRECOMPILED_EPOCH_ATTRIBUTES if hasattr(self, name)})
+        finally:
+            self.num_epochs_completed = num_epochs_completed
+            self.precompiling = False
+
+        self.precompiled_epochs = precompiled_epochs
+        return schedule
+
+    def draw_epoch_protocol_parameters(self, epoch_index):
+        """
+        Epoch protocol parameters that visprotocol's own selection draws for epoch epoch_index, leaving
+        this protocol's epoch state as it was. Called in epoch order by EpochSchedule.record.
+        """
+        num_epochs_completed = getattr(self, 'num_epochs_completed', 0)
+        epoch_attributes = {name: getattr(self, name) for name in PRECOMPILED_EPOCH_ATTRIBUTES if hasattr(self, name)}
+        try:
+            self.num_epochs_completed = epoch_index
+            protocol.BaseProtocol.get_epoch_parameters(self)
+            return dict(self.epoch_protocol_parameters)
+        finally:
+            self.num_epochs_completed = num_epochs_completed
+            for name, value in epoch_attributes.items():
+                setattr(self, name, value)
+
+    def clear_epoch_schedule(self):
+        self.epoch_schedule = None
+        self.precompiled_epochs = None
+
+    def get_precompiled_epoch(self, epoch_index):
+        """
+        returns: stored attributes of epoch epoch_index, or None past the end of the run
+        """
+        if epoch_index >= len(self.precompiled_epochs):
+            return None
+        return self.precompiled_epochs[epoch_index]
+
+    def get_precompiled_epoch_parameters(self):
+        # Epochs past num_epochs, e.g. of a run that is extended, repeat the schedule as get_epoch_parameters does
+        epoch = self.precompiled_epochs[self.num_epochs_completed % len(self.precompiled_epochs)]
+        for name, value in epoch.items():
+            setattr(self, name, dict(value) if isinstance(value, dict) else value)
+
+    def write_epoch_schedule(self, data):
+        """
+        Save the epoch schedule (order, hash and seed) into the current epoch run of data (lab_package.data.Data), to replay the run later.
+        """
+        if self.epoch_schedule is not None:
+            self.epoch_schedule.write(data)
+
     def get_moving_spot_parameters(self, center=None, angle=None, speed=None, radius=None, color=None, distance_to_travel=None, render_on_cylinder=None):
         if radius is None: radius = self.epoch_protocol_parameters['radius']
         return self.get_moving_patch_parameters(center=center, angle=angle, speed=speed, width=radius*2, height=radius*2, color=color, distance_to_travel=distance_to_travel, ellipse=True, render_on_cylinder=render_on_cylinder)
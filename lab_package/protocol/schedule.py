@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precompiled epoch schedules.
+
+With all_combinations and randomize_order, visprotocol draws each epoch's protocol parameters one at
+a time. EpochSchedule records visprotocol's own draws for the whole run once, from a fixed seed, and
+stores the order as a structured array with one value index per varied parameter. The schedule has a
+stable hash, and can be saved into the data file and replayed without rerunning the RNG.
+
+Varied parameters are protocol parameters given as lists with more than one value. Tuples (e.g. a
+center) and single values are held constant, and single-element lists are unwrapped.
+"""
+import hashlib
+import json
+import random
+import numpy as np
+
+
+def get_varied_parameters(protocol_parameters):
+    """
+    Names of the protocol parameters that vary across epochs, in protocol_parameters order.
+    """
+    return [key for key, value in protocol_parameters.items() if isinstance(value, list) and len(value) > 1]
+
+
+class EpochSchedule():
+    """
+    :protocol_parameters: dict of protocol parameters, see get_varied_parameters
+    :order: structured array with one integer field per varied parameter, giving that parameter's value index for each epoch
+    :seed: seed the order was drawn with (None if unknown)
+    """
+    def __init__(self, protocol_parameters, order, seed=None):
+        self.protocol_parameters = dict(protocol_parameters)
+        self.varied_parameters = get_varied_parameters(self.protocol_parameters)
+        self.order = order
+        self.seed = seed
+
+        self.constant_parameters = {key: (value[0] if isinstance(value, list) and len(value) == 1 else value)
+                                    for key, value in self.protocol_parameters.items() if key not in self.varied_parameters}
+        self.hash = self.compute_hash()
+
+    @classmethod
+    def record(cls, protocol_parameters, num_epochs, draw_epoch_protocol_parameters, seed=None):
+        """
+        Draw the epoch order by running the parameter selection once per epoch, with the random
+        and numpy.random global RNGs seeded, and restored afterwards.
+
+        draw_epoch_protocol_parameters: function of the epoch index returning that epoch's protocol
+            parameters, e.g. BaseProtocol.draw_epoch_protocol_parameters (visprotocol's selection)
+        seed: seeds the draws. Drawn from fresh entropy and kept in self.seed if None
+        """
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2**32)
+        varied_parameters = get_varied_parameters(protocol_parameters)
+        n_values = [len(protocol_parameters[key]) for key in varied_parameters]
+        index_dtype = np.int16 if max(n_values, default=1) < 2**15 else np.int32
+        order = np.zeros(num_epochs, dtype=[(key, index_dtype) for key in varied_parameters])
+
+        random_state, np_random_state = random.getstate(), np.random.get_state()
+        random.seed(seed)
+        np.random.seed(seed)
+        try:
+            for epoch_index in range(num_epochs):
+                epoch_protocol_parameters = draw_epoch_protocol_parameters(epoch_index)
+                for key in varied_parameters:
+                    order[key][epoch_index] = protocol_parameters[key].index(epoch_protocol_parameters[key])
+        finally:
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
+        return cls(protocol_parameters, order, seed=seed)
+
+    def __len__(self):
+        return self.order.shape[0]
+
+    def compute_hash(self):
+        """
+        sha256 over the parameter values and the epoch order, stable across processes and platforms.
+        """
+        description = json.dumps({'protocol_parameters': self.protocol_parameters,
+                                  'varied_parameters': self.varied_parameters,
+                                  'order': {key: self.order[key].tolist() for key in self.varied_parameters}},
+                                 sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get_epoch_protocol_parameters(self, epoch_index):
+        """
+        Protocol parameters of epoch epoch_index (counting from 0), with one value per varied parameter.
+        """
+        epoch_protocol_parameters = dict(self.constant_parameters)
+        row = self.order[epoch_index]
+        for key in self.varied_parameters:
+            epoch_protocol_parameters[key] = self.protocol_parameters[key][row[key]]
+        return epoch_protocol_parameters
+
+    def write(self, data, name='epoch_schedule', series_number=None):
+        """
+        Save the order into the epoch run group of data (lab_package.data.Data), with the hash, seed and parameters as attributes.
+        """
+        attrs = {'hash': self.hash,
+                 'seed': 'None' if self.seed is None else self.seed,
+                 'protocol_parameters': json.dumps(self.protocol_parameters, sort_keys=True, default=str)}
+        # HDF5 compound types need at least one field
+        order = self.order if self.varied_parameters else np.zeros(len(self), dtype=[('no_varied_parameters', np.int8)])
+        data.append_to_epoch_run_dataset(name, order, attrs=attrs, series_number=series_number)
+
+    @classmethod
+    def read(cls, epoch_run_group, protocol_parameters, name='epoch_schedule'):
+        """
+        Load a saved schedule from an open h5py epoch run group, to replay it.
+        protocol_parameters must be the run's protocol parameters (the hash is checked against the saved one).
+        """
+        dataset = epoch_run_group[name]
+        order = dataset[:]
+        if order.dtype.names == ('no_varied_parameters',):
+            order = np.zeros(order.shape[0], dtype=[])
+        seed = dataset.attrs.get('seed', 'None')
+        schedule = cls(protocol_parameters, order, seed=None if seed == 'None' else int(seed))
+        saved_hash = dataset.attrs.get('hash')
+        if saved_hash is not None and saved_hash != schedule.hash:
+            raise ValueError('Epoch schedule hash does not match: the protocol parameters differ from the saved run')
+        return schedule
@@ -0,0 +1,348 @@
+"""
+On-disk cache of rendered pixmap stimuli.
+
+Each entry is a uint8 frame stack of shape (n_frames, h, w, c) stored as a .npy file, keyed by
+(source, frame shape, frame rate, start frame, duration). The source is a movie filepath or a
+white noise seed. Entries are written once and served as read-only memory maps, so repeated
+epochs read from the page cache instead of decoding again. The least recently used entries
+are evicted when the cache grows past max_bytes.
+
+SharedPixMapServer serves cached frames to the screens: it copies an entry into the shared memory
+block (memname) that flystim's PixMap stimulus reads, in place of flystim generating the frames
+itself. See MagnetoServer, which routes shared pixmap stimuli marked 'stimulus_cache' through it.
+"""
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+from lab_package.lazy_import import lazy_import
+from lab_package.stimulus.baccus import util
+from lab_package.stimulus.baccus.noise import WhiteNoiseFrames
+
+CACHE_DIRNAME = 'stimulus_cache'
+DEFAULT_MAX_BYTES = 50 * 2**30
+
+PAGE_SIZE = 4096
+
+cv2 = lazy_import('cv2')
+
+_default_cache = None
+_default_prefetcher = None
+
+
+class StimulusCache():
+    """
+    :cache_dir: directory for cached .npy files. Defaults to resources/stimulus_cache
+    :max_bytes: total size of cached files above which least recently used entries are evicted
+    """
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        if cache_dir is None:
+            cache_dir = os.path.join(util.get_resource_dir(), CACHE_DIRNAME)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(source, frame_shape, frame_rate, start_frame, duration):
+        """
+        Hash the cache key. For movie sources, the file's mtime and size are included
+        so that an edited file does not hit a stale entry.
+        """
+        source_id = source
+        if isinstance(source, str) and os.path.exists(source):
+            stat = os.stat(source)
+            source_id = (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+        key = repr((source_id, tuple(int(x) for x in frame_shape), float(frame_rate), int(start_frame), float(duration)))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """
+        Return the cached frame stack for key as a read-only memmap, or None on a miss.
+        """
+        path = self.get_path(key)
+        try:
+            frames = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return frames
+
+    def put(self, key, n_frames, frame_shape, render_fn):
+        """
+        Create the entry for key and fill it with render_fn, then return it as a read-only memmap.
+
+        render_fn: callable that takes the writable (n_frames,) + frame_shape uint8 memmap and fills it
+        """
+        path = self.get_path(key)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(int(n_frames),) + tuple(frame_shape))
+        try:
+            render_fn(out)
+            out.flush()
+        except BaseException:
+            del out
+            os.remove(tmp_path)
+            raise
+        del out
+        os.replace(tmp_path, path)
+
+        self.evict(keep=key)
+        return np.load(path, mmap_mode='r')
+
+    def get_or_render(self, source, frame_shape, frame_rate, start_frame, duration, render_fn):
+        key = self.make_key(source, frame_shape, frame_rate, start_frame, duration)
+        with self.lock:
+            frames = self.get(key)
+            if frames is None:
+                n_frames = int(np.floor(duration * frame_rate))
+                frames = self.put(key, n_frames, frame_shape, render_fn)
+        return frames
+
+    def get_movie_frames(self, filepath, frame_rate, start_frame, duration, frame_shape=None):
+        """
+        Frames [start_frame, start_frame + duration*frame_rate) of a movie, as RGB uint8.
+        frame_shape ((h, w) or (h, w, 3)) defaults to the shape of the movie; otherwise frames are resized to it,
+        and cached separately for each shape.
+        """
+        if frame_shape is None:
+            frame_shape = util.get_video_dim(filepath)
+        frame_shape = tuple(frame_shape[:2]) + (3,)
+        render_fn = lambda out: render_movie_frames(out, filepath, start_frame)
+        return self.get_or_render(filepath, frame_shape, frame_rate, start_frame, duration, render_fn)
+
+    def get_white_noise_frames(self, seed, frame_shape, frame_rate, duration, start_frame=0):
+        noise = WhiteNoiseFrames(frame_shape=frame_shape, seed=seed, frame_rate=frame_rate)
+        render_fn = lambda out: render_white_noise_frames(out, noise, start_frame)
+        return self.get_or_render(('white_noise', int(seed)), frame_shape, frame_rate, start_frame, duration, render_fn)
+
+    def list_entries(self):
+        """
+        Return [(path, size in bytes, last used time)] for all entries, least recently used first.
+        """
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def total_bytes(self):
+        return sum([e[1] for e in self.list_entries()])
+
+    def evict(self, max_bytes=None, keep=None):
+        """
+        Delete least recently used entries until the cache is at most max_bytes.
+        The entry for key keep is never evicted.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.list_entries()
+        total = sum([e[1] for e in entries])
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            if keep is not None and path == self.get_path(keep):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+
+class StimulusPrefetcher():
+    """
+    Renders cache entries on a background worker thread, then reads one byte per page of the
+    resulting memmap so that the frames are resident in the page cache when the epoch starts.
+    """
+    def __init__(self, max_workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stimulus_prefetch')
+
+    def submit(self, get_frames_fn, *args, **kwargs):
+        """
+        get_frames_fn: callable that returns a frame stack, e.g. StimulusCache.get_movie_frames
+        returns: future that resolves to the frame stack
+        """
+        def prefetch_helper():
+            frames = get_frames_fn(*args, **kwargs)
+            warm_page_cache(frames)
+            return frames
+        return self.executor.submit(prefetch_helper)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def warm_page_cache(frames):
+    flat = frames.reshape(-1)
+    if flat.size > 0:
+        int(flat[::PAGE_SIZE].sum())
+
+def render_movie_frames(out, filepath, start_frame=0):
+    """
+    Decode consecutive frames of a movie starting at start_frame into out, converting to RGB
+    and resizing to out.shape[1:3] if needed. If the movie ends early, the remaining frames
+    are filled with its last decoded frame.
+    """
+    n_frames, height, width = out.shape[:3]
+    cap = cv2.VideoCapture(filepath)
+    try:
+        assert cap.isOpened(), 'Could not open video at {}'.format(filepath)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        for i in range(n_frames):
+            ret, frame = cap.read()
+            if not ret:
+                assert i > 0, 'Could not decode frame {} of video at {}'.format(start_frame, filepath)
+                out[i:] = out[i-1]
+                break
+            if frame.shape[:2] != (height, width):
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            out[i] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        cap.release()
+
+def render_white_noise_frames(out, noise, start_frame=0):
+    stop = start_frame + out.shape[0]
+    for first_frame, frames in noise.iter_blocks(start=start_frame, stop=stop):
+        out[first_frame - start_frame:first_frame - start_frame + frames.shape[0]] = frames
+
+def get_pixmap_frames(shared_pixmap_stim_parameters, stimulus_cache=None):
+    """
+    Frames of a shared pixmap stimulus from the stimulus cache, rendered on a miss.
+
+    shared_pixmap_stim_parameters: parameters as sent to the server, e.g. PixMapProtocol.epoch_shared_pixmap_stim_parameters.
+                                   'StreamMovie' and 'WhiteNoise' stimuli are supported
+    """
+    if stimulus_cache is None:
+        stimulus_cache = get_default_cache()
+    parameters = shared_pixmap_stim_parameters
+    if parameters['name'] == 'StreamMovie':
+        return stimulus_cache.get_movie_frames(filepath=parameters['filepath'],
+                                               frame_rate=parameters['nominal_frame_rate'],
+                                               start_frame=parameters['start_frame'],
+                                               duration=parameters['duration'],
+                                               frame_shape=parameters.get('frame_shape'))
+    if parameters['name'] == 'WhiteNoise':
+        return stimulus_cache.get_white_noise_frames(seed=parameters['seed'],
+                                                     frame_shape=parameters['frame_shape'],
+                                                     frame_rate=parameters['nominal_frame_rate'],
+                                                     duration=parameters['dur'])
+    raise ValueError('No cached frames for shared pixmap stimulus {}'.format(parameters['name']))
+
+def get_pixmap_key(shared_pixmap_stim_parameters):
+    """
+    Identifies the frames of a shared pixmap stimulus: its parameters without the memname.
+    """
+    parameters = {key: value for key, value in shared_pixmap_stim_parameters.items() if key not in ('memname', 'stimulus_cache')}
+    return json.dumps(parameters, sort_keys=True, default=str)
+
+
+class SharedPixMapServer():
+    """
+    Loads cached frames into the shared memory blocks read by flystim's PixMap stimulus.
+    Frames are laid out as (n_frames,) + frame_shape uint8, as written by flystim's shared pixmap stimuli,
+    followed by one copy of the last frame so that a read at the very end of the stimulus stays in bounds.
+
+    :stimulus_cache: defaults to get_default_cache()
+    :keep: number of most recently loaded blocks kept. Older ones are unlinked
+    """
+    def __init__(self, stimulus_cache=None, keep=2):
+        self.stimulus_cache = get_default_cache() if stimulus_cache is None else stimulus_cache
+        self.keep = keep
+        self.prefetcher = StimulusPrefetcher()
+        self.lock = threading.Lock()
+        self.blocks = []  # (memname, SharedMemory), oldest first
+        self.prefetch_futures = {}  # get_pixmap_key -> Future
+
+    def prefetch(self, **shared_pixmap_stim_parameters):
+        """
+        Render the frames of a later epoch into the cache in the background. Returns the Future.
+        """
+        key = get_pixmap_key(shared_pixmap_stim_parameters)
+        with self.lock:
+            future = self.prefetch_futures.get(key)
+            if future is None:
+                # Finished prefetches are in the cache already, so a later load finds them without the future
+                self.prefetch_futures = {k: f for k, f in self.prefetch_futures.items() if not f.done()}
+                future = self.prefetcher.submit(get_pixmap_frames, shared_pixmap_stim_parameters, self.stimulus_cache)
+                future.add_done_callback(log_prefetch_error)
+                self.prefetch_futures[key] = future
+        return future
+
+    def load(self, memname, **shared_pixmap_stim_parameters):
+        """
+        Copy the stimulus frames into a new shared memory block named memname, waiting for a pending prefetch of
+        the same frames. Errors from rendering are raised here.
+        returns: shape of the frames
+        """
+        shared_pixmap_stim_parameters.pop('stimulus_cache', None)
+        with self.lock:
+            future = self.prefetch_futures.pop(get_pixmap_key(shared_pixmap_stim_parameters), None)
+        frames = future.result() if future is not None else get_pixmap_frames(shared_pixmap_stim_parameters, self.stimulus_cache)
+
+        n_frames = frames.shape[0]
+        if n_frames == 0:
+            raise ValueError('Shared pixmap stimulus {} has no frames'.format(memname))
+        block = shared_memory.SharedMemory(name=memname, create=True, size=(n_frames + 1) * frames[0].nbytes)
+        out = np.ndarray((n_frames + 1,) + frames.shape[1:], dtype=np.uint8, buffer=block.buf)
+        out[:n_frames] = frames
+        out[n_frames] = frames[-1]
+        del out
+        with self.lock:
+            self.blocks.append((memname, block))
+            old_blocks, self.blocks = self.blocks[:-self.keep], self.blocks[-self.keep:]
+        for _, old_block in old_blocks:
+            release_block(old_block)
+        return frames.shape
+
+    def close(self):
+        """
+        Unlink all shared memory blocks and stop prefetching.
+        """
+        self.prefetcher.shutdown(wait=False)
+        with self.lock:
+            blocks, self.blocks = self.blocks, []
+            self.prefetch_futures = {}
+        for _, block in blocks:
+            release_block(block)
+
+
+def log_prefetch_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        print('Could not prefetch stimulus frames: {!r}'.format(future.exception()))
+
+def release_block(block):
+    block.close()
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+def get_default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = StimulusCache()
+    return _default_cache
+
+def get_default_prefetcher():
+    global _default_prefetcher
+    if _default_prefetcher is None:
+        _default_prefetcher = StimulusPrefetcher()
+    return _default_prefetcher
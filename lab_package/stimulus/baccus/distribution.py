@@ -1,4 +1,6 @@
 import numpy as np
-from flystim import distribution as fdistribution
+from lab_package.lazy_import import lazy_import
+
+fdistribution = lazy_import('flystim.distribution')
 
 
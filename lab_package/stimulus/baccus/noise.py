@@ -0,0 +1,110 @@
+import numpy as np
+from numpy.random import default_rng
+
+
+class WhiteNoiseFrames():
+    """
+    Deterministic, seekable source of white noise frames.
+
+    Frames are generated in blocks of block_size frames with one vectorized draw per block.
+    Each block has its own generator, seeded from (seed, block index), so any frame can be
+    regenerated without replaying the frames before it. The frame sequence is fully
+    determined by (seed, frame_shape, block_size, binary).
+
+    This is a stimulus source of its own: it does not reproduce the frames of flystim's
+    server-side 'WhiteNoise' shared pixmap generator for the same seed. Frames shown by
+    WhiteNoisePixMap are rendered from here (served by MagnetoServer from the stimulus cache),
+    so the recorded seed regenerates exactly what was presented.
+
+    :frame_shape: shape of one frame, e.g. (boxes_h, boxes_w, 3)
+    :seed: integer seed for the whole sequence
+    :frame_rate: (Hz) frame rate, used to convert times to frame indices
+    :block_size: number of frames generated per vectorized draw
+    :binary: if True frames are 0 or 255, otherwise uniform integers in [0, 255]
+    """
+    def __init__(self, frame_shape, seed=0, frame_rate=None, block_size=64, binary=False):
+        self.frame_shape = tuple(int(x) for x in frame_shape)
+        self.seed = int(seed)
+        self.frame_rate = frame_rate
+        self.block_size = int(block_size)
+        self.binary = binary
+
+        self._cached_block_index = None
+        self._cached_block = None
+
+    def get_block(self, block_index):
+        """
+        Return frames [block_index*block_size, (block_index+1)*block_size) as a uint8 array
+        of shape (block_size,) + frame_shape.
+        """
+        block_index = int(block_index)
+        if block_index != self._cached_block_index:
+            rng = default_rng([self.seed, block_index])
+            size = (self.block_size,) + self.frame_shape
+            if self.binary:
+                block = rng.integers(0, 2, size=size, dtype=np.uint8) * np.uint8(255)
+            else:
+                block = rng.integers(0, 256, size=size, dtype=np.uint8)
+            block.flags.writeable = False
+            self._cached_block_index = block_index
+            self._cached_block = block
+        return self._cached_block
+
+    def get_frame(self, frame_index):
+        """
+        Return frame number frame_index (read-only view into its block).
+        """
+        block_index, offset = divmod(int(frame_index), self.block_size)
+        return self.get_block(block_index)[offset]
+
+    def get_frames(self, start, stop):
+        """
+        Return frames [start, stop) as a new uint8 array of shape (stop-start,) + frame_shape.
+        """
+        start = int(start)
+        stop = int(stop)
+        frames = np.empty((max(stop - start, 0),) + self.frame_shape, dtype=np.uint8)
+        for block_start, block_stop, out_start in self._iter_block_spans(start, stop):
+            block_index = block_start // self.block_size
+            offset = block_start - block_index * self.block_size
+            n = block_stop - block_start
+            frames[out_start:out_start + n] = self.get_block(block_index)[offset:offset + n]
+        return frames
+
+    def iter_blocks(self, start=0, stop=None):
+        """
+        Yield (first_frame_index, frames) chunks covering frames [start, stop), aligned to block
+        boundaries. Yields forever if stop is None.
+        """
+        start = int(start)
+        while stop is None or start < stop:
+            block_index, offset = divmod(start, self.block_size)
+            n = self.block_size - offset if stop is None else min(self.block_size - offset, int(stop) - start)
+            yield start, self.get_block(block_index)[offset:offset + n]
+            start += n
+
+    def frame_index(self, t):
+        """
+        Index of the frame shown at time t (sec) after stimulus onset.
+        """
+        assert self.frame_rate is not None, 'frame_rate must be set to convert time to frame index'
+        return int(np.floor(t * self.frame_rate))
+
+    def get_frame_at_time(self, t):
+        return self.get_frame(self.frame_index(t))
+
+    def get_frames_for_duration(self, duration, start_time=0):
+        """
+        Return all frames shown between start_time and start_time + duration (sec).
+        """
+        start = self.frame_index(start_time)
+        return self.get_frames(start, start + int(np.floor(duration * self.frame_rate)))
+
+    def _iter_block_spans(self, start, stop):
+        out_start = 0
+        while start < stop:
+            block_end = (start // self.block_size + 1) * self.block_size
+            span_stop = min(block_end, stop)
+            yield start, span_stop, out_start
+            out_start += span_stop - start
+            start = span_stop
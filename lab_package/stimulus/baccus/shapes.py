@@ -1,4 +1,6 @@
 import numpy as np
 from math import radians
-from flystim import shapes as fshapes
-from flystim import util as futil
+from lab_package.lazy_import import lazy_import
+
+fshapes = lazy_import('flystim.shapes')
+futil = lazy_import('flystim.util')
@@ -5,9 +5,13 @@ from math import radians
 import numpy as np
 from numpy.random import default_rng
 
-from flystim import shapes as fshapes
-from flystim import stimuli as fstimuli
-from flystim.stimuli import BaseProgram
-from flystim.trajectory import make_as_trajectory, return_for_time_t
-from flystim.distribution import make_as_distribution
+from lab_package.lazy_import import lazy_attributes
+
+# flystim is loaded on first use of any of these names
+__getattr__ = lazy_attributes(globals(), {'fshapes': ('flystim.shapes', None),
+                                          'fstimuli': ('flystim.stimuli', None),
+                                          'BaseProgram': ('flystim.stimuli', 'BaseProgram'),
+                                          'make_as_trajectory': ('flystim.trajectory', 'make_as_trajectory'),
+                                          'return_for_time_t': ('flystim.trajectory', 'return_for_time_t'),
+                                          'make_as_distribution': ('flystim.distribution', 'make_as_distribution')})
 
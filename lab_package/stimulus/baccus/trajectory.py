@@ -1,26 +1,144 @@
+from bisect import bisect_right
+
 import numpy as np
-from scipy.interpolate import interp1d
 
 from flystim import trajectory as ftrajectory
+from lab_package.lazy_import import lazy_import
+
+interpolate = lazy_import('scipy.interpolate')
 
 class TVPairsBounded(ftrajectory.Trajectory):
     """
-    List of arbitrary time-value pairs. 
+    List of arbitrary time-value pairs.
     Values are optionally bounded by a lower and upper bound, and wrap around if they exceed the bounds.
 
     :tv_pairs: list of time, value tuples. [(t0, v0), (t1, v1), ..., (tn, vn)]
     :kind: interpolation type. See scipy.interpolate.interp1d for options.
     :bounds: lower and upper bounds for the value. (lower, upper) or None for no bounds.
+    :precompile_dt: (sec) if not None, tabulate the trajectory on a grid with this spacing between t0 and tn,
+                    plus the times t0..tn themselves, at construction, and evaluate by linear interpolation in the table
+                    (extrapolating linearly from its first and last segments).
+                    Otherwise, linear trajectories are evaluated piecewise with a binary search over the times,
+                    and other kinds go through interp1d.
+
+    getValue(t) evaluates at one time point, getValues(t_array) at many time points at once.
     """
-    def __init__(self, tv_pairs, kind='linear', fill_value='extrapolate', bounds=None):
+    def __init__(self, tv_pairs, kind='linear', fill_value='extrapolate', bounds=None, precompile_dt=None):
+        tv_pairs = sorted(tv_pairs, key=lambda tv: tv[0])
         times, values = zip(*tv_pairs)
-        values_interpolated = interp1d(times, values, kind=kind, fill_value=fill_value, axis=0)
-        
+
         if bounds is None:
-            self.getValue = values_interpolated
-        else:            
-            lo = min(*bounds)
-            hi = max(*bounds)
-            bound_range = hi - lo
-            self.getValue = lambda t: np.mod(values_interpolated(t) - lo, bound_range) + lo
+            self.lo = None
+            self.bound_range = None
+        else:
+            self.lo = min(*bounds)
+            self.bound_range = max(*bounds) - self.lo
+
+        self.extrapolate = isinstance(fill_value, str) and fill_value == 'extrapolate'
+        if precompile_dt is not None and len(times) > 1:
+            self.t0 = float(times[0])
+            self.t_end = float(times[-1])
+            self.inv_dt = 1.0 / precompile_dt
+            n_grid = int(np.ceil((self.t_end - self.t0) * self.inv_dt)) + 1
+            grid = self.t0 + np.arange(n_grid) * precompile_dt
+            grid[-1] = min(grid[-1], self.t_end)
+            # The time-value pairs go into the table too, so that interpolating in it does not cut corners
+            self.times = np.union1d(grid, np.asarray(times, dtype=float))
+            # Table index of the last table time at or before each grid time
+            self.grid_start_idx = (np.searchsorted(self.times, grid, side='right') - 1).tolist()
+            values_interpolated = interpolate.interp1d(times, values, kind=kind, fill_value=fill_value, axis=0)
+            self.values = np.asarray(values_interpolated(self.times), dtype=float)
+            self.mode = 'table'
+        elif kind == 'linear' and self.extrapolate and len(times) > 1:
+            self.times = np.asarray(times, dtype=float)
+            self.values = np.asarray(values, dtype=float)
+            self.mode = 'piecewise'
+        else:
+            self.mode = 'interp1d'
+
+        if self.mode == 'interp1d':
+            self.values_interpolated = interpolate.interp1d(times, values, kind=kind, fill_value=fill_value, axis=0)
+            if bounds is None:
+                self.getValue = self.values_interpolated
+            else:
+                self.getValue = lambda t: np.mod(self.values_interpolated(t) - self.lo, self.bound_range) + self.lo
+            return
+
+        # Scalar-valued trajectories are evaluated with plain floats, which is much cheaper per call than numpy scalars
+        self.scalar_values = self.values.ndim == 1
+        self.times_list = self.times.tolist()
+        self.values_list = self.values.tolist() if self.scalar_values else list(self.values)
+        self.last_idx = len(self.times_list) - 2
+
+        if self.mode == 'table':
+            self.getValue = self._get_value_table
+        else:
+            self.getValue = self._get_value_piecewise
+
+    def _get_value_piecewise(self, t):
+        if not np.isscalar(t):
+            return self.getValues(t)
+        i = bisect_right(self.times_list, t) - 1
+        if i < 0:
+            i = 0
+        elif i > self.last_idx:
+            i = self.last_idx
+        t_i = self.times_list[i]
+        v_i = self.values_list[i]
+        value = v_i + (self.values_list[i+1] - v_i) * ((t - t_i) / (self.times_list[i+1] - t_i))
+        return self._bound(value)
+
+    def _get_value_table(self, t):
+        if not np.isscalar(t):
+            return self.getValues(t)
+        if t < self.t0 or t > self.t_end:
+            self._check_in_range(t)
+            i = 0 if t < self.t0 else self.last_idx
+        else:
+            grid_idx = min(int((t - self.t0) * self.inv_dt), len(self.grid_start_idx) - 1)
+            i = self.grid_start_idx[grid_idx]
+            while i < self.last_idx and self.times_list[i+1] <= t:
+                i += 1
+            if i > self.last_idx:
+                i = self.last_idx
+        v_i = self.values_list[i]
+        value = v_i + (self.values_list[i+1] - v_i) * ((t - self.times_list[i]) / (self.times_list[i+1] - self.times_list[i]))
+        return self._bound(value)
+
+    def _check_in_range(self, t):
+        # As interp1d without extrapolation
+        if not self.extrapolate:
+            raise ValueError('Time {} is outside the trajectory range [{}, {}]'.format(t, self.t0, self.t_end))
+
+    def _bound(self, value):
+        if self.lo is None:
+            return value
+        if self.scalar_values and not isinstance(value, np.ndarray):
+            return (value - self.lo) % self.bound_range + self.lo
+        return np.mod(value - self.lo, self.bound_range) + self.lo
+
+    def getValues(self, t_array):
+        """
+        Evaluate the trajectory at many time points at once.
+
+        t_array: array of times (sec)
+        returns: array of values, shape t_array.shape + value shape
+        """
+        t_array = np.asarray(t_array, dtype=float)
+        if self.mode == 'interp1d':
+            values = self.values_interpolated(t_array)
+        else:
+            t_flat = t_array.reshape(-1)
+            idx = np.clip(np.searchsorted(self.times, t_flat, side='right') - 1, 0, self.last_idx)
+            frac = (t_flat - self.times[idx]) / (self.times[idx+1] - self.times[idx])
+            if not self.scalar_values:
+                frac = frac.reshape((-1,) + (1,) * (self.values.ndim - 1))
+            values = self.values[idx] + (self.values[idx+1] - self.values[idx]) * frac
+
+            if self.mode == 'table' and t_flat.size > 0 and (t_flat.min() < self.t0 or t_flat.max() > self.t_end):
+                self._check_in_range(t_flat.min() if t_flat.min() < self.t0 else t_flat.max())
+            values = values.reshape(t_array.shape + self.values.shape[1:])
 
+        if self.lo is None:
+            return values
+        return np.mod(values - self.lo, self.bound_range) + self.lo
@@ -1,23 +1,134 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import inspect
-import cv2
-import lab_package
-from flystim import util as futil
+from lab_package.lazy_import import lazy_import
+
+cv2 = lazy_import('cv2')
+futil = lazy_import('flystim.util')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.mpg', '.mpeg', '.wmv')
+
+# Video metadata, keyed by filepath. Each entry holds the (mtime, size) signature
+# of the file when it was probed, so edits to the file invalidate the entry.
+_video_metadata_cache = {}
+_video_metadata_lock = threading.Lock()
+
+def get_resource_dir():
+    # lab_package is a namespace package (no __init__.py), so it has no file to locate it by
+    return os.path.join(REPO_DIR, 'resources')
 
 def get_resource_path(resource_name):
-    path_to_resource = os.path.join(inspect.getfile(lab_package).split('lab_package')[0],
-                                    'lab_package',
-                                    'resources',
-                                    resource_name)
+    path_to_resource = os.path.join(get_resource_dir(), resource_name)
 
     assert os.path.exists(path_to_resource), 'Resource not found at {}'.format(path_to_resource)
 
     return path_to_resource
 
+def _decode_fourcc(fourcc):
+    return ''.join([chr((int(fourcc) >> 8 * i) & 0xFF) for i in range(4)])
+
+def _probe_video(filepath, max_reads=10):
+    """
+    Read video metadata from the container header. Frames are only decoded if the
+    header does not report a frame size, and then at most max_reads times.
+    """
+    cap = cv2.VideoCapture(filepath)
+    try:
+        assert cap.isOpened(), 'Could not open video at {}'.format(filepath)
+
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width > 0 and height > 0:
+            # OpenCV decodes to 3-channel BGR by default
+            shape = (height, width, 3)
+        else:
+            shape = None
+            for _ in range(max_reads):
+                ret, frame = cap.read()
+                if ret:
+                    shape = frame.shape
+                    break
+            assert shape is not None, 'Could not decode a frame from video at {} after {} reads'.format(filepath, max_reads)
+
+        return {'shape': shape,
+                'fps': cap.get(cv2.CAP_PROP_FPS),
+                'frame_count': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                'codec': _decode_fourcc(cap.get(cv2.CAP_PROP_FOURCC))}
+    finally:
+        cap.release()
+
+def get_video_metadata(filepath, max_reads=10):
+    """
+    Return metadata for a video file, probing the file only if it is not cached
+    or has changed (mtime or size) since it was last probed.
+
+    filepath: (str) path to the video file
+    max_reads: (int) max number of frames to decode if the header has no frame size
+    returns: dict with keys 'shape' (h, w, c), 'fps', 'frame_count' and 'codec' (fourcc str)
+    """
+    stat = os.stat(filepath)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _video_metadata_lock:
+        entry = _video_metadata_cache.get(filepath)
+    if entry is None or entry[0] != signature:
+        entry = (signature, _probe_video(filepath, max_reads=max_reads))
+        with _video_metadata_lock:
+            _video_metadata_cache[filepath] = entry
+
+    return dict(entry[1])
+
+def clear_video_metadata_cache():
+    with _video_metadata_lock:
+        _video_metadata_cache.clear()
+
 def get_video_dim(fileapth):
-    cap = cv2.VideoCapture(fileapth)
-    ret = False
-    while not ret:
-        ret, frame = cap.read()
-    return frame.shape
+    return get_video_metadata(fileapth)['shape']
+
+def find_video_files(directory, extensions=VIDEO_EXTENSIONS):
+    """
+    Recursively list video files under directory, sorted by path.
+    """
+    filepaths = []
+    for root, _, filenames in os.walk(directory):
+        for fn in filenames:
+            if fn.lower().endswith(extensions):
+                filepaths.append(os.path.join(root, fn))
+    return sorted(filepaths)
+
+def probe_videos(paths, max_workers=8, max_reads=10):
+    """
+    Probe many video files in parallel.
+
+    paths: (str or list) a directory (e.g. resources/), searched recursively for video files,
+            or a list of video file paths
+    max_workers: (int) number of probing threads
+    max_reads: (int) max number of frames to decode per file if the header has no frame size
+    returns: list of dicts, one row per file, in path order, with keys
+            'filepath', 'shape', 'fps', 'frame_count', 'duration' (sec), 'codec' and 'error'.
+            Files that could not be probed have 'error' set and None for the other fields.
+    """
+    if isinstance(paths, str):
+        filepaths = find_video_files(paths) if os.path.isdir(paths) else [paths]
+    else:
+        filepaths = list(paths)
+
+    def probe_helper(filepath):
+        row = {'filepath': filepath, 'shape': None, 'fps': None, 'frame_count': None,
+               'duration': None, 'codec': None, 'error': None}
+        try:
+            row.update(get_video_metadata(filepath, max_reads=max_reads))
+            if row['fps'] > 0 and row['frame_count'] > 0:
+                row['duration'] = row['frame_count'] / row['fps']
+        except Exception as e:
+            row['error'] = '{}: {}'.format(type(e).__name__, e)
+        return row
+
+    if len(filepaths) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(filepaths))) as executor:
+        return list(executor.map(probe_helper, filepaths))
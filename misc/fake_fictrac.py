@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Fake FicTrac: sends FicTrac-style "FT, ..." lines over UDP at a fixed frame rate, for benchmarking
+and testing the closed-loop managers without a camera. Frame counter, timestamp (ms since epoch),
+heading and position sit in the columns FtClosedLoopManager reads by default.
+
+Accepts FicTrac's command line (config file and -v level are ignored), so it can stand in for the
+FicTrac binary, e.g. FtManager(ft_bin='misc/fake_fictrac.py'). Like FicTrac, it writes a .dat and
+a .log file to the working directory and exits cleanly on SIGINT.
+
+Usage:
+    python misc/fake_fictrac.py [config] [-v LEVEL] [--port 33334] [--rate 100] [--drop_probability 0]
+"""
+import argparse
+import os
+import signal
+import socket
+import time
+import numpy as np
+
+N_COLS = 25
+FRAME_NUM_IDX = 0
+X_IDX = 14
+Y_IDX = 15
+THETA_IDX = 16
+TIMESTAMP_IDX = 21
+
+stop = False
+
+def handle_sigint(signum, frame):
+    global stop
+    stop = True
+
+def main():
+    parser = argparse.ArgumentParser(description='Send fake FicTrac frames over UDP.')
+    parser.add_argument('config', nargs='?', default=None, help='ignored, as FicTrac config file')
+    parser.add_argument('-v', dest='verbosity', default=None, help='ignored, as FicTrac log level')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=33334)
+    parser.add_argument('--rate', type=float, default=100.0, help='frames per second')
+    parser.add_argument('--duration', type=float, default=None, help='(sec) run until SIGINT if not given')
+    parser.add_argument('--lines_per_datagram', type=int, default=1)
+    parser.add_argument('--drop_probability', type=float, default=0.0, help='probability of skipping a frame number')
+    parser.add_argument('--startup_delay', type=float, default=0.0, help='(sec) before the first frame, as FicTrac loading its config')
+    parser.add_argument('--no_files', action='store_true', help='do not write .dat/.log files')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGINT, handle_sigint)
+    signal.signal(signal.SIGTERM, handle_sigint)
+
+    rng = np.random.default_rng(args.seed)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stamp = time.strftime('%y%m%d_%H%M%S')
+    dat_file = None if args.no_files else open(os.path.join(os.getcwd(), 'fictrac-{}.dat'.format(stamp)), 'w')
+    log_file = None if args.no_files else open(os.path.join(os.getcwd(), 'fictrac-{}.log'.format(stamp)), 'w')
+    if log_file is not None:
+        log_file.write('fake fictrac: config {}, {} Hz\n'.format(args.config, args.rate))
+
+    time.sleep(args.startup_delay)
+
+    frame_num = 0
+    theta, x, y = 0.0, 0.0, 0.0
+    t_start = time.monotonic()
+    pending = []
+    cols = np.zeros(N_COLS)
+    while not stop:
+        t_next = t_start + frame_num / args.rate
+        delay = t_next - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if args.duration is not None and time.monotonic() - t_start > args.duration:
+            break
+
+        frame_num += 1
+        if args.drop_probability > 0 and rng.random() < args.drop_probability:
+            continue
+        theta = (theta + 0.02 * rng.standard_normal()) % (2 * np.pi)
+        x += 0.01 * np.cos(theta)
+        y += 0.01 * np.sin(theta)
+
+        cols[:] = rng.standard_normal(N_COLS)
+        cols[X_IDX], cols[Y_IDX], cols[THETA_IDX] = x, y, theta
+        cols[TIMESTAMP_IDX] = 1e3 * time.time()
+        values = ['{:.6f}'.format(v) for v in cols]
+        values[FRAME_NUM_IDX] = str(frame_num)
+        values[TIMESTAMP_IDX] = '{:.3f}'.format(cols[TIMESTAMP_IDX])
+        line = 'FT, ' + ', '.join(values)
+
+        pending.append(line)
+        if len(pending) >= args.lines_per_datagram:
+            sock.sendto(('\n'.join(pending) + '\n').encode(), (args.host, args.port))
+            pending = []
+        if dat_file is not None:
+            dat_file.write(line[4:] + '\n')
+
+    sock.close()
+    for f in (dat_file, log_file):
+        if f is not None:
+            f.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,91 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
-import matplotlib.pyplot as plt
-
+import argparse
 from flystim.screen import Screen, SubScreen
-from flystim.draw import draw_screens
 
 from base_server import BaseServer
+from lab_package.device.rig_geometry import get_rig_geometry
+from lab_package.device.shared_state import CoalescingFsManagerProxy
+from lab_package.stimulus.baccus.cache import SharedPixMapServer
 # from lab_package.device.daq import LabJackTSeries
 # from lab_package.device.loco_managers.fictrac_managers import FtClosedLoopManager
 
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 class MagnetoServer(BaseServer):
-    def __init__(self, screens=[], loco_class=None, loco_kwargs={}, daq_class=None, daq_kwargs={}):
+    """
+    :pose_relay_rate: (Hz) if given, closed-loop pose updates from the loco manager are coalesced and relayed
+                      to the screens at this rate by a separate thread (see lab_package/device/shared_state.py)
+
+    Shared pixmap stimuli whose parameters include 'stimulus_cache': True (see PixMapProtocol) are served from
+    the on-disk stimulus cache by self.pixmap_server instead of being generated by flystim.
+    """
+    subscreen_cache = {}  # ScreenGeometry.get_key() -> SubScreen
+
+    def __init__(self, screens=[], loco_class=None, loco_kwargs={}, daq_class=None, daq_kwargs={}, pose_relay_rate=None):
+        # Set before the loco manager is built, see __set_up_loco__
+        self.pose_relay_rate = pose_relay_rate
+        self.pose_relay = None
         super().__init__(screens=screens, loco_class=loco_class, loco_kwargs=loco_kwargs, daq_class=daq_class, daq_kwargs=daq_kwargs)
 
+        self.manager.register_function_on_root(self.get_pose_relay_counters, "get_pose_relay_counters")
+
+        self.pixmap_server = SharedPixMapServer()
+        self.cached_pixmap_loaded = False
+        self.flystim_load_shared_pixmap_stim = getattr(self.manager, 'load_shared_pixmap_stim', None)
+        self.flystim_start_shared_pixmap_stim = getattr(self.manager, 'start_shared_pixmap_stim', None)
+        self.manager.register_function_on_root(self.load_shared_pixmap_stim, "load_shared_pixmap_stim")
+        self.manager.register_function_on_root(self.start_shared_pixmap_stim, "start_shared_pixmap_stim")
+        self.manager.register_function_on_root(self.prefetch_shared_pixmap_stim, "prefetch_shared_pixmap_stim")
+
+    def load_shared_pixmap_stim(self, **kwargs):
+        if kwargs.pop('stimulus_cache', False):
+            self.pixmap_server.load(**kwargs)
+            self.cached_pixmap_loaded = True
+        else:
+            self.cached_pixmap_loaded = False
+            self.flystim_load_shared_pixmap_stim(**kwargs)
+
+    def prefetch_shared_pixmap_stim(self, **kwargs):
+        kwargs.pop('stimulus_cache', None)
+        self.pixmap_server.prefetch(**kwargs)
+
+    def start_shared_pixmap_stim(self, *args, **kwargs):
+        # Cached frames are all in shared memory once loaded, there is nothing to stream
+        if not self.cached_pixmap_loaded:
+            self.flystim_start_shared_pixmap_stim(*args, **kwargs)
+
+    def get_pose_relay_counters(self):
+        if self.pose_relay is None:
+            return None
+        return self.pose_relay.get_counters()
+
+    def __set_up_loco__(self, loco_class, start_at_init=False, **kwargs):
+        super().__set_up_loco__(loco_class, **kwargs)
+
+        # The relay goes in before the loco manager is started, so that no pose call bypasses it
+        if self.pose_relay_rate is not None and hasattr(self.loco_manager, 'fs_manager'):
+            self.pose_relay = CoalescingFsManagerProxy(self.loco_manager.fs_manager, rate=self.pose_relay_rate)
+            self.loco_manager.fs_manager = self.pose_relay
+        if start_at_init:
+            self.loco_manager.start()
+
+    def loop(self):
+        try:
+            super().loop()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the pose relay and unlink the cached stimulus shared memory blocks.
+        """
+        if self.pose_relay is not None:
+            self.pose_relay.close()
+            self.pose_relay = None
+        self.pixmap_server.close()
+
     def __set_up_daq__(self, daq_class, **kwargs):
         super().__set_up_daq__(daq_class, **kwargs)
 
@@ -23,40 +95,53 @@ class MagnetoServer(BaseServer):
         #     self.manager.register_function_on_root(self.daq_device.stop_stream, "daq_stop_stream")
         #     self.manager.register_function_on_root(self.daq_device.stream_with_timing, "daq_stream_with_timing")
 
-    def get_subscreens(dir):
-        if dir == 'l':
-            viewport_ll = (-1.0, -1.0)
-            viewport_width  = 2
-            viewport_height = 2
-            pa = (-14, -7, -2)
-            pb = (0, 10, -2)
-            pc = (-14, -7, 10)
-        elif dir == 'r':
-            viewport_ll = (-1.0, -1.0)
-            viewport_width  = 2
-            viewport_height = 2
-            pa = (0, 10, -2)
-            pb = (14, -7, -2)
-            pc = (0, 10, 10)
-        elif dir == 'aux':
-            viewport_ll = (-1.0, -1.0)
-            viewport_width  = 2
-            viewport_height = 2
-            pa = (-4, -2, -2)
-            pb = (0, 4, -2)
-            pc = (-4, -2, 2)
-        else:
+        # Acquired samples go to a file on the server, which the client links into its Data (see acquisition.py)
+        if hasattr(getattr(self, 'daq_device', None), 'start_ain_acquisition'):
+            self.manager.register_function_on_root(self.daq_start_ain_acquisition, "daq_start_ain_acquisition")
+            self.manager.register_function_on_root(self.daq_device.stop_ain_acquisition, "daq_stop_ain_acquisition")
+
+    def daq_start_ain_acquisition(self, filepath, **kwargs):
+        # The AinAcquisition object stays on the server
+        self.daq_device.start_ain_acquisition(filepath=filepath, **kwargs)
+
+    @classmethod
+    def get_subscreens(cls, dir, cfg_path, rig_name='Magneto'):
+        """
+        SubScreen for screen dir ('l', 'r' or 'aux'), from the screen corners in the config at cfg_path
+        (rig_config.<rig_name>.screens). Built once per screen geometry, so edits to the config are picked
+        up; see lab_package/device/rig_geometry.py.
+        """
+        screens = get_rig_geometry(rig_name, cfg_path).screens
+        if dir not in screens:
             raise ValueError('Invalid direction.')
-        return SubScreen(pa=pa, pb=pb, pc=pc, viewport_ll=viewport_ll, viewport_width=viewport_width, viewport_height=viewport_height)
+        key = screens[dir].get_key()
+        if key not in cls.subscreen_cache:
+            cls.subscreen_cache[key] = SubScreen(**screens[dir].get_subscreen_kwargs())
+        return cls.subscreen_cache[key]
+
+def show_screens(screens):
+    # matplotlib is only imported when the screen layout is actually drawn
+    import matplotlib.pyplot as plt
+    from flystim.draw import draw_screens
+    draw_screens(screens)
+    plt.show()
 
 def main():
-    left_screen = Screen(subscreens=[MagnetoServer.get_subscreens('l')], server_number=1, id=2, fullscreen=True, vsync=True, square_size=(0.1, 0.1), square_loc=(-0.9, -0.9), name='Left', horizontal_flip=False)
-    right_screen = Screen(subscreens=[MagnetoServer.get_subscreens('r')], server_number=1, id=1, fullscreen=True, vsync=False, square_size=(0.1, 0.1), square_loc=(0.9, 0.9), name='Right', horizontal_flip=False)
-    aux_screen = Screen(subscreens=[MagnetoServer.get_subscreens('aux')], server_number=1, id=0, fullscreen=False, vsync=False, square_size=(0.1, 0.1), square_loc=(-1, -1), name='Aux', horizontal_flip=False)
+    parser = argparse.ArgumentParser(description='Magneto stimulus server.')
+    parser.add_argument('--cfg', default=os.path.join(REPO_DIR, 'configs', 'JBM_config.yaml'), help='config with the rig screen geometry')
+    parser.add_argument('--rig', default='Magneto', help='rig name in the config')
+    args = parser.parse_args()
+
+    left_screen = Screen(subscreens=[MagnetoServer.get_subscreens('l', args.cfg, args.rig)], server_number=1, id=2, fullscreen=True, vsync=True, square_size=(0.1, 0.1), square_loc=(-0.9, -0.9), name='Left', horizontal_flip=False)
+    right_screen = Screen(subscreens=[MagnetoServer.get_subscreens('r', args.cfg, args.rig)], server_number=1, id=1, fullscreen=True, vsync=False, square_size=(0.1, 0.1), square_loc=(0.9, 0.9), name='Right', horizontal_flip=False)
+    aux_screen = Screen(subscreens=[MagnetoServer.get_subscreens('aux', args.cfg, args.rig)], server_number=1, id=0, fullscreen=False, vsync=False, square_size=(0.1, 0.1), square_loc=(-1, -1), name='Aux', horizontal_flip=False)
 
+    # flystim renders each Screen in its own process. With pose_relay_rate, closed-loop pose updates reach
+    # them through the pose relay. Check the Right screen's frame timing with the photodiode
+    # (lab_package/analysis/photodiode.py) before turning its vsync on
     screens = [left_screen, right_screen, aux_screen]
 
-    # draw_screens(screens); plt.show()
+    # show_screens(screens)
 
     # loco_class = FtClosedLoopManager
     # loco_kwargs = {
@@ -73,7 +158,7 @@ def main():
     # daq_class = LabJackTSeries
     # daq_kwargs = {'dev':"470022145", 'trigger_channel':["FIO4", "FIO5", "FIO6"]}
     
-    server = MagnetoServer(screens = screens)#, loco_class=loco_class, loco_kwargs=loco_kwargs, daq_class=daq_class, daq_kwargs=daq_kwargs)
+    server = MagnetoServer(screens = screens)#, loco_class=loco_class, loco_kwargs=loco_kwargs, daq_class=daq_class, daq_kwargs=daq_kwargs, pose_relay_rate=144)
     server.loop()
 
 if __name__ == '__main__':
@@ -0,0 +1,15 @@
+"""
+visprotocol, flystim and flyrpc are only installed on the rigs. Where they are missing, the tests
+import the minimal stand-ins in tests/stubs instead, which are appended to the end of sys.path so
+that installed packages always take precedence.
+"""
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+
+for path in (REPO_DIR, os.path.join(REPO_DIR, 'server')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+sys.path.append(os.path.join(TESTS_DIR, 'stubs'))
@@ -0,0 +1,15 @@
+class MyMultiCall():
+    """
+    Collects calls to manager functions, and makes them in order when called.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.calls = []
+
+    def __getattr__(self, name):
+        def add_call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return add_call
+
+    def __call__(self):
+        return [getattr(self.manager, name)(*args, **kwargs) for name, args, kwargs in self.calls]
@@ -0,0 +1,9 @@
+class SubScreen():
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Screen():
+    def __init__(self, subscreens=None, **kwargs):
+        self.subscreens = subscreens
+        self.__dict__.update(kwargs)
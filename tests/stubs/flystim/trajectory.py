@@ -0,0 +1,19 @@
+import numpy as np
+
+
+class Trajectory():
+    pass
+
+
+def make_as_trajectory(parameter):
+    """
+    Trajectory dicts {'name': 'tv_pairs', 'tv_pairs': [(t, v), ...]} become callables of t, interpolated linearly.
+    """
+    if isinstance(parameter, dict) and parameter.get('name') == 'tv_pairs':
+        times, values = zip(*parameter['tv_pairs'])
+        return lambda t: np.interp(t, times, values)
+    return parameter
+
+
+def return_for_time_t(parameter, t):
+    return parameter(t) if callable(parameter) else parameter
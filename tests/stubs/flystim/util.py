@@ -0,0 +1,6 @@
+import random
+import string
+
+
+def generate_lowercase_barcode(length=10):
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
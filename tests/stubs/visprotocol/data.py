@@ -0,0 +1,7 @@
+class BaseData():
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.data_directory = None
+        self.experiment_file_name = None
+        self.current_subject = None
+        self.series_count = 1
@@ -0,0 +1,12 @@
+class DAQ():
+    def __init__(self):
+        pass
+
+
+class DAQonServer(DAQ):
+    def __init__(self):
+        super().__init__()
+        self.manager = None
+
+    def set_manager(self, manager):
+        self.manager = manager
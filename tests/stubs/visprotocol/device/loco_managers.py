@@ -0,0 +1,23 @@
+class LocoManager():
+    def __init__(self):
+        pass
+
+
+class LocoClosedLoopManager(LocoManager):
+    """
+    Stand-in without the receive loop: lines are handed to _parse_line by the tests.
+    """
+    def __init__(self, fs_manager, host=None, port=None, save_directory=None, start_at_init=False, udp=True):
+        super().__init__()
+        self.fs_manager = fs_manager
+        self.host = host
+        self.port = port
+        self.save_directory = save_directory
+        self.udp = udp
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+    def close(self):
+        self.started = False
@@ -0,0 +1,55 @@
+"""
+Stand-in for visprotocol.protocol: epochs are drawn from the protocol parameters, lists being
+varied parameters. With all_combinations (default) each pass goes through their product, otherwise
+through the lists side by side, each list cycling on its own. randomize_order shuffles each pass.
+"""
+import itertools
+import numpy as np
+
+
+class BaseProtocol():
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.num_epochs_completed = 0
+        self.run_parameters = {}
+        self.protocol_parameters = {}
+        self.epoch_protocol_parameters = None
+        self.epoch_stim_parameters = None
+
+    def prepare_run(self, recompute_epoch_parameters=True):
+        self.num_epochs_completed = 0
+
+    def get_epoch_parameters(self):
+        varied = [key for key, value in self.protocol_parameters.items() if isinstance(value, list) and len(value) > 1]
+        values = [self.protocol_parameters[key] for key in varied]
+        if self.run_parameters.get('all_combinations', True):
+            sequence = list(itertools.product(*values))
+        else:
+            n_pass = max([len(value) for value in values], default=1)
+            sequence = [tuple(value[i % len(value)] for value in values) for i in range(n_pass)]
+        if self.num_epochs_completed % len(sequence) == 0:
+            if self.run_parameters.get('randomize_order', False):
+                sequence = [sequence[i] for i in np.random.permutation(len(sequence))]
+            self.parameter_sequence = sequence
+        combination = self.parameter_sequence[self.num_epochs_completed % len(sequence)]
+        self.epoch_protocol_parameters = {key: (value[0] if isinstance(value, list) else value) for key, value in self.protocol_parameters.items()}
+        self.epoch_protocol_parameters.update(dict(zip(varied, combination)))
+
+    def adjust_center(self, relative_center):
+        return relative_center
+
+    def get_moving_patch_parameters(self, center=None, angle=None, speed=None, width=None, height=None, color=None, **kwargs):
+        return {'name': 'MovingPatch', 'width': width, 'height': height, 'color': color,
+                'theta': {'name': 'tv_pairs', 'tv_pairs': [(0, 0), (1, speed)], 'kind': 'linear'}}
+
+    def load_stimuli(self, client, multicall=None):
+        # Stimulus load commands are added to multicall if given, which the caller then sends
+        target = client.manager if multicall is None else multicall
+        if self.epoch_stim_parameters is not None:
+            target.load_stim(**self.epoch_stim_parameters)
+
+
+class SharedPixMapProtocol(BaseProtocol):
+    def load_stimuli(self, client, multicall=None):
+        target = client.manager if multicall is None else multicall
+        target.load_shared_pixmap_stim(**self.epoch_shared_pixmap_stim_parameters)
@@ -0,0 +1,30 @@
+class Manager():
+    """
+    Records root functions, and calls to flystim's own shared pixmap functions.
+    """
+    def __init__(self):
+        self.functions = {}
+        self.calls = []
+
+    def register_function_on_root(self, function, name):
+        self.functions[name] = function
+
+    def load_shared_pixmap_stim(self, **kwargs):
+        self.calls.append(('load_shared_pixmap_stim', kwargs))
+
+    def start_shared_pixmap_stim(self, *args, **kwargs):
+        self.calls.append(('start_shared_pixmap_stim', kwargs))
+
+
+class BaseServer():
+    def __init__(self, screens=[], loco_class=None, loco_kwargs={}, daq_class=None, daq_kwargs={}):
+        self.screens = screens
+        self.manager = Manager()
+        if loco_class is not None:
+            self.__set_up_loco__(loco_class, **loco_kwargs)
+
+    def __set_up_loco__(self, loco_class, **kwargs):
+        self.loco_manager = loco_class(fs_manager=self.manager, start_at_init=False, **kwargs)
+
+    def loop(self):
+        pass
@@ -0,0 +1,36 @@
+import time
+
+import h5py
+import numpy as np
+
+from lab_package.data import Data
+from lab_package.device import daq, ljm_sim
+
+
+def test_server_side_acquisition_file_is_linked_into_the_epoch_run(tmp_path, monkeypatch):
+    sim = ljm_sim.SimulatedLJM(signals={'AIN0': lambda t: np.sin(t)})
+    monkeypatch.setattr(daq, 'ljm', sim)
+    dev = daq.LabJackTSeries()
+    filepath = str(tmp_path / 'server_ain.hdf5')
+    try:
+        dev.start_ain_acquisition(channels=['AIN0'], scanRate=2000, scansPerRead=100, flush_interval=0.02, filepath=filepath)
+        time.sleep(0.2)
+        counters = dev.stop_ain_acquisition()
+    finally:
+        dev.close()
+    assert counters['error'] is None
+    assert counters['scans_written'] == counters['scans'] > 0
+
+    data = Data({})
+    data.data_directory = str(tmp_path)
+    data.experiment_file_name = 'experiment'
+    data.current_subject = 1
+    with h5py.File(data.get_experiment_filepath(), 'w') as experiment_file:
+        experiment_file.create_group(data.get_epoch_run_group_path())
+    data.link_acquisition_file('acquisition/ain', filepath)
+
+    with h5py.File(data.get_experiment_filepath(), 'r') as experiment_file:
+        ain = experiment_file[data.get_epoch_run_group_path()]['acquisition/ain']
+        assert ain.shape == (counters['scans_written'], 1)
+        assert list(ain.attrs['channel_names']) == ['AIN0']
+        np.testing.assert_allclose(ain[:, 0], np.sin(np.arange(ain.shape[0]) / 2000))
@@ -0,0 +1,73 @@
+import random
+
+import numpy as np
+import pytest
+
+from flyrpc.multicall import MyMultiCall
+
+from lab_package.device.daq import DAQonServer
+from lab_package.protocol import base_protocol
+from lab_package.protocol.JBM_protocol import SyncPulse
+
+
+class Manager():
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda **kwargs: self.calls.append(name)
+
+
+class Client():
+    def __init__(self):
+        self.manager = Manager()
+        self.daq_device = DAQonServer()
+        self.daq_device.set_manager(self.manager)
+
+
+class CountingMultiCall(MyMultiCall):
+    n_sent = 0
+
+    def __call__(self):
+        CountingMultiCall.n_sent += 1
+        return super().__call__()
+
+
+def test_epoch_daq_setup_goes_out_with_the_stimulus_load(monkeypatch):
+    monkeypatch.setattr(base_protocol, 'MyMultiCall', CountingMultiCall)
+    protocol = SyncPulse(cfg={})
+    protocol.protocol_parameters['daq_output_channel'] = 'DAC0'
+    protocol.get_epoch_parameters()
+    client = Client()
+
+    protocol.load_stimuli(client)
+    assert client.manager.calls == ['daq_setup_pulse_wave_streamOut', 'daq_stream_with_timing', 'load_stim']
+    assert CountingMultiCall.n_sent == 1
+    assert client.daq_device.get_round_trip_stats()['round_trips'] == 0
+
+    # With the caller's multicall, nothing is sent until the caller sends it
+    multicall = MyMultiCall(client.manager)
+    protocol.load_stimuli(client, multicall)
+    assert CountingMultiCall.n_sent == 1
+    assert [name for name, _, _ in multicall.calls] == ['daq_setup_pulse_wave_streamOut', 'daq_stream_with_timing', 'load_stim']
+
+
+@pytest.mark.parametrize('all_combinations', [True, False])
+def test_epoch_schedule_matches_visprotocol_order(all_combinations):
+    protocol = base_protocol.BaseProtocol(cfg={})
+    protocol.run_parameters = {'num_epochs': 14, 'all_combinations': all_combinations, 'randomize_order': True}
+    protocol.protocol_parameters = {'speed': [10, 20, 40], 'angle': [0, 90], 'color': 1.0}
+    protocol.precompile_epoch_schedule(seed=5)
+
+    # visprotocol drawing the run live from the same seed
+    live = base_protocol.BaseProtocol(cfg={})
+    live.run_parameters = dict(protocol.run_parameters)
+    live.protocol_parameters = dict(protocol.protocol_parameters)
+    random.seed(5)
+    np.random.seed(5)
+    for epoch_index in range(14):
+        live.num_epochs_completed = epoch_index
+        live.get_epoch_parameters()
+        protocol.num_epochs_completed = epoch_index
+        protocol.get_epoch_parameters()
+        assert protocol.epoch_protocol_parameters == live.epoch_protocol_parameters
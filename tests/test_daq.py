@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from lab_package.device import daq, ljm_sim
+
+
+@pytest.fixture
+def sim(monkeypatch):
+    sim = ljm_sim.SimulatedLJM()
+    monkeypatch.setattr(daq, 'ljm', sim)
+    return sim
+
+
+def test_hardware_timed_pulse_goes_high_after_the_delay_for_the_width(sim):
+    dev = daq.LabJackTSeries(trigger_channel=['FIO4'])
+    try:
+        dev.output_hardware_timed_pulse(output_channel=['FIO4'], pulse_width=0.005, initial_delay=0.002)
+        # Pulse Out: CONFIG_A is the high to low transition, CONFIG_B the low to high one
+        assert sim.registers['DIO4_EF_CONFIG_B'] < sim.registers['DIO4_EF_CONFIG_A']
+        ((dio, t_high, width),) = sim.pulse_log
+        assert dio == 'DIO4'
+        assert width == pytest.approx(0.005)
+        assert t_high - sim.write_log[-1][0] == pytest.approx(0.002)
+    finally:
+        dev.close()
+
+
+def test_buffered_step_fits_the_stream_out_buffer(sim):
+    dev = daq.LabJackTSeries()
+    try:
+        # The defaults (2 sec of waveform) fit by lowering the scan rate
+        dev.buffered_analog_output_step().result(timeout=5)
+        assert len(sim.stream_out[0]['waveform']) <= daq.STREAM_OUT_MAX_SAMPLES
+
+        # An explicit rate is validated
+        with pytest.raises(ValueError):
+            dev.buffered_analog_output_step(scanRate=5000)
+        with pytest.raises(ljm_sim.LJMError):
+            sim.periodicStreamOut(dev.handle, 0, 1000, 5000, daq.STREAM_OUT_MAX_SAMPLES + 1, [0.0] * (daq.STREAM_OUT_MAX_SAMPLES + 1))
+    finally:
+        dev.close()
+
+
+def test_stream_start_error_reaches_the_caller(sim):
+    dev = daq.LabJackTSeries()
+    try:
+        dev.stream_output_channel = 'DAC0'
+        sim.eStreamStart(dev.handle, 1000, 1, [4800], 5000)
+        done = dev.stream_with_timing(pre_time=0.0, stim_time=0.05)
+        with pytest.raises(ljm_sim.LJMError, match='STREAM_IS_ACTIVE'):
+            done.result(timeout=5)
+        sim.eStreamStop(dev.handle)
+
+        # Stopping a running stream early resolves the same future
+        done = dev.stream_with_timing(pre_time=0.0, stim_time=60)
+        while sim.stream is None:
+            time.sleep(0.001)
+        dev.cancel_stream()
+        assert done.result(timeout=5) is None
+    finally:
+        dev.close()
+
+
+def test_conflicting_stream_does_not_touch_the_playing_waveform(sim):
+    dev = daq.LabJackTSeries()
+    try:
+        done = dev.pulse_wave(pre_time=0.0, stim_time=60, freq=10, amp=1.0, blocking=False)
+        while sim.stream is None:
+            time.sleep(0.001)
+        playing = sim.stream_out[0]['waveform'].copy()
+
+        with pytest.raises(daq.ChannelConflictError):
+            dev.pulse_wave(pre_time=0.0, stim_time=1, freq=10, amp=2.0, blocking=False)
+        assert sim.periodic_stream_out_calls == 1
+        assert (sim.stream_out[0]['waveform'] == playing).all()
+
+        dev.cancel_stream()
+        done.result(timeout=5)
+        assert dev.pulse_wave(pre_time=0.0, stim_time=0.01, freq=10, amp=2.0, blocking=True) is not None
+        assert sim.stream_out[0]['waveform'].max() == 2.0
+    finally:
+        dev.close()
+
+
+def test_buffered_step_is_only_marked_uploaded_once_it_ran(sim):
+    dev = daq.LabJackTSeries()
+    try:
+        done = dev.pulse_wave(pre_time=0.0, stim_time=60, blocking=False)
+        dev.stream_setup_future.result(timeout=5)
+        with pytest.raises(daq.ChannelConflictError):
+            dev.buffered_analog_output_step(pre_time=0.1, step_time=0.1, tail_time=0.1)
+        assert sim.periodic_stream_out_calls == 1
+        dev.cancel_stream()
+        done.result(timeout=5)
+
+        # The rejected step was never uploaded, so it is not skipped now
+        dev.buffered_analog_output_step(pre_time=0.1, step_time=0.1, tail_time=0.1).result(timeout=5)
+        assert sim.periodic_stream_out_calls == 2
+        dev.buffered_analog_output_step(pre_time=0.1, step_time=0.1, tail_time=0.1).result(timeout=5)
+        assert (sim.periodic_stream_out_calls, dev.stream_out_uploads_skipped) == (2, 1)
+    finally:
+        dev.close()
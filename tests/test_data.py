@@ -0,0 +1,41 @@
+import h5py
+import numpy as np
+
+from lab_package.data import Data, to_column_value
+
+
+class Protocol():
+    def __init__(self):
+        self.num_epochs_completed = 0
+        self.epoch_protocol_parameters = {}
+        self.epoch_stim_parameters = {}
+
+
+def make_data(tmp_path):
+    data = Data({'epoch_parameter_storage': 'columns'})
+    data.data_directory = str(tmp_path)
+    data.experiment_file_name = 'experiment'
+    data.current_subject = 1
+    with h5py.File(data.get_experiment_filepath(), 'w') as experiment_file:
+        experiment_file.create_group(data.get_epoch_run_group_path())
+    return data
+
+
+def test_ragged_and_empty_values_are_stored_as_json():
+    assert to_column_value([[1, 2], [3]]) == '[[1, 2], [3]]'
+    assert to_column_value([]) == '[]'
+    assert to_column_value(np.zeros(0)) == '[]'
+    np.testing.assert_array_equal(to_column_value([1, 2]), [1, 2])
+
+
+def test_epoch_table_takes_ragged_and_empty_values(tmp_path):
+    data = make_data(tmp_path)
+    protocol = Protocol()
+    for epoch, (ragged, empty) in enumerate([([[1, 2], [3]], []), ([[4], [5, 6]], [1.0]), ([1, 2], np.zeros(0))]):
+        protocol.num_epochs_completed = epoch
+        protocol.epoch_protocol_parameters = {'ragged': ragged, 'empty': empty}
+        data.append_epoch_parameter_row(protocol)
+
+    table = data.get_epoch_parameter_table()['protocol_parameters']
+    assert list(table['ragged']) == ['[[1, 2], [3]]', '[[4], [5, 6]]', '[1, 2]']
+    assert list(table['empty']) == ['[]', '[1.0]', '[]']
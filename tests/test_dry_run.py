@@ -0,0 +1,16 @@
+from lab_package.benchmarks import dry_run
+
+
+def test_dry_run_drives_the_protocol_through_a_run():
+    result = dry_run.run('MovingPatch', num_epochs=3, precompile=True)
+    assert len(result['epochs']) == 3
+    assert 'schedule_hash' in result
+    for epoch in result['epochs']:
+        assert epoch['n_trajectories'] == 1
+        assert epoch['n_frames'] == 432  # 3 sec at 144 Hz
+    assert result['estimated_run_time'] >= 3 * 4.5
+
+
+def test_dry_run_loads_the_stimuli_of_every_epoch():
+    result = dry_run.run('WhiteNoisePixMap', num_epochs=2)
+    assert [epoch['commands'] for epoch in result['epochs']] == [['load_shared_pixmap_stim']] * 2
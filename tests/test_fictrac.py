@@ -0,0 +1,129 @@
+import os
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from lab_package.device.loco_managers.fictrac_managers import FtClosedLoopManager, FtManager
+from lab_package.device.loco_managers.fictrac_parser import FtFrameBuffer
+from lab_package.device.loco_managers.fictrac_recorder import FtRecorder, read_epoch_frames
+from lab_package.device.loco_managers.fictrac_supervisor import FtSupervisor
+
+
+def make_line(frame_num, ts, theta, x=0.0, y=0.0):
+    cols = [0.0] * 25
+    cols[0], cols[21], cols[16], cols[14], cols[15] = frame_num, ts, theta, x, y
+    return 'FT, ' + ', '.join(str(c) for c in cols)
+
+
+def test_parse_line_returns_the_pose():
+    manager = FtClosedLoopManager(fs_manager=None)
+    pose = manager._parse_line(make_line(7, 1000.0, 0.5, x=1.0, y=2.0).encode())
+    assert pose == {'frame_num': 7, 'ts': 1000.0, 'theta': -0.5, 'x': 1.0, 'y': 2.0, 'z': 0.0}
+    assert manager.ft_frames.count == 1
+    assert manager._parse_line(b'not fictrac') is None
+
+
+@pytest.mark.parametrize('predictor', [None, {'mode': 'constant_velocity', 'max_horizon': 1.0}])
+def test_kept_pose_does_not_change_with_later_frames(predictor):
+    # The closed-loop manager keeps the initial pose (pos_0) for the whole epoch
+    manager = FtClosedLoopManager(fs_manager=None)
+    manager.set_predictor(predictor)
+    pos_0 = manager._parse_line(make_line(0, 0.0, 0.5, x=1.0, y=2.0).encode())
+    kept = dict(pos_0)
+    for frame_num in range(1, 2 * manager.ft_frames.capacity):
+        manager._parse_line(make_line(frame_num, 0.01 * frame_num, 0.5 + frame_num, x=frame_num).encode())
+    assert pos_0 == kept
+
+
+def test_predictor_parameters_round_trip():
+    manager = FtClosedLoopManager(fs_manager=None)
+    manager.set_predictor(manager.get_predictor_parameters())
+    assert manager.predictor is None
+
+    parameters = {'mode': 'constant_velocity', 'refresh_rate': 100.0, 'max_horizon': 1.0}
+    with pytest.raises(ValueError):
+        manager.set_predictor(parameters)
+    manager.set_predictor(parameters, vsync_reference=lambda: 10.003)
+    manager.set_predictor(manager.get_predictor_parameters(), vsync_reference=lambda: 10.003)
+    # Targets follow the reference's phase
+    assert manager.predictor.get_target_time(now=20.0) == pytest.approx(20.003)
+
+
+def test_epochs_are_indexed_by_frame_number(tmp_path):
+    manager = FtClosedLoopManager(fs_manager=None, save_directory=str(tmp_path))
+    filepath = manager.start_recording(flush_interval=0.01)
+    manager._parse_line(make_line(0, 0.0, 0.0).encode())
+    manager.mark_epoch_start(1)
+    for frame_num in (1, 2, 5, 6):  # frames 3 and 4 are lost
+        manager._parse_line(make_line(frame_num, 10.0 * frame_num, 0.0).encode())
+    manager.mark_epoch_end()
+    manager._parse_line(make_line(7, 70.0, 0.0).encode())
+    manager.mark_epoch_start(2)
+    manager._parse_line(make_line(8, 80.0, 0.0).encode())
+    counters = manager.stop_recording()
+    assert counters['frames_written'] == 7
+    assert counters['epochs_written'] == 2
+
+    with h5py.File(filepath, 'r') as f:
+        assert list(read_epoch_frames(f, 1)['frame_num']) == [1, 2, 5, 6]
+        epoch_2 = read_epoch_frames(f, 2)
+        assert list(epoch_2['frame_num']) == [8]
+        assert f['fictrac/epoch_index']['start_ts'][1] == 70.0
+        assert (f['fictrac/epoch_index']['start_row'][1], f['fictrac/epoch_index']['end_row'][1]) == (6, 7)
+        assert f['fictrac/frames'].chunks[0] > 1
+
+
+def test_epoch_rows_account_for_frames_lost_before_writing():
+    buffer = FtFrameBuffer(capacity=4)
+    frames, epochs = [], []
+    recorder = FtRecorder(buffer, frames.append, epoch_index_sink=epochs.append)
+    recorder.start_count = recorder.read_count = buffer.count
+    for frame_num in range(6):  # frames 0 and 1 are overwritten before the flush
+        buffer.append(frame_num, 0.0, 0.0, 0.0, 0.0)
+        if frame_num == 2:
+            recorder.mark_epoch_start(1)
+    recorder._flush()
+    for frame_num in range(6, 8):
+        buffer.append(frame_num, 0.0, 0.0, 0.0, 0.0)
+    recorder.mark_epoch_end()
+    recorder._flush()
+
+    written = np.concatenate(frames)
+    ((epoch,),) = epochs
+    assert list(written['frame_num'][epoch['start_row']:epoch['end_row']]) == [3, 4, 5, 6, 7]
+    assert recorder.get_counters()['frames_lost'] == 2
+
+
+FAKE_FICTRAC = """#!/bin/sh
+echo frames > output_$$.log
+trap 'exit 0' INT
+while true; do sleep 0.01; done
+"""
+
+
+def test_supervised_fictrac_output_is_saved_on_restart_and_shutdown(tmp_path, monkeypatch):
+    ft_bin = tmp_path / 'fictrac'
+    ft_bin.write_text(FAKE_FICTRAC)
+    ft_bin.chmod(0o755)
+    cwds = iter(str(tmp_path / 'cwd_{}'.format(i)) for i in range(10))
+    monkeypatch.setattr(FtManager, '_new_cwd', staticmethod(lambda: next(cwds)))
+
+    def wait_for_output(ft_manager):
+        while not os.path.isdir(ft_manager.cwd) or not os.listdir(ft_manager.cwd):
+            time.sleep(0.01)
+
+    supervisor = FtSupervisor(ft_bin=str(ft_bin), ft_config='config.txt', port=0, startup_timeout=60)
+    save_directory = tmp_path / 'saved'
+    manager = FtClosedLoopManager(fs_manager=None, ft_supervisor=supervisor)
+    manager.set_save_directory(str(save_directory))
+    supervisor.ensure_running()
+    try:
+        wait_for_output(supervisor.ft_manager)
+        supervisor.restart('test')
+        wait_for_output(supervisor.ft_manager)
+    finally:
+        supervisor.shutdown().result(timeout=10)
+    assert supervisor.ft_manager.wait_for_finalize(timeout=10)
+    assert len([fn for fn in os.listdir(save_directory) if fn.startswith('output_')]) == 2
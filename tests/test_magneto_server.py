@@ -0,0 +1,28 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import Magneto
+from lab_package.stimulus.baccus import cache
+
+
+def test_cached_pixmap_is_served_from_the_stimulus_cache(tmp_path):
+    server = Magneto.MagnetoServer()
+    server.pixmap_server = cache.SharedPixMapServer(stimulus_cache=cache.StimulusCache(cache_dir=str(tmp_path)))
+    load = server.manager.functions['load_shared_pixmap_stim']
+    start = server.manager.functions['start_shared_pixmap_stim']
+    parameters = {'name': 'WhiteNoise', 'memname': 'testmagnetopixmap', 'frame_shape': [2, 3, 3], 'nominal_frame_rate': 10.0, 'dur': 0.5, 'seed': 1}
+    try:
+        load(stimulus_cache=True, **parameters)
+        start()
+        assert server.manager.calls == []
+        block = shared_memory.SharedMemory(name='testmagnetopixmap')
+        assert np.ndarray((6, 2, 3, 3), dtype=np.uint8, buffer=block.buf)[0].sum() > 0
+        block.close()
+
+        # Without the mark, flystim generates the frames
+        load(**dict(parameters, memname='othermemname'))
+        start()
+        assert [name for name, _ in server.manager.calls] == ['load_shared_pixmap_stim', 'start_shared_pixmap_stim']
+    finally:
+        server.pixmap_server.close()
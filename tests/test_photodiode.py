@@ -0,0 +1,23 @@
+import numpy as np
+
+from lab_package.analysis.photodiode import PhotodiodeAligner
+
+
+def test_low_contrast_channel_does_not_hold_samples_forever():
+    sample_rate = 1000.0
+    aligner = PhotodiodeAligner(sample_rate, min_contrast=0.5, max_pending_time=1.0)
+    # Square flipping every 10 ms at 0.2 V contrast, below min_contrast
+    square = 0.2 * (np.arange(200) // 10 % 2)
+    for _ in range(4):
+        assert aligner.feed(square) == 0
+        assert aligner.low is None
+    assert not aligner.low_contrast
+    assert aligner.feed(square) > 0
+    assert aligner.low_contrast
+    assert aligner.pending_chunks == []
+    assert 0 < aligner.low < aligner.high < 0.2
+
+    aligner.feed(square)
+    assert aligner.pending_chunks == []
+    np.testing.assert_allclose(np.diff(aligner.get_frame_times()), 0.01)
+    assert aligner.get_timing()['low_contrast']
@@ -0,0 +1,87 @@
+import numpy as np
+
+from lab_package.protocol.JBM_protocol import WhiteNoisePixMap
+from lab_package.stimulus.baccus import cache
+
+
+class Manager():
+    def __init__(self):
+        self.calls = []
+
+    def load_shared_pixmap_stim(self, **kwargs):
+        self.calls.append(('load_shared_pixmap_stim', kwargs))
+
+    def prefetch_shared_pixmap_stim(self, **kwargs):
+        self.calls.append(('prefetch_shared_pixmap_stim', kwargs))
+
+
+class Client():
+    def __init__(self):
+        self.manager = Manager()
+
+
+def test_prefetch_requests_the_next_epoch_frames():
+    protocol = WhiteNoisePixMap(cfg={})
+    protocol.protocol_parameters.update({'seed': [1, 2, 3], 'boxes_w': 4, 'boxes_h': 2, 'prefetch_frames': True})
+    protocol.run_parameters['num_epochs'] = 3
+    protocol.prepare_run()
+    client = Client()
+
+    protocol.get_epoch_parameters()
+    protocol.load_stimuli(client)
+    (_, loaded), (name, prefetched) = client.manager.calls
+    assert name == 'prefetch_shared_pixmap_stim'
+    assert loaded['seed'] == protocol.epoch_protocol_parameters['seed']
+
+    # The prefetched parameters are the ones the next epoch loads, randomized order included
+    protocol.num_epochs_completed += 1
+    protocol.get_epoch_parameters()
+    protocol.load_stimuli(client)
+    assert client.manager.calls[2][1] == dict(prefetched, stimulus_cache=True)
+
+
+def test_white_noise_is_presented_from_its_noise_source(tmp_path):
+    protocol = WhiteNoisePixMap(cfg={})
+    protocol.protocol_parameters.update({'boxes_w': 4, 'boxes_h': 2})
+    protocol.get_epoch_parameters()
+    client = Client()
+    protocol.load_stimuli(client)
+    assert client.manager.calls[0][1]['stimulus_cache'] is True
+
+    frames = protocol.get_epoch_frames(stimulus_cache=cache.StimulusCache(cache_dir=str(tmp_path)))
+    np.testing.assert_array_equal(frames, protocol.get_noise_source().get_frames(0, len(frames)))
+
+
+def test_precompiled_epochs_are_compiled_again_for_each_run():
+    protocol = WhiteNoisePixMap(cfg={})
+    protocol.protocol_parameters.update({'seed': [1, 2], 'boxes_w': 4, 'boxes_h': 2, 'prefetch_frames': True})
+    protocol.run_parameters['num_epochs'] = 2
+    client = Client()
+
+    memnames = []
+    for _ in range(2):
+        protocol.prepare_run()
+        assert 'get_epoch_parameters' not in protocol.__dict__
+        for _ in range(protocol.run_parameters['num_epochs']):
+            protocol.get_epoch_parameters()
+            protocol.load_stimuli(client)
+            memnames.append(protocol.epoch_shared_pixmap_stim_parameters['memname'])
+            protocol.num_epochs_completed += 1
+    assert len(set(memnames)) == len(memnames)
+
+    # Nothing is prefetched during the last epoch of a run
+    names = [name for name, _ in client.manager.calls]
+    assert names == ['load_shared_pixmap_stim', 'prefetch_shared_pixmap_stim', 'load_shared_pixmap_stim'] * 2
+
+    protocol.clear_epoch_schedule()
+    protocol.get_epoch_parameters()
+    assert protocol.epoch_shared_pixmap_stim_parameters['memname'] not in memnames
+
+
+def test_white_noise_falls_back_to_flystim_without_the_stimulus_cache():
+    protocol = WhiteNoisePixMap(cfg={})
+    protocol.protocol_parameters.update({'boxes_w': 4, 'boxes_h': 2, 'use_stimulus_cache': False})
+    protocol.get_epoch_parameters()
+    client = Client()
+    protocol.load_stimuli(client)
+    assert 'stimulus_cache' not in client.manager.calls[0][1]
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import yaml
+
+import Magneto
+from lab_package.device.rig_geometry import get_rig_geometry
+
+SCREEN = {'pa': [-14, -7, -2], 'pb': [0, 10, -2], 'pc': [-14, -7, 10], 'resolution': [1920, 1080]}
+
+
+def write_config(cfg_path, screen, mtime):
+    with open(cfg_path, 'w') as f:
+        yaml.safe_dump({'rig_config': {'Magneto': {'screens': {'l': screen}}}}, f)
+    os.utime(cfg_path, (mtime, mtime))
+
+
+def get_center_angles(screen):
+    x, y, z = (np.array(screen['pb']) + np.array(screen['pc'])) / 2
+    return np.degrees(np.arctan2(y, x)), np.degrees(np.arccos(z / np.linalg.norm((x, y, z))))
+
+
+def test_screen_center_maps_to_the_window_center(tmp_path):
+    cfg_path = str(tmp_path / 'config.yaml')
+    write_config(cfg_path, SCREEN, 1e9)
+    screen = get_rig_geometry('Magneto', cfg_path).screens['l']
+    theta, phi = get_center_angles(SCREEN)
+
+    ndc, visible = screen.angles_to_ndc(theta, phi)
+    np.testing.assert_allclose(ndc, (0, 0), atol=1e-9)
+    assert visible
+    pixels, _ = screen.angles_to_pixels(theta, phi)
+    np.testing.assert_allclose(pixels, (960, 540), atol=1e-6)
+
+    # The opposite direction misses the screen
+    assert screen.get_coverage([theta, theta + 180], [phi, 180 - phi]) == 0.5
+
+
+def test_subscreens_follow_config_changes(tmp_path):
+    cfg_path = str(tmp_path / 'config.yaml')
+    write_config(cfg_path, SCREEN, 1e9)
+    subscreen = Magneto.MagnetoServer.get_subscreens('l', cfg_path)
+    assert Magneto.MagnetoServer.get_subscreens('l', cfg_path) is subscreen
+
+    write_config(cfg_path, dict(SCREEN, pa=[-15, -7, -2], pc=[-15, -7, 10]), 2e9)
+    moved = Magneto.MagnetoServer.get_subscreens('l', cfg_path)
+    assert moved is not subscreen
+    assert moved.pa == (-15.0, -7.0, -2.0)
@@ -0,0 +1,65 @@
+import pytest
+
+import Magneto
+from lab_package.device.shared_state import CoalescingFsManagerProxy
+from visprotocol.device.loco_managers import LocoClosedLoopManager
+
+
+class FsManager():
+    def __init__(self, fail=()):
+        self.calls = []
+        self.fail = fail
+
+    def set_global_theta_offset(self, theta):
+        if 'set_global_theta_offset' in self.fail:
+            raise RuntimeError('screen not responding')
+        self.calls.append(('set_global_theta_offset', theta))
+
+    def set_global_fly_pos(self, x, y, z):
+        self.calls.append(('set_global_fly_pos', (x, y, z)))
+
+
+def make_relay(fs_manager):
+    # Relay thread stopped, so that the tests flush by hand
+    relay = CoalescingFsManagerProxy(fs_manager, rate=1.0)
+    relay.stop_event.set()
+    relay.relay.join()
+    return relay
+
+
+def test_relay_forwards_the_latest_call_per_method():
+    fs_manager = FsManager()
+    relay = make_relay(fs_manager)
+    try:
+        for theta in range(10):
+            relay.set_global_theta_offset(theta)
+        relay.set_global_fly_pos(1, 2, 0)
+        relay.flush()
+        assert fs_manager.calls == [('set_global_theta_offset', 9), ('set_global_fly_pos', (1, 2, 0))]
+        assert relay.get_counters()['forwarded'] == 2
+    finally:
+        relay.close()
+
+
+def test_failed_call_does_not_drop_the_rest_of_the_batch():
+    fs_manager = FsManager(fail=('set_global_theta_offset',))
+    relay = make_relay(fs_manager)
+    try:
+        relay.set_global_theta_offset(1)
+        relay.set_global_fly_pos(1, 2, 0)
+        with pytest.raises(RuntimeError):
+            relay.flush()
+        relay.flush()
+        assert fs_manager.calls == [('set_global_fly_pos', (1, 2, 0))]
+    finally:
+        relay.close()
+
+
+def test_server_relays_pose_calls_and_stops_the_relay_on_shutdown():
+    server = Magneto.MagnetoServer(loco_class=LocoClosedLoopManager, loco_kwargs={'start_at_init': True}, pose_relay_rate=1000.0)
+    relay = server.pose_relay
+    assert server.loco_manager.fs_manager is relay
+    assert server.loco_manager.started
+    server.loop()
+    assert server.pose_relay is None
+    assert not relay.relay.is_alive()
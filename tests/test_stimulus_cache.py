@@ -0,0 +1,66 @@
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from lab_package.stimulus.baccus import cache, util
+from lab_package.stimulus.baccus.noise import WhiteNoiseFrames
+
+
+def test_default_cache_in_resources():
+    stimulus_cache = cache.get_default_cache()
+    assert stimulus_cache.cache_dir == os.path.join(util.REPO_DIR, 'resources', cache.CACHE_DIRNAME)
+    assert os.path.isdir(stimulus_cache.cache_dir)
+    assert cache.get_default_cache() is stimulus_cache
+
+
+def test_white_noise_frames_are_cached(tmp_path):
+    stimulus_cache = cache.StimulusCache(cache_dir=str(tmp_path))
+    frames = stimulus_cache.get_white_noise_frames(seed=3, frame_shape=(4, 5, 3), frame_rate=10.0, duration=2.0)
+    assert frames.shape == (20, 4, 5, 3)
+    np.testing.assert_array_equal(frames, WhiteNoiseFrames((4, 5, 3), seed=3).get_frames(0, 20))
+    assert len(stimulus_cache.list_entries()) == 1
+    again = stimulus_cache.get_white_noise_frames(seed=3, frame_shape=(4, 5, 3), frame_rate=10.0, duration=2.0)
+    assert isinstance(again, np.memmap)
+    assert len(stimulus_cache.list_entries()) == 1
+
+
+def test_shared_pixmap_server_loads_cached_frames(tmp_path):
+    server = cache.SharedPixMapServer(stimulus_cache=cache.StimulusCache(cache_dir=str(tmp_path)), keep=1)
+    parameters = {'name': 'WhiteNoise', 'frame_shape': (4, 5, 3), 'nominal_frame_rate': 10.0, 'dur': 1.0, 'seed': 7, 'stimulus_cache': True}
+    memnames = ['testpixmapa', 'testpixmapb']
+    try:
+        server.prefetch(**parameters).result(timeout=10)
+        assert server.load(memname=memnames[0], **parameters) == (10, 4, 5, 3)
+
+        block = shared_memory.SharedMemory(name=memnames[0])
+        frames = np.ndarray((11, 4, 5, 3), dtype=np.uint8, buffer=block.buf).copy()
+        block.close()
+        expected = WhiteNoiseFrames((4, 5, 3), seed=7).get_frames(0, 10)
+        np.testing.assert_array_equal(frames[:10], expected)
+        np.testing.assert_array_equal(frames[10], expected[-1])
+
+        # Only the most recent block is kept
+        server.load(memname=memnames[1], **parameters)
+        assert [memname for memname, _ in server.blocks] == [memnames[1]]
+    finally:
+        server.close()
+    for memname in memnames:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=memname)
+
+
+def test_movie_frames_are_rendered_at_the_requested_shape(tmp_path, monkeypatch):
+    movie = tmp_path / 'movie.mp4'
+    movie.write_bytes(b'not decoded')
+    rendered_shapes = []
+    monkeypatch.setattr(cache, 'render_movie_frames', lambda out, filepath, start_frame: rendered_shapes.append(out.shape))
+    stimulus_cache = cache.StimulusCache(cache_dir=str(tmp_path / 'cache'))
+    parameters = {'name': 'StreamMovie', 'filepath': str(movie), 'nominal_frame_rate': 10.0, 'start_frame': 0, 'duration': 1.0}
+
+    frames = cache.get_pixmap_frames(dict(parameters, frame_shape=(4, 6)), stimulus_cache=stimulus_cache)
+    assert frames.shape == (10, 4, 6, 3)
+    cache.get_pixmap_frames(dict(parameters, frame_shape=(8, 12, 3)), stimulus_cache=stimulus_cache)
+    cache.get_pixmap_frames(dict(parameters, frame_shape=(4, 6, 3)), stimulus_cache=stimulus_cache)
+    assert rendered_shapes == [(10, 4, 6, 3), (10, 8, 12, 3)]
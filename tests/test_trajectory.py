@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from lab_package.stimulus.baccus.trajectory import TVPairsBounded
+
+
+def test_precompiled_table_keeps_breakpoints():
+    tv_pairs = [(0, 0), (1, 10), (2, 0)]
+    trajectory = TVPairsBounded(tv_pairs, precompile_dt=0.3)
+    assert trajectory.getValue(1.0) == pytest.approx(10)
+
+    t = np.linspace(-0.5, 2.5, 31)
+    np.testing.assert_allclose(trajectory.getValues(t), TVPairsBounded(tv_pairs).getValues(t))
+    np.testing.assert_allclose([trajectory.getValue(x) for x in t], trajectory.getValues(t))
+
+
+def test_interp1d_is_only_built_in_interp1d_mode():
+    assert not hasattr(TVPairsBounded([(0, 0), (1, 10)]), 'values_interpolated')
+    assert not hasattr(TVPairsBounded([(0, 0), (1, 10), (2, 0)], kind='quadratic', precompile_dt=0.1), 'values_interpolated')
+    assert TVPairsBounded([(0, 0), (1, 10), (2, 0)], kind='quadratic').getValue(1.0) == pytest.approx(10)